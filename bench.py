@@ -0,0 +1,405 @@
+"""Micro-benchmarks for rr.py hot paths.
+
+Usage:
+    python bench.py router [--messages 200000]
+    python bench.py memory [--records 1000000]
+    python bench.py codes [--codes 100000]
+    python bench.py engines [--updates 2000] [--latency 0.05] [--threads 8]
+    python bench.py redeem-stress [--redeems 10000] [--uses 100] [--threads 64]
+    python bench.py start [--messages 50000]
+
+Runs against in-memory data only; no Telegram calls are made (`engines` answers the Bot API
+calls from a fake that just sleeps for --latency).
+"""
+import argparse
+import asyncio
+import gc
+import itertools
+import os
+import random
+import string
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("DISPATCH_WORKERS", "0")
+
+import telebot  # noqa: E402
+import telebot.asyncio_helper  # noqa: E402
+import rr  # noqa: E402
+
+
+def make_message(uid, text):
+    return telebot.types.Message.de_json({
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": "Bench"},
+        "text": text,
+    })
+
+
+def populate(n_files=100_000, n_bundles=10_000, n_codes=100_000):
+    for i in range(n_files):
+        rr.files_db[f"F{i:09d}"] = rr.FileRecord(i % 1000, i, "document", "", i)
+    for i in range(n_bundles):
+        rr.bundles_db[f"B{i:09d}"] = rr.BundleRecord(i % 1000, [f"F{i:09d}"], i)
+    for i in range(n_codes):
+        rr.codes_db[f"R{i:09d}"] = {"category": "Movies", "account": "a", "max_uses": 1, "used_count": 0,
+                                   "expires_at": None, "created_by": 0}
+
+
+def legacy_chain():
+    """The predicate chain text messages went through before the router (same order)."""
+    stage = lambda m, s: rr.pending_redeem.get(m.from_user.id, {}).get("stage") == s
+    return [
+        (lambda m: stage(m, "have_cat"), "have_cat"),
+        (lambda m: stage(m, "await_code"), "await_code"),
+        (lambda m: stage(m, "await_time"), "await_time"),
+        (lambda m: stage(m, "await_limit"), "await_limit"),
+        (lambda m: (m.content_type == 'text') and (
+            legacy_is_deeplink(m.text) or (m.text.strip() in rr.files_db) or (m.text.strip() in rr.bundles_db)
+        ), "retrieve"),
+        (lambda m: rr.pending_privacy.get(m.from_user.id) is not None, "privacy"),
+        (lambda m: m.content_type == 'text' and not m.text.startswith('/'), "redeem"),
+    ]
+
+
+def legacy_is_deeplink(text):
+    if not text:
+        return ""
+    m = rr.re.search(r"(?:https?://)?t\.me/[^?\s]+?\?start=([A-Za-z0-9_-]+)", text)
+    return m.group(1) if m else ""
+
+
+def bench_router(args):
+    populate()
+    rnd = random.Random(1)
+    for uid in range(0, 50):
+        rr.pending_redeem[uid] = {"stage": "await_limit", "category": "Movies", "accounts": ["a"]}
+    for uid in range(50, 60):
+        rr.pending_privacy[uid] = {"kind": "file", "code": "F000000001"}
+    texts = (
+        [f"https://t.me/YourBot?start=F{i:09d}" for i in range(0, 1000, 7)]
+        + [f"F{i:09d}" for i in range(0, 100_000, 997)]
+        + [f"B{i:09d}" for i in range(0, 10_000, 97)]
+        + [f"R{i:09d}" for i in range(0, 100_000, 997)]
+        + ["hello there", "netflix pls", "XXXXXXXXXX", "12"] * 50
+    )
+    messages = [make_message(rnd.randrange(0, 5000), rnd.choice(texts)) for _ in range(args.messages)]
+
+    chain = legacy_chain()
+    started = time.perf_counter()
+    for m in messages:
+        for pred, name in chain:
+            if pred(m):
+                break
+    legacy = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for m in messages:
+        rr.text_route(m)
+    routed = time.perf_counter() - started
+
+    # both paths must agree on where every message goes
+    names = {rr.receive_accounts_for_redeem: "have_cat", rr.finalize_custom_code: "await_code",
+             rr.finalize_time_code: "await_time", rr.finalize_limit_code: "await_limit",
+             rr.retrieve_by_link_or_code: "retrieve", rr.receive_unlisted_limit: "privacy",
+             rr.redeem_code: "redeem", None: None}
+    for m in messages[:5000]:
+        expected = next((name for pred, name in chain if pred(m)), None)
+        assert names[rr.text_route(m)[0]] == expected, (m.from_user.id, m.text)
+
+    n = len(messages)
+    print(f"predicate chain: {n / legacy:,.0f} msg/s")
+    print(f"router:          {n / routed:,.0f} msg/s  ({legacy / routed:.1f}x)")
+
+
+def file_json(i):
+    """A files_db entry as it is stored on disk (and as it was kept in memory before FileRecord)."""
+    return {"owner": 5_000_000_000 + i % 100_000, "store_msg_id": 100_000 + i, "type": ("document", "photo", "video")[i % 3],
+            "caption": "", "created_at": 1_700_000_000 + i,
+            "access": {"mode": "public", "limit": None, "viewed_by": []}}
+
+
+def measure(build, n):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    table = build(n)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return table, (after - before) / n
+
+
+def bench_memory(args):
+    n = args.records
+    codes = [f"F{i:09d}" for i in range(n)]  # keys are shared by both layouts and not counted
+    _, dict_bytes = measure(lambda n: {codes[i]: file_json(i) for i in range(n)}, n)
+    table, record_bytes = measure(lambda n: {codes[i]: rr.FileRecord.from_json(file_json(i)) for i in range(n)}, n)
+    assert table[codes[1]].to_json() == file_json(1)
+    print(f"{n:,} file records, excluding the code strings:")
+    print(f"dict entries: {dict_bytes:,.0f} bytes/record")
+    print(f"FileRecord:   {record_bytes:,.0f} bytes/record  ({dict_bytes / record_bytes:.1f}x smaller)")
+
+
+def legacy_generate_unique_code():
+    """generate_code()/generate_unique_code() as they were before CodeAllocator."""
+    chars = string.ascii_letters + string.digits
+    while True:
+        code = ''.join(random.choice(chars) for _ in range(10))
+        if (code not in rr.codes_db) and (code not in rr.files_db) and (code not in rr.bundles_db):
+            return code
+
+
+def bench_codes(args):
+    populate()
+    rr.code_allocator.rebuild()
+    n = args.codes
+
+    started = time.perf_counter()
+    legacy = [legacy_generate_unique_code() for _ in range(n)]
+    legacy_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    single = [rr.generate_unique_code() for _ in range(n)]
+    single_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    batch = rr.code_allocator.allocate(n)
+    batch_s = time.perf_counter() - started
+
+    assert len(set(legacy)) == n and len(set(single) | set(batch)) == 2 * n
+    assert not (set(batch) & (set(rr.codes_db) | set(rr.files_db) | set(rr.bundles_db)))
+    assert all(len(c) == rr.CODE_LENGTH and set(c) <= set(rr.CODE_ALPHABET) for c in batch)
+    print(f"{n:,} codes against {len(rr.code_allocator.taken) - 2 * n:,} existing:")
+    print(f"legacy random.choice loop: {legacy_s * 1000:8.1f} ms")
+    print(f"allocator, one at a time:  {single_s * 1000:8.1f} ms  ({legacy_s / single_s:.1f}x)")
+    print(f"allocator, one batch:      {batch_s * 1000:8.1f} ms  ({legacy_s / batch_s:.1f}x)")
+
+
+def no_rate_limits():
+    """These benchmarks measure the bot, not the token buckets."""
+    rr.API_CHAT_RATE = rr.API_CHAT_BURST = 1e9
+    rr.api.global_bucket = rr.TokenBucket(1e9)
+
+
+def fake_bot_api(latency, calls):
+    """Patch telebot's sync and async request functions with a Bot API that only sleeps.
+    Every call is appended to `calls` as (method, params)."""
+    ids = itertools.count(1)
+
+    def result(method, params):
+        calls.append((method, params))
+        if method == "copyMessage":
+            return {"message_id": next(ids)}
+        if method == "copyMessages":
+            return [{"message_id": next(ids)} for _ in rr.json.loads(params["message_ids"])]
+        return {"message_id": next(ids), "date": 0, "chat": {"id": int(params.get("chat_id", 0)), "type": "private"}}
+
+    def sync_request(token, method_name, method="get", params=None, files=None):
+        time.sleep(latency)
+        return result(method_name, params or {})
+
+    async def async_request(token, url, method="get", params=None, files=None, **kwargs):
+        await asyncio.sleep(latency)
+        return result(url, params or {})
+
+    telebot.apihelper._make_request = sync_request
+    telebot.asyncio_helper._process_request = async_request
+
+
+def start_updates(n, first_id):
+    updates = []
+    for i in range(n):
+        uid = 10_000_000 + i
+        text = f"/start F{i % 100_000:09d}"
+        updates.append(telebot.types.Update.de_json({"update_id": first_id + i, "message": {
+            "message_id": i + 1, "date": 0, "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": "Bench"}, "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}))
+    return updates
+
+
+def bench_engines(args):
+    populate()
+    no_rate_limits()
+    calls = []
+    fake_bot_api(args.latency, calls)
+    n = args.updates
+    copies = lambda: sum(method == "copyMessage" for method, _ in calls)
+
+    rr.bot.threaded = False
+    updates = start_updates(n, 1)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(lambda u: rr.bot.process_new_updates([u]), updates))
+    thread_s = time.perf_counter() - started
+    assert copies() == n, "every update must retrieve its file"
+    calls.clear()
+
+    engine = rr.AsyncEngine()
+    updates = start_updates(n, n + 1)
+
+    async def run_async():
+        engine.loop = asyncio.get_running_loop()
+        for u in updates:
+            while not engine.inflight.acquire(blocking=False):
+                await asyncio.sleep(0.001)
+            engine.spawn(u)
+        await engine.drain()
+
+    started = time.perf_counter()
+    asyncio.run(run_async())
+    async_s = time.perf_counter() - started
+    assert copies() == n, "every update must retrieve its file"
+
+    print(f"{n:,} concurrent /start deep-link retrievals, {args.latency * 1000:.0f} ms per Bot API call:")
+    print(f"thread engine ({args.threads} workers): {n / thread_s:8,.0f} retrievals/s")
+    print(f"asyncio engine:             {n / async_s:8,.0f} retrievals/s  ({thread_s / async_s:.1f}x)")
+
+
+def bench_redeem_stress(args):
+    tmp = tempfile.mkdtemp(prefix="rr-bench-")
+    journal = rr.codes_journal
+    journal.snapshot_path = os.path.join(tmp, "codes.json")
+    journal.journal_path = os.path.join(tmp, "codes.journal")
+    journal.old_path = journal.journal_path + ".old"
+    rr.store = rr.JsonStore()
+    no_rate_limits()
+    calls = []
+    fake_bot_api(0, calls)
+    n = args.redeems
+    uids = range(20_000_000, 20_000_000 + n)
+    for uid in uids:
+        rr.membership_cache[uid] = (True, time.monotonic())
+
+    def new_code(code):
+        with rr.db_lock:
+            rr.codes_db[code] = {"category": "Netflix", "account": "stress@example.com", "max_uses": args.uses,
+                                 "used_count": 0, "expires_at": None, "created_by": 0}
+        rr.save_codes_db(code)
+        calls.clear()
+        return [make_message(uid, code) for uid in uids]
+
+    def check(engine, code, elapsed):
+        successes = sum(method == "sendMessage" and p["text"].startswith("🎉") for method, p in calls)
+        refused = sum(method == "sendMessage" and p["text"].startswith("❌") for method, p in calls)
+        assert successes == args.uses, f"{engine}: {successes} successes for a {args.uses}-use code"
+        assert successes + refused == n
+        assert rr.codes_db[code]["used_count"] == args.uses
+        print(f"{engine:<16} {n:,} redeems in {elapsed:.2f}s: {successes} succeeded, {refused:,} refused")
+
+    messages = new_code("STRESSTHRD")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(rr.redeem_code, messages))
+    check(f"threads ({args.threads})", "STRESSTHRD", time.perf_counter() - started)
+
+    engine = rr.AsyncEngine()
+    messages = new_code("STRESSASYN")
+
+    async def run_async():
+        await asyncio.gather(*(engine.redeem_code(m) for m in messages))
+
+    started = time.perf_counter()
+    asyncio.run(run_async())
+    check("asyncio engine", "STRESSASYN", time.perf_counter() - started)
+
+    # the redeem records alone must bring the counters back after a restart
+    reloaded = journal.load()
+    assert reloaded["STRESSTHRD"]["used_count"] == reloaded["STRESSASYN"]["used_count"] == args.uses
+    print(f"reloaded from {journal.journal_path}: used_count {args.uses} for both codes")
+
+
+def legacy_categories_markup():
+    """The categories keyboard as start_cmd/add_cmd built it before the render cache."""
+    markup = telebot.types.InlineKeyboardMarkup()
+    for cat in rr.categories:
+        markup.add(telebot.types.InlineKeyboardButton(cat, callback_data=f"cat_{cat}"))
+    return markup
+
+
+def bench_start(args):
+    no_rate_limits()
+    calls = []
+    fake_bot_api(0, calls)
+    n = args.messages
+    messages = [make_message(20_000_000 + i % 1000, "/start") for i in range(n)]
+    rr.users.update(m.from_user.id for m in messages)
+    expected = rr.categories_markup()
+
+    def run(label, reference=None):
+        calls.clear()
+        started = time.perf_counter()
+        for m in messages:
+            rr.start_cmd(m)
+        elapsed = time.perf_counter() - started
+        assert len(calls) == n and calls[-1][1]["reply_markup"] == expected
+        note = f"  ({reference / elapsed:.1f}x)" if reference else ""
+        print(f"{label} {elapsed / n * 1e6:7.1f} us/message{note}")
+        return elapsed
+
+    def per_call(fn, reps):
+        started = time.perf_counter()
+        for _ in range(reps):
+            fn()
+        return (time.perf_counter() - started) / reps * 1e6
+
+    print(f"{n:,} /start messages from returning users, {len(rr.categories)} categories, Bot API answered instantly:")
+    cached = rr.categories_markup
+    rr.categories_markup = legacy_categories_markup
+    try:
+        legacy_s = run("start_cmd, markup rebuilt per call:")
+    finally:
+        rr.categories_markup = cached
+    run("start_cmd, render cache:          ", legacy_s)
+
+    reps = 20_000
+    legacy_us = per_call(lambda: legacy_categories_markup().to_json(), reps)
+    cached_us = per_call(rr.categories_markup, reps)
+    print(f"categories keyboard: {legacy_us:6.2f} us built + serialized, {cached_us:5.2f} us cached ({legacy_us / cached_us:.0f}x)")
+    legacy_us = per_call(lambda: rr.build_privacy_keyboard("file", "AbCdEf1234").to_json(), reps)
+    cached_us = per_call(lambda: rr.privacy_keyboard("file", "AbCdEf1234"), reps)
+    print(f"privacy keyboard:    {legacy_us:6.2f} us built + serialized, {cached_us:5.2f} us template ({legacy_us / cached_us:.0f}x)")
+
+    rr.categories.append("Bench")
+    rr.save_categories()
+    assert '"cat_Bench"' in rr.categories_markup(), "/addcat must invalidate the cached keyboard"
+    rr.categories.remove("Bench")
+    rr.save_categories()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="bench", required=True)
+    p = sub.add_parser("router", help="text message routing: router vs legacy predicate chain")
+    p.add_argument("--messages", type=int, default=200_000)
+    p.set_defaults(func=bench_router)
+    p = sub.add_parser("memory", help="bytes per files_db record: JSON-shaped dicts vs FileRecord")
+    p.add_argument("--records", type=int, default=1_000_000)
+    p.set_defaults(func=bench_memory)
+    p = sub.add_parser("codes", help="unique code allocation: legacy generator vs CodeAllocator")
+    p.add_argument("--codes", type=int, default=100_000)
+    p.set_defaults(func=bench_codes)
+    p = sub.add_parser("engines", help="concurrent /start deep-link retrievals: thread engine vs asyncio engine")
+    p.add_argument("--updates", type=int, default=2000)
+    p.add_argument("--latency", type=float, default=0.05, help="seconds per fake Bot API call")
+    p.add_argument("--threads", type=int, default=8, help="thread engine workers (the DISPATCH_WORKERS default)")
+    p.set_defaults(func=bench_engines)
+    p = sub.add_parser("redeem-stress", help="concurrent redeems of one multi-use code must never oversell")
+    p.add_argument("--redeems", type=int, default=10_000)
+    p.add_argument("--uses", type=int, default=100)
+    p.add_argument("--threads", type=int, default=64)
+    p.set_defaults(func=bench_redeem_stress)
+    p = sub.add_parser("start", help="/start handling cost: per-call keyboards vs the render cache")
+    p.add_argument("--messages", type=int, default=50_000)
+    p.set_defaults(func=bench_start)
+    args = ap.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,521 @@
+"""End-to-end load test: rr.py against a local fake Bot API server.
+
+Usage:
+    python loadtest.py [--users 100] [--duration 30] [--mix start=2,upload=1,deeplink=4,redeem=2]
+                       [--latency 0.03] [--jitter 0.02] [--rate-429 0] [--error-rate 0]
+                       [--broadcast 0] [--engine thread|asyncio] [--mode polling|webhook]
+                       [--max-p95 MS] [--max-error-rate FRACTION]
+    python loadtest.py --serve-only [--port 8081]    # just the fake server, for a bot started by hand
+
+The fake server answers the Bot API methods the bot uses (getUpdates, sendMessage, copyMessage,
+copyMessages, getChatMember, editMessageText, getFile, sendPhoto, sendDocument, ...) after
+--latency (+ up to --jitter) seconds, and answers a --rate-429 share of calls with a 429 and a
+--error-rate share with a 500. The bot is started as a subprocess with TELEGRAM_API_URL pointing
+at it and DATA_DIR at a fresh directory seeded with public files, multi-use redeem codes and
+--broadcast extra users.
+
+Each of --users virtual users repeatedly picks an action from --mix, sends the update (queued
+for getUpdates, or POSTed to the webhook) and waits for the bot's final reply to that user:
+
+    start     /start                    -> the welcome message
+    upload    a document                -> "File stored."
+    deeplink  /start <seeded file code> -> the share link after the copied file
+    redeem    a seeded code             -> the redeemed account
+
+With --broadcast N an admin sends /broadcast once the users are done and the time until the
+bot reports it finished (N + users recipients) is measured.
+
+Prints per-action throughput and latency percentiles plus the fake server's call counts. With
+--max-p95 / --max-error-rate the exit status is 1 when a threshold is exceeded, so this can
+gate performance changes.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+TOKEN = "123456:loadtest"
+ADMIN_ID = 900_000_001
+USER_BASE = 1_000_000_000
+BROADCAST_BASE = 2_000_000_000
+STORE_MSG_BASE = 10_000
+WEBHOOK_PORT = 18443
+WEBHOOK_SECRET = "loadtest-secret"
+
+ACTIONS = ("start", "upload", "deeplink", "redeem")
+DONE_TEXT = {
+    "start": "Welcome!",
+    "upload": "File stored.",
+    "deeplink": "Share link:",
+    "redeem": "Success!",
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100.0 * len(sorted_values)))]
+
+
+# ==============================
+#      FAKE BOT API SERVER
+# ==============================
+class Inbox:
+    """Messages the bot sent, per chat, for the virtual users to wait on."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chats = {}  # chat_id -> [Condition, [(monotonic, text), ...]]
+
+    def _chat(self, chat_id):
+        with self.lock:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self.chats[chat_id] = [threading.Condition(), []]
+            return chat
+
+    def deliver(self, chat_id, text):
+        cond, messages = self._chat(chat_id)
+        with cond:
+            messages.append((time.monotonic(), text))
+            cond.notify_all()
+
+    def wait_for(self, chat_id, needle, since, timeout):
+        """Wait for a message containing `needle` sent at or after `since`; returns its time or None."""
+        cond, messages = self._chat(chat_id)
+        deadline = time.monotonic() + timeout
+        with cond:
+            while True:
+                for i, (t, text) in enumerate(messages):
+                    if t >= since and needle in text:
+                        del messages[:i + 1]
+                        return t
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                cond.wait(remaining)
+
+
+class FakeBotApi:
+    def __init__(self, latency, jitter, rate_429, error_rate, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.error_rate = error_rate
+        self.rnd = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.update_ids = itertools.count(1)
+        self.updates = []
+        self.updates_cond = threading.Condition()
+        self.inbox = Inbox()
+        self.lock = threading.Lock()
+        self.calls = {}     # method -> count
+        self.injected = {}  # "429" / "500" -> count
+        self.polled = threading.Event()
+
+    # --- updates for getUpdates ---
+    def push_update(self, update):
+        with self.updates_cond:
+            update["update_id"] = next(self.update_ids)
+            self.updates.append(update)
+            self.updates_cond.notify_all()
+
+    def get_updates(self, params):
+        self.polled.set()
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + min(float(params.get("timeout") or 0), 5)
+        with self.updates_cond:
+            while True:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+                if self.updates or time.monotonic() >= deadline:
+                    return self.updates[:limit]
+                self.updates_cond.wait(max(0.0, deadline - time.monotonic()))
+
+    # --- calls ---
+    def message(self, chat_id, text=None):
+        msg = {"message_id": next(self.ids), "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"}}
+        if text is not None:
+            msg["text"] = text
+        return msg
+
+    def handle(self, method, params):
+        """Returns (http_status, json_body)."""
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self.get_updates(params)}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 42, "is_bot": True, "first_name": "Load", "username": "LoadTestBot"}}
+
+        delay = self.latency + (self.rnd.random() * self.jitter if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        roll = self.rnd.random()
+        if roll < self.rate_429:
+            with self.lock:
+                self.injected["429"] = self.injected.get("429", 0) + 1
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                         "parameters": {"retry_after": 1}}
+        if roll < self.rate_429 + self.error_rate:
+            with self.lock:
+                self.injected["500"] = self.injected.get("500", 0) + 1
+            return 500, {"ok": False, "error_code": 500, "description": "Internal Server Error"}
+
+        chat_id = params.get("chat_id")
+        chat_id = int(chat_id) if chat_id and chat_id.lstrip("-").isdigit() else 0
+        if method in ("sendMessage", "editMessageText"):
+            text = params.get("text", "")
+            self.inbox.deliver(chat_id, text)
+            return 200, {"ok": True, "result": self.message(chat_id, text)}
+        if method in ("copyMessage", "sendPhoto", "sendDocument"):
+            self.inbox.deliver(chat_id, f"<{method}>")
+            result = {"message_id": next(self.ids)} if method == "copyMessage" else self.message(chat_id)
+            return 200, {"ok": True, "result": result}
+        if method == "copyMessages":
+            ids = json.loads(params.get("message_ids") or "[]")
+            self.inbox.deliver(chat_id, "<copyMessages>")
+            return 200, {"ok": True, "result": [{"message_id": next(self.ids)} for _ in ids]}
+        if method == "getChatMember":
+            user_id = int(params.get("user_id") or 0)
+            return 200, {"ok": True, "result": {"status": "member",
+                                                "user": {"id": user_id, "is_bot": False, "first_name": "U"}}}
+        if method == "getFile":
+            return 200, {"ok": True, "result": {"file_id": params.get("file_id", ""), "file_unique_id": "u",
+                                                "file_size": 1024, "file_path": "documents/file.bin"}}
+        return 200, {"ok": True, "result": True}
+
+
+def parse_multipart(body, content_type):
+    """Form fields of a multipart body (file parts are skipped)."""
+    boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+    fields = {}
+    for part in body.split(b"--" + boundary):
+        head, sep, value = part.partition(b"\r\n\r\n")
+        if not sep or b"filename=" in head:
+            continue
+        for line in head.decode("utf-8", "replace").split("\r\n"):
+            if line.lower().startswith("content-disposition") and 'name="' in line:
+                name = line.split('name="', 1)[1].split('"', 1)[0]
+                fields[name] = value[:-2].decode("utf-8", "replace") if value.endswith(b"\r\n") else value.decode()
+    return fields
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    api = None  # set by start_fake_server()
+
+    def do_GET(self):
+        self.handle_call()
+
+    def do_POST(self):
+        self.handle_call()
+
+    def handle_call(self):
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        if parts[0] == "file":
+            return self.reply(200, b"\0" * 1024, "application/octet-stream")
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return self.reply(404, b"{}")
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        ctype = self.headers.get("Content-Type", "")
+        if body and ctype.startswith("multipart/form-data"):
+            params.update(parse_multipart(body, ctype))
+        elif body:
+            params.update(parse_qsl(body.decode("utf-8")))
+        status, result = self.api.handle(parts[1], params)
+        self.reply(status, json.dumps(result).encode())
+
+    def reply(self, status, body, ctype="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def start_fake_server(api, port):
+    FakeBotApiHandler.api = api
+    server = FakeServer(("127.0.0.1", port), FakeBotApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ==============================
+#      BOT UNDER TEST
+# ==============================
+def seed_data_dir(path, files, codes, broadcast_users):
+    now = int(time.time())
+    file_codes = [f"LTF{i:07d}" for i in range(files)]
+    redeem_codes = [f"LTR{i:07d}" for i in range(codes)]
+    with open(os.path.join(path, "files_db.json"), "w") as f:
+        json.dump({code: {"owner": ADMIN_ID, "store_msg_id": STORE_MSG_BASE + i, "type": "document", "caption": "",
+                          "created_at": now, "access": {"mode": "public", "limit": None, "viewed_by": []}}
+                   for i, code in enumerate(file_codes)}, f)
+    with open(os.path.join(path, "codes.json"), "w") as f:
+        json.dump({code: {"category": "Netflix", "account": "load@test", "max_uses": 10 ** 9, "used_count": 0,
+                          "expires_at": None, "created_by": ADMIN_ID} for code in redeem_codes}, f)
+    with open(os.path.join(path, "admins.txt"), "w") as f:
+        f.write(f"{ADMIN_ID}\n")
+    with open(os.path.join(path, "users.txt"), "w") as f:
+        f.writelines(f"{BROADCAST_BASE + i}\n" for i in range(broadcast_users))
+    return file_codes, redeem_codes
+
+
+def start_bot(args, data_dir, api_url):
+    env = dict(os.environ, BOT_TOKEN=TOKEN, DATA_DIR=data_dir + os.sep, TELEGRAM_API_URL=api_url,
+               BOT_ENGINE=args.engine, BOT_MODE=args.mode, WEBHOOK_PORT=str(WEBHOOK_PORT),
+               WEBHOOK_LISTEN="127.0.0.1", WEBHOOK_URL="", WEBHOOK_SECRET=WEBHOOK_SECRET, PYTHONUNBUFFERED="1")
+    if not args.rate_limits:
+        env["API_GLOBAL_RATE"] = "1000000"
+    log = open(os.path.join(data_dir, "bot.log"), "w")
+    proc = subprocess.Popen([sys.executable, args.bot], env=env, stdout=log, stderr=subprocess.STDOUT)
+    return proc, log
+
+
+def wait_until_ready(args, api, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            return False
+        if args.mode == "webhook":
+            try:
+                socket.create_connection(("127.0.0.1", WEBHOOK_PORT), timeout=1).close()
+                return True
+            except OSError:
+                pass
+        elif api.polled.wait(0.2):
+            return True
+        time.sleep(0.2)
+    return False
+
+
+# ==============================
+#        LOAD GENERATOR
+# ==============================
+def user_obj(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"Load{uid % 100000}", "username": f"load{uid}"}
+
+
+def text_message(uid, text):
+    msg = {"message_id": random.randrange(1, 2 ** 31), "date": int(time.time()),
+           "chat": {"id": uid, "type": "private"}, "from": user_obj(uid), "text": text}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": msg}
+
+
+def document_message(uid):
+    return {"message": {"message_id": random.randrange(1, 2 ** 31), "date": int(time.time()),
+                        "chat": {"id": uid, "type": "private"}, "from": user_obj(uid),
+                        "document": {"file_id": f"doc{uid}", "file_unique_id": f"u{uid}",
+                                     "file_name": "load.bin", "mime_type": "application/octet-stream"}}}
+
+
+class Sender:
+    """Delivers updates to the bot: queued for getUpdates, or POSTed to its webhook."""
+    def __init__(self, args, api):
+        self.api = api
+        self.webhook = args.mode == "webhook"
+
+    def send(self, update):
+        if not self.webhook:
+            self.api.push_update(update)
+            return True
+        update["update_id"] = next(self.api.update_ids)
+        req = urllib.request.Request(f"http://127.0.0.1:{WEBHOOK_PORT}/webhook", data=json.dumps(update).encode(),
+                                     headers={"Content-Type": "application/json",
+                                              "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET})
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                return resp.status == 200
+        except OSError:
+            return False
+
+
+def parse_mix(text):
+    weights = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in ACTIONS:
+            raise SystemExit(f"unknown action {name!r}; choose from {', '.join(ACTIONS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def run_users(args, api, sender, file_codes, redeem_codes):
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    results = {name: [] for name in ACTIONS}  # name -> [latency or None (timeout)]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + args.duration
+
+    def make_update(action, uid, rnd):
+        if action == "start":
+            return text_message(uid, "/start")
+        if action == "upload":
+            return document_message(uid)
+        if action == "deeplink":
+            return text_message(uid, f"/start {rnd.choice(file_codes)}")
+        return text_message(uid, rnd.choice(redeem_codes))
+
+    def user(i):
+        rnd = random.Random(i)
+        uid = USER_BASE + i
+        while time.monotonic() < stop_at:
+            action = rnd.choices(names, weights)[0]
+            started = time.monotonic()
+            if sender.send(make_update(action, uid, rnd)):
+                done = api.inbox.wait_for(uid, DONE_TEXT[action], started, args.timeout)
+            else:
+                done = None
+            with lock:
+                results[action].append(None if done is None else done - started)
+            if args.think:
+                time.sleep(rnd.random() * 2 * args.think)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(i,)) for i in range(args.users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - started
+
+
+def run_broadcast(args, api, sender):
+    started = time.monotonic()
+    sender.send(text_message(ADMIN_ID, "/broadcast loadtest broadcast"))
+    done = api.inbox.wait_for(ADMIN_ID, "Broadcast finished", started, args.broadcast_timeout)
+    return None if done is None else done - started
+
+
+def report(args, results, wall, broadcast_s, api):
+    total = sum(len(v) for v in results.values())
+    failed = sum(v.count(None) for v in results.values())
+    print(f"{args.users} users for {wall:.1f}s ({args.engine} engine, {args.mode}), Bot API latency "
+          f"{args.latency * 1000:.0f}+{args.jitter * 1000:.0f} ms, 429s {args.rate_429:.1%}, errors {args.error_rate:.1%}")
+    print(f"{'action':<10} {'done':>7} {'timeout':>8} {'per s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    worst_p95 = 0.0
+    for name in ACTIONS:
+        values = results[name]
+        if not values:
+            continue
+        ok = sorted(v for v in values if v is not None)
+        p50, p95, p99 = (percentile(ok, p) * 1000 for p in (50, 95, 99))
+        worst_p95 = max(worst_p95, p95)
+        print(f"{name:<10} {len(ok):>7} {len(values) - len(ok):>8} {len(ok) / wall:>8.1f} "
+              f"{p50:>8.1f} {p95:>8.1f} {p99:>8.1f} {(ok[-1] * 1000 if ok else 0):>8.1f}")
+    print(f"{'total':<10} {total - failed:>7} {failed:>8} {(total - failed) / wall:>8.1f}")
+    if args.broadcast:
+        recipients = args.broadcast + args.users
+        if broadcast_s is None:
+            print(f"broadcast to {recipients} users: did not finish within {args.broadcast_timeout}s")
+        else:
+            print(f"broadcast to {recipients} users: {broadcast_s:.1f}s ({recipients / broadcast_s:.1f} msg/s)")
+    print("Bot API calls:", ", ".join(f"{k}: {v}" for k, v in sorted(api.calls.items())))
+    if api.injected:
+        print("Injected:", ", ".join(f"{k}: {v}" for k, v in sorted(api.injected.items())))
+
+    error_rate = failed / total if total else 1.0
+    failures = []
+    if args.max_p95 is not None and worst_p95 > args.max_p95:
+        failures.append(f"p95 {worst_p95:.1f} ms > {args.max_p95:.1f} ms")
+    if args.max_error_rate is not None and error_rate > args.max_error_rate:
+        failures.append(f"timeouts {error_rate:.2%} > {args.max_error_rate:.2%}")
+    if args.broadcast and broadcast_s is None:
+        failures.append("broadcast did not finish")
+    if failures:
+        print("FAIL:", "; ".join(failures))
+        return 1
+    return 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=100, help="concurrent virtual users")
+    ap.add_argument("--duration", type=float, default=30, help="seconds the users keep sending")
+    ap.add_argument("--mix", default="start=2,upload=1,deeplink=4,redeem=2", help="action weights")
+    ap.add_argument("--think", type=float, default=0.0, help="mean seconds a user waits between actions")
+    ap.add_argument("--timeout", type=float, default=30, help="seconds to wait for the bot's reply")
+    ap.add_argument("--latency", type=float, default=0.03, help="seconds per Bot API call")
+    ap.add_argument("--jitter", type=float, default=0.02, help="up to this many extra seconds per call")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="share of calls answered with a 429")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with a 500")
+    ap.add_argument("--broadcast", type=int, default=0, help="extra seeded users; broadcast to everyone at the end")
+    ap.add_argument("--broadcast-timeout", type=float, default=600)
+    ap.add_argument("--files", type=int, default=1000, help="seeded public files for deep links")
+    ap.add_argument("--codes", type=int, default=100, help="seeded multi-use redeem codes")
+    ap.add_argument("--engine", choices=("thread", "asyncio"), default="thread")
+    ap.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    ap.add_argument("--rate-limits", action="store_true",
+                    help="keep the bot's 30 msg/s global limit (off by default: it would be all we measure)")
+    ap.add_argument("--bot", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "rr.py"))
+    ap.add_argument("--port", type=int, default=0, help="fake Bot API port (0 = any free port)")
+    ap.add_argument("--serve-only", action="store_true", help="run only the fake Bot API server")
+    ap.add_argument("--keep", action="store_true", help="keep the data directory (bot.log is in it)")
+    ap.add_argument("--max-p95", type=float, default=None, help="fail if any action's p95 exceeds this (ms)")
+    ap.add_argument("--max-error-rate", type=float, default=None, help="fail if more actions than this time out")
+    args = ap.parse_args()
+
+    api = FakeBotApi(args.latency, args.jitter, args.rate_429, args.error_rate)
+    server = start_fake_server(api, args.port)
+    api_url = f"http://127.0.0.1:{server.server_address[1]}"
+    if args.serve_only:
+        print(f"Fake Bot API on {api_url} (set TELEGRAM_API_URL={api_url}); Ctrl+C to stop")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            return 0
+
+    data_dir = tempfile.mkdtemp(prefix="rr-loadtest-")
+    file_codes, redeem_codes = seed_data_dir(data_dir, args.files, args.codes, args.broadcast)
+    proc, log = start_bot(args, data_dir, api_url)
+    try:
+        if not wait_until_ready(args, api, proc):
+            print(f"Bot did not come up; see {os.path.join(data_dir, 'bot.log')}")
+            args.keep = True
+            return 1
+        sender = Sender(args, api)
+        results, wall = run_users(args, api, sender, file_codes, redeem_codes)
+        broadcast_s = run_broadcast(args, api, sender) if args.broadcast else None
+        return report(args, results, wall, broadcast_s, api)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+        server.shutdown()
+        if args.keep:
+            print(f"Data directory kept: {data_dir}")
+        else:
+            import shutil
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,34 @@
 import telebot
-import random
+import secrets
 import string
 import time
 import json
 import os
 import re
 import html
+import io
+import csv
+import itertools
+import requests
+import threading
+import sqlite3
+import array
+import enum
+import sys
+import bisect
+import heapq
+import queue
+import signal
+import asyncio
+import hmac
+import functools
+import gzip
+import zlib
+import hashlib
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 # ==============================
 #      CONFIGURATION
@@ -19,31 +42,663 @@ MAIN_ADMINS = [7251749429, 7529094605]
 
 # Where to log general data events (can be @username or -100id)
 DATA_CHANNEL = "@userdatachnl"
+EVENT_FLUSH_INTERVAL = 5        # seconds between DATA_CHANNEL flushes
+EVENT_FLUSH_BATCH = 50          # ...or flush as soon as this many events are queued
+EVENT_QUEUE_SIZE = 10000        # queued events before overflow goes to the spill file
+TELEGRAM_MESSAGE_LIMIT = 4096
 
 # Force-join gate (kept for redeem flow)
 FORCE_JOIN_CHANNEL_ID = -1002805274329
 FORCE_JOIN_CHANNEL_LINK = "https://t.me/+pI7fWKuTecxhZDU1"
+MEMBERSHIP_TTL_JOINED = 600       # seconds a "member" answer is trusted
+MEMBERSHIP_TTL_NOT_JOINED = 30    # seconds a "not a member" answer is trusted (they may be joining now)
+MEMBERSHIP_STALE_GRACE = 300      # on API errors, keep serving the last answer this much longer
+MEMBERSHIP_CACHE_SIZE = 100000    # LRU bound on cached users
+REDEEM_LOCK_STRIPES = 256         # redeem locks; a code always maps to the same one
 
 # === Channels ===
 PROOF_CHANNEL_ID = -1003186829689      # must be a chat where the bot is admin
+PROOF_MAX_BYTES = 20 * 1024 * 1024     # re-upload fallback: refuse bigger downloads (getFile's own cap)
+PROOF_DOWNLOAD_TIMEOUT = 30            # seconds for the whole download
+PROOF_CONCURRENCY = 4                  # proofs going through the send/fallback chain at once
+IMPORT_MAX_BYTES = 20 * 1024 * 1024    # accounts file (.txt/.csv) uploaded during /add; getFile's own cap
+IMPORT_MAX_LINES = 200000              # accounts per file
+CODES_INLINE_MAX = 50                  # more new codes than this are sent back as a CSV document
 STORE_CHANNEL_ID = -1002893816996      # REQUIRED (storage channel where uploads go)
+COPY_BATCH_LIMIT = 100                 # max message ids per copyMessages call
+CALLBACK_DATA_LIMIT = 64               # bytes of callback_data Telegram accepts per button
 
 # --- Data Files (for persistence) ---
-DATA_DIR = "/data/"
+DATA_DIR = os.environ.get("DATA_DIR", "/data/")
 USERS_FILE = os.path.join(DATA_DIR, "users.txt")
 BANNED_USERS_FILE = os.path.join(DATA_DIR, "banned_users.txt")
 ADMINS_FILE = os.path.join(DATA_DIR, "admins.txt")
+USERS_REGISTRY_FILE = os.path.join(DATA_DIR, "users.bin")          # append-only id registries (see UserRegistry);
+BANNED_REGISTRY_FILE = os.path.join(DATA_DIR, "banned_users.bin")  # the .txt files above are only read once
+ADMINS_REGISTRY_FILE = os.path.join(DATA_DIR, "admins.bin")        # to migrate
 CODES_FILE = os.path.join(DATA_DIR, "codes.json")
 CATEGORIES_FILE = os.path.join(DATA_DIR, "categories.txt")
 FILES_DB_FILE = os.path.join(DATA_DIR, "files_db.json")
 BUNDLES_DB_FILE = os.path.join(DATA_DIR, "bundles_db.json")
+EVENT_SPILL_FILE = os.path.join(DATA_DIR, "data_channel_spill.jsonl")  # undelivered DATA_CHANNEL events
+
+# --- Storage backend: "json" (snapshot + journal files) or "sqlite" (one WAL-mode database) ---
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json").lower()
+SQLITE_DB_FILE = os.path.join(DATA_DIR, "bot.sqlite3")
+ROW_CACHE_SIZE = 50000            # sqlite: codes/files rows kept in memory; the rest are read on demand
+ROW_SCAN_CHUNK = 1000             # rows per query when a whole table is scanned
+
+# --- Append-only journals (one small record per mutation, folded into the JSON snapshot on compaction) ---
+CODES_JOURNAL_FILE = os.path.join(DATA_DIR, "codes.journal")
+FILES_DB_JOURNAL_FILE = os.path.join(DATA_DIR, "files_db.journal")
+BUNDLES_DB_JOURNAL_FILE = os.path.join(DATA_DIR, "bundles_db.journal")
+JOURNAL_COMPACT_EVERY = 5000      # compact after this many journal records
+JOURNAL_COMPACT_INTERVAL = 600    # seconds between periodic compactions
+REGISTRY_COMPACT_MIN = 100000     # appended ids before a registry is compacted (also needs > live ids)
+SAVE_COALESCE_DELAY = 1.0         # seconds the background saver waits after a change so bursts become one write
+
+# --- Dead code archive: expired / used-up codes move out of codes_db into a gzip file ---
+CODES_ARCHIVE_FILE = os.path.join(DATA_DIR, "codes_archive.jsonl.gz")
+CODES_ARCHIVE_INDEX_FILE = os.path.join(DATA_DIR, "codes_archive.idx.json")
+CODES_ARCHIVE_BLOOM_FILE = os.path.join(DATA_DIR, "codes_archive.bloom")
+CODES_ARCHIVE_INTERVAL = 600      # seconds between archival passes
+CODES_ARCHIVE_GRACE = 3600        # dead codes stay in codes_db this much longer
+CODES_ARCHIVE_BATCH = 10000       # codes per gzip member (a lookup decompresses one member)
+ARCHIVE_BLOOM_BITS_PER_CODE = 10  # with 7 hashes: ~1% false positives
+ARCHIVE_BLOOM_HASHES = 7
+ARCHIVE_BLOOM_MIN_CAPACITY = 100000
+ARCHIVE_MERGE_MEMBERS = 64        # members short of CODES_ARCHIVE_BATCH before the archive is rewritten into full ones
+
+# --- Broadcast engine ---
+BROADCAST_STATE_FILE = os.path.join(DATA_DIR, "broadcast_state.json")  # resumable checkpoint
+DEAD_USERS_FILE = os.path.join(DATA_DIR, "dead_users.txt")             # users that blocked the bot (legacy)
+DEAD_USERS_REGISTRY_FILE = os.path.join(DATA_DIR, "dead_users.bin")
+BROADCAST_WORKERS = 8          # concurrent senders
+BROADCAST_RATE = 28            # messages per second (Telegram's global limit is ~30/s)
+BROADCAST_CHUNK = 200          # users per checkpoint
+BROADCAST_PROGRESS_EVERY = 5   # seconds between progress edits
+
+# --- Wizard/session state lifetimes (seconds since the last step) ---
+SESSION_TTL_REDEEM = 1800
+SESSION_TTL_PRIVACY = 600
+SESSION_TTL_PROOF = 600
+SESSION_TTL_BUNDLE = 6 * 3600
+RESTORE_BUNDLE_SESSIONS = os.environ.get("RESTORE_BUNDLE_SESSIONS", "0") == "1"
+BUNDLE_SESSIONS_FILE = os.path.join(DATA_DIR, "bundle_sessions.json")
+
+# --- Telegram API client (rate limits, retries) ---
+PRIORITY_USER, PRIORITY_LOG, PRIORITY_BULK = 0, 1, 2
+API_GLOBAL_RATE = float(os.environ.get("API_GLOBAL_RATE", "30"))  # messages per second across all chats
+API_CHAT_RATE = 1              # messages per second per chat...
+API_CHAT_BURST = 10            # ...allowing short bursts (a reply or bundle is often several messages)
+API_CHAT_BUCKETS_MAX = 100000  # LRU bound on per-chat buckets
+# Per-chat rate for STORE_CHANNEL_ID, PROOF_CHANNEL_ID and DATA_CHANNEL: every upload goes to the store
+# channel, so API_CHAT_RATE there would cap the whole bot. The default leaves only the global limit and
+# 429 backoff in effect.
+API_CHANNEL_RATE = float(os.environ.get("API_CHANNEL_RATE", "1000"))
+API_PRIORITY_RESERVE = {PRIORITY_USER: 0, PRIORITY_LOG: 5, PRIORITY_BULK: 10}  # global tokens left for higher classes
+API_MAX_RETRIES = 3            # retries per call on 429 / 5xx
+API_RETRY_BUDGET = 30          # max seconds one call may spend waiting on retries
+API_RATE_LIMITED_METHODS = {"send_message", "copy_message", "copy_messages", "forward_message", "send_photo",
+                            "send_document", "edit_message_text", "edit_message_reply_markup"}
+
+# --- Bot API server: "" = api.telegram.org, else e.g. a local telegram-bot-api server or loadtest.py's fake ---
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "").rstrip("/")
+
+# --- Update dispatch ---
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS", "8"))  # 0 = telebot's default thread pool
+DISPATCH_QUEUE_SIZE = 1000     # pending updates per worker before polling blocks
+DISPATCH_SPARE_WORKERS = 32    # extra threads serving a worker's queue while its handler waits on a rate limit
+
+# --- Engine: "thread" (TeleBot + worker threads) or "asyncio" (AsyncTeleBot; needs aiohttp) ---
+BOT_ENGINE = os.environ.get("BOT_ENGINE", "thread").lower()
+ASYNC_SYNC_WORKERS = 16        # threads running the sync handlers for updates the async engine delegates
+ASYNC_MAX_INFLIGHT = 2000      # updates being handled at once by the async engine (webhook mode)
+ASYNC_STORE_CONCURRENCY = 64   # concurrent copies out of STORE_CHANNEL_ID
+ASYNC_PERSIST_CONCURRENCY = 4  # concurrent persistence calls handed to threads
+ASYNC_HTTP_CONNECTIONS = 100   # aiohttp connection pool to the Bot API (one session for all calls)
+
+# --- Run mode: "polling" (getUpdates) or "webhook" (built-in HTTP server) ---
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")  # behind a TLS reverse proxy; 0.0.0.0 to expose
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")        # public base URL; if set, setWebhook is called at startup
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")  # required X-Telegram-Bot-Api-Secret-Token; generated
+                                                        # at startup if empty and WEBHOOK_URL is set
+WEBHOOK_QUEUE_SIZE = 10000     # updates accepted but not yet handled; beyond this we answer 503
+WEBHOOK_WORKERS = 4            # threads draining the webhook queue
+
+# --- Metrics endpoint (Prometheus text format); 0 = off. Same numbers as /perf. ---
+PERF_LISTEN = os.environ.get("PERF_LISTEN", "127.0.0.1")
+PERF_PORT = int(os.environ.get("PERF_PORT", "0"))
 
 # ==============================
 #      INITIALIZE BOT
 # ==============================
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="Markdown")
+def update_user_id(update):
+    for kind in ("message", "callback_query", "edited_message", "inline_query", "chosen_inline_result",
+                 "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+                 "chat_join_request"):
+        obj = getattr(update, kind, None)
+        user = getattr(obj, "from_user", None) or getattr(obj, "user", None)
+        if user is not None:
+            return user.id
+    return update.update_id
+
+class OrderedDispatchBot(telebot.TeleBot):
+    """TeleBot whose handlers run on a pool of worker threads.
+
+    Each worker owns a queue and every update of a given user is routed to the same worker,
+    so one user's updates are handled strictly in arrival order (the pending_* wizards rely
+    on that) while different users are handled in parallel.
+
+    A handler about to wait on a rate limit calls hand_off(): a spare thread takes over the
+    worker's queue so other users aren't held up, and the waiting thread finishes that user's
+    updates, parked meanwhile, before it exits (at most DISPATCH_SPARE_WORKERS at a time).
+    """
+    def __init__(self, *args, workers=DISPATCH_WORKERS, queue_size=DISPATCH_QUEUE_SIZE, **kwargs):
+        kwargs["threaded"] = False  # handlers run inline on our workers
+        super().__init__(*args, **kwargs)
+        self.dispatch_queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.running = [{} for _ in range(workers)]  # per queue: {user key: deque of parked updates}
+        self.dispatch_lock = threading.Lock()
+        self.spare = threading.Semaphore(DISPATCH_SPARE_WORKERS)
+        self.worker = threading.local()
+        for i in range(workers):
+            threading.Thread(target=self._dispatch_worker, args=(i,), daemon=True).start()
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # advance the polling offset now; handling happens later on the worker
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            key = update_user_id(update)
+            self.dispatch_queues[hash(key) % len(self.dispatch_queues)].put(update)
+
+    def _dispatch_worker(self, i):
+        q, running = self.dispatch_queues[i], self.running[i]
+        self.worker.index, self.worker.handed_off = i, False
+        while True:
+            update = q.get()
+            key = update_user_id(update)
+            with self.dispatch_lock:
+                if key in running:
+                    # this user's handler is waiting on a thread that handed off the queue
+                    running[key].append(update)
+                    continue
+                running[key] = deque()
+            while update is not None:
+                try:
+                    super().process_new_updates([update])
+                except Exception as e:
+                    print(f"Handler failed for update {update.update_id}:", e)
+                finally:
+                    q.task_done()
+                with self.dispatch_lock:
+                    if running[key]:
+                        update = running[key].popleft()
+                    else:
+                        del running[key]
+                        update = None
+            if self.worker.handed_off:
+                self.spare.release()
+                return
+
+    def hand_off(self):
+        """Called before a blocking wait inside a handler; no-op off the dispatch workers."""
+        i = getattr(self.worker, "index", None)
+        if i is None or self.worker.handed_off or not self.spare.acquire(blocking=False):
+            return
+        self.worker.handed_off = True
+        threading.Thread(target=self._dispatch_worker, args=(i,), daemon=True).start()
+
+    def drain(self):
+        """Block until every queued update has been handled."""
+        for q in self.dispatch_queues:
+            q.join()
+
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    telebot.apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+
+if DISPATCH_WORKERS > 0:
+    bot = OrderedDispatchBot(BOT_TOKEN, parse_mode="Markdown")
+else:
+    bot = telebot.TeleBot(BOT_TOKEN, parse_mode="Markdown")
 BOT_USERNAME = None  # filled in at startup (for share links)
 
+# ==============================
+#           METRICS
+# ==============================
+class Histogram:
+    """Rolling window over the last `size` observations (fixed memory)."""
+    def __init__(self, size=2048):
+        self.window = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.window.append(value)
+            self.count += 1
+            self.total += value
+
+    def percentiles(self, *ps):
+        with self.lock:
+            data = sorted(self.window)
+        if not data:
+            return [0.0 for _ in ps]
+        return [data[min(len(data) - 1, int(p / 100.0 * len(data)))] for p in ps]
+
+metrics = {}  # name -> Histogram
+gauges = {}   # name -> zero-arg callable returning the current value
+
+def histogram(name):
+    h = metrics.get(name)
+    if h is None:
+        h = metrics.setdefault(name, Histogram())
+    return h
+
+def timed(fn):
+    """Record each call's duration (exceptions included) in handler_<name>_seconds.
+
+    Coroutines go to handler_async_<name>_seconds: the asyncio engine hands some updates on to
+    the sync handler of the same name, which must not count them a second time."""
+    if asyncio.iscoroutinefunction(fn):
+        hist = histogram(f"handler_async_{fn.__name__}_seconds")
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                hist.observe(time.monotonic() - started)
+        return async_wrapper
+    hist = histogram(f"handler_{fn.__name__}_seconds")
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            hist.observe(time.monotonic() - started)
+    return wrapper
+
+if hasattr(bot, "dispatch_queues"):
+    gauges["dispatch_queue_depth"] = lambda: sum(q.qsize() for q in bot.dispatch_queues)
+
+def perf_report():
+    lines = []
+    for name in sorted(metrics):
+        h = metrics[name]
+        if not h.count:
+            continue
+        p50, p95, p99 = (v * 1000 for v in h.percentiles(50, 95, 99))
+        lines.append(f"{name}: n={h.count} p50={p50:.1f} p95={p95:.1f} p99={p99:.1f} ms")
+    for name in sorted(gauges):
+        try:
+            lines.append(f"{name}: {gauges[name]():g}")
+        except Exception as e:
+            lines.append(f"{name}: error {e}")
+    return lines
+
+def prometheus_text():
+    out = []
+    for name in sorted(metrics):
+        h = metrics[name]
+        metric = "rr_" + re.sub(r"[^A-Za-z0-9_]", "_", name)
+        out.append(f"# TYPE {metric} summary")
+        for q, v in zip(("0.5", "0.95", "0.99"), h.percentiles(50, 95, 99)):
+            out.append(f'{metric}{{quantile="{q}"}} {v:.6f}')
+        out.append(f"{metric}_sum {h.total:.6f}")
+        out.append(f"{metric}_count {h.count}")
+    for name in sorted(gauges):
+        metric = "rr_" + re.sub(r"[^A-Za-z0-9_]", "_", name)
+        try:
+            value = float(gauges[name]())
+        except Exception:
+            continue
+        out.append(f"# TYPE {metric} gauge")
+        out.append(f"{metric} {value:g}")
+    return "\n".join(out) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    server = ThreadingHTTPServer((PERF_LISTEN, PERF_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"📈 Metrics on http://{PERF_LISTEN}:{PERF_PORT}/metrics")
+
+# ==============================
+#     TELEGRAM API CLIENT
+# ==============================
+class TokenBucket:
+    """Blocking token bucket: `rate` tokens per second, holding at most `burst`."""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, n=1, reserve=0):
+        """Take n tokens if `reserve` more would still be left for others; else return seconds to wait."""
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= n + reserve:
+                self.tokens -= n
+                return 0
+            return (n + reserve - self.tokens) / self.rate
+
+    def acquire(self, n=1, reserve=0):
+        while True:
+            wait = self.take(n, reserve)
+            if not wait:
+                return
+            time.sleep(min(wait, 1.0))
+
+    async def acquire_async(self, n=1, reserve=0):
+        while True:
+            wait = self.take(n, reserve)
+            if not wait:
+                return
+            await asyncio.sleep(min(wait, 1.0))
+
+    def pause(self, seconds):
+        """Drain the bucket so nobody sends for `seconds` (used after a 429)."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+# Both telebot.apihelper's and telebot.asyncio_helper's ApiTelegramException carry error_code,
+# description and result_json, so errors are recognised by those rather than by class.
+def retry_after_of(e):
+    """Seconds Telegram asked us to wait, or None if `e` is not a 429."""
+    if getattr(e, "error_code", None) == 429:
+        try:
+            return int(e.result_json["parameters"]["retry_after"])
+        except (KeyError, TypeError, ValueError):
+            return 1
+    return None
+
+def is_dead_chat_error(e):
+    if getattr(e, "error_code", None) is None:
+        return False
+    desc = (e.description or "").lower()
+    return e.error_code == 403 or "chat not found" in desc or "user is deactivated" in desc
+
+class TelegramApi:
+    """Every Bot API call from the handlers goes through here (`api.send_message(...)` etc.).
+
+    - message-producing methods pass a per-chat token bucket (API_CHAT_RATE/s, API_CHANNEL_RATE/s
+      for the bot's own channels) and the global one (API_GLOBAL_RATE/s); lower priority classes only take a global token while
+      API_PRIORITY_RESERVE tokens would remain, so user replies overtake logs and broadcasts;
+    - a 429 pauses the chat's bucket for retry_after and the call is retried, as are 5xx
+      errors, within API_MAX_RETRIES attempts and API_RETRY_BUDGET seconds of waiting;
+    - before any such wait on a dispatch worker, the worker's queue is handed to a spare thread
+      (OrderedDispatchBot.hand_off), so one busy chat doesn't hold up the users sharing it;
+    - each call's latency lands in the api_<method>_seconds histogram.
+    Pass priority=PRIORITY_LOG / PRIORITY_BULK as a keyword, and throttle=<TokenBucket> for a
+    caller's own limit (taken before every attempt, paused by a 429 as well); everything else
+    goes to telebot.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.global_bucket = TokenBucket(API_GLOBAL_RATE)
+        self.chat_buckets = OrderedDict()
+        self.channel_ids = {STORE_CHANNEL_ID, PROOF_CHANNEL_ID, DATA_CHANNEL}
+        self.lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if chat_id in self.channel_ids:
+                    bucket = TokenBucket(API_CHANNEL_RATE)
+                else:
+                    bucket = TokenBucket(API_CHAT_RATE, API_CHAT_BURST)
+                self.chat_buckets[chat_id] = bucket
+                while len(self.chat_buckets) > API_CHAT_BUCKETS_MAX:
+                    self.chat_buckets.popitem(last=False)
+            else:
+                self.chat_buckets.move_to_end(chat_id)
+            return bucket
+
+    def chat_bucket_for(self, method, args, kwargs):
+        if method not in API_RATE_LIMITED_METHODS:
+            return None
+        pos = 1 if method == "edit_message_text" else 0
+        return self._chat_bucket(kwargs.get("chat_id", args[pos] if len(args) > pos else None))
+
+    @staticmethod
+    def retry_wait(e, attempt, waited):
+        """Seconds to wait before retrying after API error `e`, or None to give up."""
+        wait = retry_after_of(e)
+        if wait is None and e.error_code >= 500:
+            wait = 2 ** attempt
+        if wait is None or attempt == API_MAX_RETRIES or waited + wait > API_RETRY_BUDGET:
+            return None
+        histogram("api_retry_wait_seconds").observe(wait)
+        return wait
+
+    def call(self, method, *args, priority=PRIORITY_USER, throttle=None, **kwargs):
+        fn = getattr(self.bot, method)
+        chat_bucket = self.chat_bucket_for(method, args, kwargs)
+        hist = histogram(f"api_{method}_seconds")
+        waited = 0.0
+        for attempt in range(API_MAX_RETRIES + 1):
+            if throttle is not None and throttle.take():
+                self.hand_off()
+                throttle.acquire()
+            if chat_bucket is not None:
+                if chat_bucket.take():
+                    # don't hold up the other users of this dispatch worker while the chat cools down
+                    self.hand_off()
+                    chat_bucket.acquire()
+                self.global_bucket.acquire(reserve=API_PRIORITY_RESERVE[priority])
+            started = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+                hist.observe(time.monotonic() - started)
+                return result
+            except telebot.apihelper.ApiTelegramException as e:
+                hist.observe(time.monotonic() - started)
+                wait = self.retry_wait(e, attempt, waited)
+                if wait is None:
+                    raise
+                waited += wait
+                if e.error_code == 429 and throttle is not None:
+                    throttle.pause(wait)
+                if e.error_code == 429 and chat_bucket is not None:
+                    chat_bucket.pause(wait)
+                else:
+                    self.hand_off()
+                    time.sleep(wait)
+
+    def hand_off(self):
+        hand_off = getattr(self.bot, "hand_off", None)
+        if hand_off is not None:
+            hand_off()
+
+    def __getattr__(self, method):
+        return lambda *args, **kwargs: self.call(method, *args, **kwargs)
+
+api = TelegramApi(bot)
+
+class AsyncTelegramApi:
+    """Awaitable counterpart of TelegramApi for the asyncio engine (`await aapi.send_message(...)`).
+
+    Shares the sync client's token buckets and retry policy, so both engines together stay
+    within the same per-chat and global limits.
+    """
+    def __init__(self, abot, sync_api):
+        self.bot = abot
+        self.sync_api = sync_api
+
+    async def call(self, method, *args, priority=PRIORITY_USER, throttle=None, **kwargs):
+        fn = getattr(self.bot, method)
+        chat_bucket = self.sync_api.chat_bucket_for(method, args, kwargs)
+        hist = histogram(f"api_{method}_seconds")
+        waited = 0.0
+        for attempt in range(API_MAX_RETRIES + 1):
+            if throttle is not None:
+                await throttle.acquire_async()
+            if chat_bucket is not None:
+                await chat_bucket.acquire_async()
+                await self.sync_api.global_bucket.acquire_async(reserve=API_PRIORITY_RESERVE[priority])
+            started = time.monotonic()
+            try:
+                result = await fn(*args, **kwargs)
+                hist.observe(time.monotonic() - started)
+                return result
+            except Exception as e:
+                hist.observe(time.monotonic() - started)
+                if getattr(e, "error_code", None) is None:
+                    raise
+                wait = self.sync_api.retry_wait(e, attempt, waited)
+                if wait is None:
+                    raise
+                waited += wait
+                if e.error_code == 429 and throttle is not None:
+                    throttle.pause(wait)
+                if e.error_code == 429 and chat_bucket is not None:
+                    chat_bucket.pause(wait)
+                else:
+                    await asyncio.sleep(wait)
+
+    def __getattr__(self, method):
+        return lambda *args, **kwargs: self.call(method, *args, **kwargs)
+
+# ==============================
+#        SESSION STATE
+# ==============================
+class ExpiringDict(dict):
+    """dict whose keys expire `ttl` seconds after they were last set or touch()ed.
+
+    Expiry is driven by session_sweeper, so idle wizards are dropped even if the
+    user never comes back. Mutating a stored value in place does not extend it; call touch().
+    """
+    def __init__(self, name, ttl):
+        super().__init__()
+        self.name = name
+        self.ttl = ttl
+        self.deadlines = {}
+        self.lock = threading.RLock()
+        gauges[f"sessions_{name}"] = self.__len__
+        session_sweeper.dicts.append(self)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super().__setitem__(key, value)
+            self.touch(key)
+
+    def touch(self, key, ttl=None):
+        with self.lock:
+            if key not in self:
+                return
+            deadline = time.monotonic() + (self.ttl if ttl is None else ttl)
+            self.deadlines[key] = deadline
+        session_sweeper.schedule(deadline, self, key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            super().__delitem__(key)
+            self.deadlines.pop(key, None)
+
+    def pop(self, key, *default):
+        with self.lock:
+            self.deadlines.pop(key, None)
+            return super().pop(key, *default)
+
+    def expire(self, key, deadline):
+        """Drop `key` if `deadline` is still its current deadline (called by the sweeper)."""
+        with self.lock:
+            if self.deadlines.get(key) == deadline and deadline <= time.monotonic():
+                del self[key]
+                return True
+        return False
+
+class SessionSweeper:
+    """One min-heap of (deadline, seq, dict, key) for every ExpiringDict.
+
+    Touching a key pushes a new heap entry and leaves the old one behind; stale entries are
+    recognised (deadline no longer current) and skipped when they come due, so a sweep
+    costs O(expired * log n).
+    """
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+        self.dicts = []
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, deadline, d, key):
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.heap, (deadline, self.seq, d, key))
+            if self.heap[0][1] == self.seq:
+                self.cond.notify()
+
+    def sweep(self):
+        expired = 0
+        while True:
+            with self.cond:
+                if not self.heap or self.heap[0][0] > time.monotonic():
+                    return expired
+                deadline, _, d, key = heapq.heappop(self.heap)
+            if d.expire(key, deadline):
+                expired += 1
+
+    def rebuild_if_bloated(self):
+        """Drop stale entries once they outnumber live ones (keys touched many times)."""
+        live = sum(len(d.deadlines) for d in self.dicts)
+        if len(self.heap) <= 2 * live + 1024:
+            return
+        with self.cond:
+            entries = []
+            for d in self.dicts:
+                with d.lock:
+                    entries.extend((deadline, d, key) for key, deadline in d.deadlines.items())
+            self.heap = [(deadline, i, d, key) for i, (deadline, d, key) in enumerate(entries)]
+            self.seq = len(self.heap)
+            heapq.heapify(self.heap)
+
+    def run(self):
+        while True:
+            self.sweep()
+            self.rebuild_if_bloated()
+            with self.cond:
+                timeout = (self.heap[0][0] - time.monotonic()) if self.heap else 60
+                self.cond.wait(max(0.05, min(timeout, 60)))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+session_sweeper = SessionSweeper()
+
 # ==============================
 #   PERSISTENT DATA STORAGE
 # ==============================
@@ -52,82 +707,1267 @@ BOT_USERNAME = None  # filled in at startup (for share links)
 #   "max_uses": int, "used_count": int,
 #   "expires_at": int|None, "created_by": int
 # }}
-codes_db = {}
+class CodeEntry(dict):
+    """A codes_db entry under the SQLite backend (a dict that RowCache can hold a weak reference to)."""
+    __slots__ = ("__weakref__",)
+
+def upgrade_code_entry(v):
+    """Fill in fields missing from old-schema codes (used -> max_uses == 1 etc.)."""
+    if isinstance(v, dict):
+        v.setdefault("max_uses", 1 if v.get("used") is not None else 1)
+        v.setdefault("used_count", 1 if v.get("used") else 0)
+        v.pop("used", None)
+        v.setdefault("expires_at", None)
+        v.setdefault("created_by", 0)
+    return v
+
+class RowCache:
+    """codes_db / files_db under the SQLite backend: a dict-like view of one table.
+
+    Only the keys and the ROW_CACHE_SIZE most recently used rows stay in memory; other rows are
+    read from the store on demand (get / [] / items). A row evicted from the LRU is kept in a
+    WeakValueDictionary while anything still holds it, so a key always maps to one object: an
+    entry changed in place and then put() is never replaced by an older copy read from disk.
+    Rows assigned with []= are pinned until store.put() has written them (saved()). put() only
+    writes rows found in memory (peek); a row that is not there is unchanged.
+    """
+    def __init__(self, table, wrap=None):
+        self.table = table
+        self.wrap = wrap          # applied to values assigned with []= (CodeEntry for codes)
+        self.keys_ = set()
+        self.rows = OrderedDict()
+        self.evicted = weakref.WeakValueDictionary()
+        self.pinned = {}          # assigned, not yet written
+        self.lock = threading.Lock()
+
+    def load_keys(self):
+        keys = store.load_keys(self.table)
+        with self.lock:
+            self.keys_ = keys
+            self.rows.clear()
+            self.evicted.clear()
+            self.pinned.clear()
+
+    def saved(self, keys):
+        with self.lock:
+            for key in keys:
+                self.pinned.pop(key, None)
+
+    def _remember(self, key, entry):
+        self.evicted.pop(key, None)
+        self.rows[key] = entry
+        self.rows.move_to_end(key)
+        while len(self.rows) > ROW_CACHE_SIZE:
+            old_key, old = self.rows.popitem(last=False)
+            self.evicted[old_key] = old
+
+    def peek(self, key):
+        """The in-memory row for key, or None; never reads the store."""
+        with self.lock:
+            entry = self.pinned.get(key)
+            if entry is None:
+                entry = self.rows.get(key)
+            return entry if entry is not None else self.evicted.get(key)
+
+    def get(self, key, default=None):
+        if key not in self.keys_:
+            return default
+        with self.lock:
+            entry = self.rows.get(key)
+            if entry is not None:
+                self.rows.move_to_end(key)
+                return entry
+            entry = self.pinned.get(key)
+            if entry is None:
+                entry = self.evicted.get(key)
+            if entry is not None:
+                self._remember(key, entry)
+                return entry
+        loaded = store.load_row(self.table, key)
+        with self.lock:
+            if key not in self.keys_:
+                return default
+            # another thread may have loaded or replaced it meanwhile; the first object wins
+            entry = self.rows.get(key)
+            if entry is None:
+                entry = self.pinned.get(key)
+            if entry is None:
+                entry = self.evicted.get(key)
+            if entry is None:
+                if loaded is None:
+                    return default
+                entry = loaded
+            self._remember(key, entry)
+            return entry
+
+    def __getitem__(self, key):
+        entry = self.get(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+
+    def __setitem__(self, key, value):
+        if self.wrap is not None and not isinstance(value, self.wrap):
+            value = self.wrap(value)
+        with self.lock:
+            self.keys_.add(key)
+            self.pinned[key] = value
+            self._remember(key, value)
+
+    def pop(self, key, *default):
+        entry = self.get(key)
+        with self.lock:
+            if key not in self.keys_:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            self.keys_.discard(key)
+            self.pinned.pop(key, None)
+            self.rows.pop(key, None)
+            self.evicted.pop(key, None)
+        return entry
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        return key in self.keys_
+
+    def __len__(self):
+        return len(self.keys_)
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def keys(self):
+        return self.keys_
+
+    def update(self, other):
+        for k, v in other.items():
+            self[k] = v
+
+    def items(self):
+        """Every row, read from the store in ROW_SCAN_CHUNK batches without filling the cache."""
+        after = ""
+        while True:
+            chunk = store.load_rows(self.table, after, ROW_SCAN_CHUNK)
+            for key, loaded in chunk:
+                if key in self.keys_:
+                    entry = self.peek(key)
+                    yield key, entry if entry is not None else loaded
+            if len(chunk) < ROW_SCAN_CHUNK:
+                return
+            after = chunk[-1][0]
+
+    def values(self):
+        return (entry for _, entry in self.items())
+
+codes_db = RowCache("codes", CodeEntry) if STORAGE_BACKEND == "sqlite" else {}
+# Guards the dicts/sets below against concurrent handlers: take it around any
+# read-modify-write of an entry and around serialization. Lock order: db_lock -> store locks.
+db_lock = threading.RLock()
 users = set()
 banned_users = set()
 admins = set(MAIN_ADMINS)
 categories = ["Movies", "Tools", "Premium", "Netflix", "Amazon Prime", "Crunchyroll", "Redeem Code"]
 
 # Proof screenshot state
-pending_proof = {}   # { user_id: {"code": code, "category": category, "expires": timestamp} }
+pending_proof = ExpiringDict("pending_proof", SESSION_TTL_PROOF)   # { user_id: {"code": code, "category": category, "expires": timestamp} }
 
 # File/Bundles
+# In memory each entry is a FileRecord / BundleRecord (__slots__, content type interned as a small
+# int, access mode as an AccessMode, viewed_by None until the first Unlisted viewer). On disk the
+# JSON format is unchanged (to_json / from_json):
 # files_db: {
 #   code: {
 #     "owner": int, "store_msg_id": int, "type": str, "caption": str, "created_at": int,
 #     "access": {"mode": "public"|"unlisted"|"private", "limit": int|None, "viewed_by": [int,int,...]}
 #   }
 # }
-files_db = {}
 # bundles_db: {
 #   code: {
 #     "owner": int, "items": [file_code,...], "created_at": int,
 #     "access": {"mode": "public"|"unlisted"|"private", "limit": int|None, "viewed_by": [int,int,...]}
 #   }
 # }
+class AccessMode(enum.IntEnum):
+    PUBLIC = 0
+    UNLISTED = 1
+    PRIVATE = 2
+
+    @property
+    def label(self):
+        return self.name.lower()
+
+    @classmethod
+    def parse(cls, name):
+        return cls[str(name or "public").upper()]
+
+CONTENT_TYPES = ["document", "photo", "video", "audio", "sticker", "voice", "animation"]
+CONTENT_TYPE_IDS = {t: i for i, t in enumerate(CONTENT_TYPES)}
+content_types_lock = threading.Lock()
+
+def content_type_id(name):
+    type_id = CONTENT_TYPE_IDS.get(name)
+    if type_id is None:
+        with content_types_lock:
+            type_id = CONTENT_TYPE_IDS.get(name)
+            if type_id is None:
+                CONTENT_TYPES.append(name)
+                type_id = CONTENT_TYPE_IDS[name] = len(CONTENT_TYPES) - 1
+    return type_id
+
+class AccessRecord:
+    # viewer_set: set(viewed_by) for Unlisted membership checks, built on first use by
+    # claim_view() and dropped with the record (or whenever viewed_by is replaced).
+    __slots__ = ("owner", "created_at", "mode", "limit", "viewed_by", "viewer_set", "__weakref__")
+
+    def set_access(self, mode, limit=None):
+        """Change privacy; any change starts a fresh viewer list."""
+        self.mode = mode
+        self.limit = limit
+        self.viewed_by = None
+        self.viewer_set = None
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_json()!r})"
+
+    def access_json(self):
+        return {"mode": self.mode.label, "limit": self.limit, "viewed_by": list(self.viewed_by or ())}
+
+    def _load_access(self, d):
+        acc = d.get("access") or {}
+        self.mode = AccessMode.parse(acc.get("mode"))
+        self.limit = acc.get("limit")
+        self.viewed_by = acc.get("viewed_by") or None
+        self.viewer_set = None
+
+class FileRecord(AccessRecord):
+    __slots__ = ("store_msg_id", "type_id", "caption")
+
+    def __init__(self, owner, store_msg_id, type, caption="", created_at=0):
+        self.owner = owner
+        self.store_msg_id = store_msg_id
+        self.type_id = content_type_id(type)
+        self.caption = caption or ""
+        self.created_at = created_at
+        self.set_access(AccessMode.PUBLIC)
+
+    @property
+    def type(self):
+        return CONTENT_TYPES[self.type_id]
+
+    def to_json(self):
+        return {"owner": self.owner, "store_msg_id": self.store_msg_id, "type": self.type, "caption": self.caption,
+                "created_at": self.created_at, "access": self.access_json()}
+
+    @classmethod
+    def from_json(cls, d):
+        rec = cls(d.get("owner"), d.get("store_msg_id"), d.get("type"), d.get("caption"), d.get("created_at") or 0)
+        rec._load_access(d)
+        return rec
+
+class BundleRecord(AccessRecord):
+    __slots__ = ("items",)
+
+    def __init__(self, owner, items, created_at=0):
+        self.owner = owner
+        self.items = tuple(items)
+        self.created_at = created_at
+        self.set_access(AccessMode.PUBLIC)
+
+    def to_json(self):
+        return {"owner": self.owner, "items": list(self.items), "created_at": self.created_at,
+                "access": self.access_json()}
+
+    @classmethod
+    def from_json(cls, d):
+        rec = cls(d.get("owner"), d.get("items") or (), d.get("created_at") or 0)
+        rec._load_access(d)
+        return rec
+
+files_db = RowCache("files") if STORAGE_BACKEND == "sqlite" else {}
 bundles_db = {}
+# users the bot can no longer message (blocked/deactivated); skipped by broadcasts
+dead_users = set()
 # in-memory bundle sessions: { user_id: [file_code,...] }
-bundle_sessions = {}
+bundle_sessions = ExpiringDict("bundle_sessions", SESSION_TTL_BUNDLE)
+# owner_index: { owner_id: [(created_at, "f"|"b", code), ...] } kept sorted (oldest first); rebuilt in load_data
+owner_index = {}
+MYFILES_PAGE_SIZE = 10
 
 # Pending flows
 pending_add = {}  # kept for legacy; now open to all users
 # Redeem creation wizard:
 # pending_redeem[user_id] = {"stage": "choose_cat"|"have_cat"|"await_code"|"await_time"|"await_limit",
 #                            "category": str|None, "accounts": [str...] }
-pending_redeem = {}
+pending_redeem = ExpiringDict("pending_redeem", SESSION_TTL_REDEEM)
 # Unlisted count entry for privacy change
 # pending_privacy[user_id] = {"kind": "file"|"bundle", "code": str}
-pending_privacy = {}
+pending_privacy = ExpiringDict("pending_privacy", SESSION_TTL_PRIVACY)
+
+# ==============================
+#   BACKGROUND SAVER
+# ==============================
+def write_atomic(path, text):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb" if isinstance(text, bytes) else "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def copy_entry(entry):
+    """Copy a dict entry (codes) deep enough that in-place edits don't reach the copy."""
+    out = dict(entry)
+    for k, v in out.items():
+        if isinstance(v, dict):
+            out[k] = {kk: list(vv) if isinstance(vv, list) else vv for kk, vv in v.items()}
+        elif isinstance(v, list):
+            out[k] = list(v)
+    return out
+
+class Saver:
+    """Writes whole-file state from one background thread so handlers never serialize.
+
+    Handlers call mark_dirty(name). The saver waits SAVE_COALESCE_DELAY after the first mark so
+    a burst becomes one write, then for each dirty target takes snapshot() under db_lock (a copy,
+    much cheaper than serializing) and passes it to write() outside the lock.
+    Metrics: save_seconds and save_lag_seconds (first mark -> durable) histograms,
+    save_last_seconds and save_dirty_age_seconds gauges.
+    """
+    def __init__(self):
+        self.targets = {}   # name -> (snapshot, write)
+        self.dirty = {}     # name -> monotonic time of the oldest unsaved change
+        self.cond = threading.Condition()
+        self.save_lock = threading.Lock()
+        self.last_duration = 0.0
+        self.thread = None
+        gauges["save_last_seconds"] = lambda: self.last_duration
+        gauges["save_dirty_age_seconds"] = self.dirty_age
+
+    def register(self, name, snapshot, write):
+        self.targets[name] = (snapshot, write)
+
+    def mark_dirty(self, name):
+        with self.cond:
+            if name not in self.dirty:
+                self.dirty[name] = time.monotonic()
+                self.cond.notify()
+
+    def dirty_age(self):
+        with self.cond:
+            oldest = min(self.dirty.values(), default=None)
+        return 0.0 if oldest is None else time.monotonic() - oldest
+
+    def save(self, name, since):
+        snapshot, write = self.targets[name]
+        with self.save_lock:
+            started = time.monotonic()
+            try:
+                with db_lock:
+                    data = snapshot()
+                write(data)
+            except Exception as e:
+                print(f"Saving '{name}' failed:", e)
+                with self.cond:
+                    self.dirty.setdefault(name, since)
+                return
+            done = time.monotonic()
+        self.last_duration = done - started
+        histogram("save_seconds").observe(self.last_duration)
+        histogram("save_lag_seconds").observe(done - since)
+
+    def flush(self):
+        """Save every dirty target now (the saver thread, and shutdown)."""
+        with self.cond:
+            batch, self.dirty = self.dirty, {}
+        for name, since in batch.items():
+            self.save(name, since)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.dirty:
+                    self.cond.wait()
+            time.sleep(SAVE_COALESCE_DELAY)
+            self.flush()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+saver = Saver()
+
+# ==============================
+#   APPEND-ONLY JOURNAL
+# ==============================
+# Each mutation appends one line {"k": key, "v": entry} (v=null means deleted) to the
+# journal; a new Unlisted viewer appends just {"k": key, "view": user_id} and a redeem just
+# {"k": code, "used": used_count, "by": user_id} (replayed as a max, so replaying it twice is harmless). Compaction is done by the
+# saver: snapshot() copies the dict and moves the journal aside to <journal>.old in one step, then
+# write_snapshot() writes the copy as the new snapshot and deletes the .old file.
+# load() reads the snapshot and replays <journal>.old (if a compaction was interrupted) and the journal on top of it.
+# With a `record` class (FileRecord / BundleRecord) entries are converted from/to JSON on the way in and out.
+class Journal:
+    def __init__(self, name, db, snapshot_path, journal_path, indent=None, record=None):
+        self.name = name
+        self.db = db
+        self.record = record
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.old_path = journal_path + ".old"
+        self.indent = indent
+        self.pending = 0       # records appended since the last compaction
+        self.replayed = 0      # records replayed by the last load()
+        self.lock = threading.Lock()
+        self._fh = None
+
+    def load(self):
+        data = {}
+        snapshot_found = False
+        try:
+            with open(self.snapshot_path, "r") as f:
+                loaded = json.load(f)
+                if isinstance(loaded, dict):
+                    data = loaded
+            snapshot_found = True
+            if self.record is not None:
+                for k, v in data.items():
+                    data[k] = self.record.from_json(v)
+        except FileNotFoundError:
+            pass
+        self.replayed = 0
+        journal_found = False
+        viewed = set()
+        for path in (self.old_path, self.journal_path):
+            try:
+                with open(path, "r") as f:
+                    journal_found = True
+                    for line in f:
+                        try:
+                            rec = json.loads(line)
+                        except json.JSONDecodeError:
+                            # torn tail from a crash mid-append; everything before it is intact
+                            continue
+                        if "view" in rec:
+                            entry = data.get(rec["k"])
+                            if entry is not None:
+                                if entry.viewed_by is None:
+                                    entry.viewed_by = []
+                                entry.viewed_by.append(rec["view"])
+                                viewed.add(rec["k"])
+                        elif "used" in rec:
+                            entry = data.get(rec["k"])
+                            if entry is not None:
+                                entry["used_count"] = max(int(entry.get("used_count", 0)), rec["used"])
+                        elif rec.get("v") is None:
+                            data.pop(rec.get("k"), None)
+                        else:
+                            data[rec["k"]] = rec["v"] if self.record is None else self.record.from_json(rec["v"])
+                        self.replayed += 1
+            except FileNotFoundError:
+                pass
+        if not snapshot_found and not journal_found:
+            raise FileNotFoundError(self.snapshot_path)
+        # a .old journal replayed over a snapshot that already has its viewers would add them twice
+        for k in viewed:
+            entry = data.get(k)
+            if entry is not None and entry.viewed_by:
+                entry.viewed_by = list(dict.fromkeys(entry.viewed_by))
+        return data
+
+    def encode(self, entry):
+        if entry is None or self.record is None:
+            return entry
+        return entry.to_json()
+
+    def append(self, *keys):
+        # written before db_lock is released: two updates of one key must reach the file in the
+        # order they were encoded, or replay (last wins) would restore the older value
+        with db_lock:
+            lines = "".join(
+                json.dumps({"k": k, "v": self.encode(self.db.get(k))}, separators=(",", ":")) + "\n" for k in keys
+            )
+            self._write(lines, len(keys))
+
+    def append_view(self, key, viewer_id):
+        """Record one new Unlisted viewer without re-serializing the entry."""
+        self._write(json.dumps({"k": key, "view": viewer_id}, separators=(",", ":")) + "\n", 1)
+
+    def append_redeem(self, code, used_count, user_id):
+        self._write(json.dumps({"k": code, "used": used_count, "by": user_id}, separators=(",", ":")) + "\n", 1)
+
+    def _write(self, lines, count):
+        with self.lock:
+            if self._fh is None:
+                self._fh = open(self.journal_path, "a")
+            self._fh.write(lines)
+            self._fh.flush()
+            self.pending += count
+            due = self.pending >= JOURNAL_COMPACT_EVERY
+        if due:
+            saver.mark_dirty(self.name)
+
+    def snapshot(self):
+        # copy and rotate with appends held off, so the copy covers exactly the rotated-out records.
+        # Entries are only copied by reference here and serialized by write_snapshot() outside the
+        # lock; an entry changed in place meanwhile is also in the new journal, and replay fixes it
+        # (redeem counts replay as a max, so a snapshot that saw the newer count is harmless).
+        with db_lock, self.lock:
+            data = dict(self.db)
+            if self._fh is not None:
+                self._fh.close()
+            try:
+                if os.path.exists(self.old_path):
+                    # an earlier compaction never finished; keep its records too
+                    with open(self.journal_path, "r") as src, open(self.old_path, "a") as dst:
+                        dst.write(src.read())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, self.old_path)
+            except FileNotFoundError:
+                pass
+            self._fh = open(self.journal_path, "w")
+            self.pending = 0
+            self.replayed = 0
+        return data
+
+    def write_snapshot(self, data):
+        if self.record is not None:
+            data = {k: v.to_json() for k, v in data.items()}
+        else:
+            # dict() of a plain dict is one step under the GIL, so json.dumps never walks a live entry
+            data = {k: dict(v) for k, v in data.items()}
+        write_atomic(self.snapshot_path, json.dumps(data, indent=self.indent))
+        try:
+            os.remove(self.old_path)
+        except FileNotFoundError:
+            pass
+
+    def compact(self):
+        self.write_snapshot(self.snapshot())
+
+codes_journal = Journal("codes", codes_db, CODES_FILE, CODES_JOURNAL_FILE, indent=4)
+files_journal = Journal("files", files_db, FILES_DB_FILE, FILES_DB_JOURNAL_FILE, indent=2, record=FileRecord)
+bundles_journal = Journal("bundles", bundles_db, BUNDLES_DB_FILE, BUNDLES_DB_JOURNAL_FILE, indent=2, record=BundleRecord)
+for journal in (codes_journal, files_journal, bundles_journal):
+    saver.register(journal.name, journal.snapshot, journal.write_snapshot)
+
+class UserRegistry:
+    """A set of user ids kept as an append-only file of little-endian int64s.
+
+    add(uid) appends uid, remove(uid) appends -uid; load() reads the whole file with one
+    array.frombytes() and replays it. Once the appended records outnumber the live ids (and
+    REGISTRY_COMPACT_MIN), the saver rewrites the file as just the live ids.
+    """
+    def __init__(self, name, data, path, legacy_path, exclude=()):
+        self.name = name
+        self.data = data
+        self.exclude = frozenset(exclude)  # ids that live only in memory (MAIN_ADMINS)
+        self.path = path
+        self.legacy_path = legacy_path
+        self.records = 0
+        self.lock = threading.Lock()
+        self._fh = None
+        saver.register(name, lambda: None, lambda _: self.compact())
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            with open(self.legacy_path, "r") as f:
+                ids = {int(line.strip()) for line in f if line.strip()}
+            self.compact(ids)
+            return ids
+        usable = len(raw) - len(raw) % 8
+        if usable != len(raw):
+            # torn tail from a crash mid-append; cut it so later appends stay aligned
+            os.truncate(self.path, usable)
+        ids = array.array("q")
+        ids.frombytes(raw[:usable])
+        if sys.byteorder == "big":
+            ids.byteswap()
+        self.records = len(ids)
+        if not ids or min(ids) > 0:
+            return set(ids)
+        result = set()
+        for uid in ids:
+            if uid > 0:
+                result.add(uid)
+            else:
+                result.discard(-uid)
+        return result
+
+    def _pack(self, ids):
+        packed = array.array("q", ids)
+        if sys.byteorder == "big":
+            packed.byteswap()
+        return packed.tobytes()
+
+    def append(self, uid):
+        with self.lock:
+            if self._fh is None:
+                self._fh = open(self.path, "ab")
+            self._fh.write(self._pack((uid,)))
+            self._fh.flush()
+            self.records += 1
+            due = self.records > max(REGISTRY_COMPACT_MIN, 2 * len(self.data))
+        if due:
+            saver.mark_dirty(self.name)
+
+    def add(self, uid):
+        self.append(int(uid))
+
+    def remove(self, uid):
+        self.append(-int(uid))
+
+    def compact(self, ids=None):
+        # under self.lock appends wait, so none can land in the file being replaced
+        with self.lock:
+            if ids is None:
+                ids = set(self.data)
+            ids = set(ids) - self.exclude
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(self._pack(ids))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            self.records = len(ids)
+
+dead_users_registry = UserRegistry("dead_users", dead_users, DEAD_USERS_REGISTRY_FILE, DEAD_USERS_FILE)
+
+# ==============================
+#   STORAGE BACKENDS
+# ==============================
+# Both backends keep the same interface:
+#   load_table(table) / put(table, *keys) / flush(table)   for "codes", "files", "bundles"
+#   load_set(name) / add_member(name, v) / remove_member(name, v)   for "users", "banned_users", "admins"
+# put() persists only the given keys, reading their current value from the in-memory dict;
+# record_view(table, code, user_id) persists one new Unlisted viewer of a file/bundle;
+# record_redeem(code, used_count, user_id) persists one redeem of a code.
+# owner_rows(table) yields (owner, created_at, code) for the owner index; code_uses() sums used_count.
+# SqliteStore also serves RowCache: load_keys(table), load_row(table, key), load_rows(table, after, limit).
+TABLE_DBS = {"codes": codes_db, "files": files_db, "bundles": bundles_db}
+TABLE_RECORDS = {"files": FileRecord, "bundles": BundleRecord}
+SET_DATA = {"users": users, "banned_users": banned_users, "admins": admins}
+
+class JsonStore:
+    def __init__(self):
+        self.journals = {"codes": codes_journal, "files": files_journal, "bundles": bundles_journal}
+        self.registries = {
+            "users": UserRegistry("users", users, USERS_REGISTRY_FILE, USERS_FILE),
+            "banned_users": UserRegistry("banned_users", banned_users, BANNED_REGISTRY_FILE, BANNED_USERS_FILE),
+            "admins": UserRegistry("admins", admins, ADMINS_REGISTRY_FILE, ADMINS_FILE, exclude=MAIN_ADMINS),
+        }
+
+    def load_table(self, table):
+        return self.journals[table].load()
+
+    def after_load(self):
+        # fold replayed journals into fresh snapshots so the next start is a plain JSON load
+        for journal in self.journals.values():
+            if journal.replayed:
+                journal.compact()
+
+    def put(self, table, *keys):
+        self.journals[table].append(*keys)
+
+    def record_view(self, table, code, viewer_id):
+        self.journals[table].append_view(code, viewer_id)
+
+    def record_redeem(self, code, used_count, user_id):
+        self.journals["codes"].append_redeem(code, used_count, user_id)
+
+    def flush(self, table):
+        self.journals[table].compact()
+
+    def maintenance(self):
+        for journal in self.journals.values():
+            if journal.pending:
+                saver.mark_dirty(journal.name)
+
+    def load_set(self, name):
+        return self.registries[name].load()
+
+    def add_member(self, name, value):
+        self.registries[name].add(value)
+
+    def remove_member(self, name, value):
+        self.registries[name].remove(value)
+
+    def owner_rows(self, table):
+        for code, entry in TABLE_DBS[table].items():
+            yield entry.owner, entry.created_at, code
+
+    def code_uses(self):
+        return sum(v.get("used_count", 0) for v in codes_db.values())
+
+class SqliteStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS codes (
+            code TEXT PRIMARY KEY, owner INTEGER, created_at INTEGER, expires_at INTEGER, data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_codes_owner ON codes(owner);
+        CREATE INDEX IF NOT EXISTS idx_codes_expires_at ON codes(expires_at);
+        CREATE TABLE IF NOT EXISTS files (
+            code TEXT PRIMARY KEY, owner INTEGER, created_at INTEGER, data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_files_owner ON files(owner, created_at);
+        CREATE INDEX IF NOT EXISTS idx_files_created_at ON files(created_at);
+        CREATE TABLE IF NOT EXISTS bundles (
+            code TEXT PRIMARY KEY, owner INTEGER, created_at INTEGER, data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_bundles_owner ON bundles(owner, created_at);
+        CREATE INDEX IF NOT EXISTS idx_bundles_created_at ON bundles(created_at);
+        CREATE TABLE IF NOT EXISTS views (
+            tbl TEXT NOT NULL, code TEXT NOT NULL, user_id INTEGER NOT NULL, PRIMARY KEY (tbl, code, user_id));
+        CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS banned_users (user_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS admins (user_id INTEGER PRIMARY KEY);
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    @staticmethod
+    def _row(table, key, entry):
+        if table != "codes":
+            entry = entry.to_json()
+        owner = entry.get("created_by") if table == "codes" else entry.get("owner")
+        row = (key, owner, entry.get("created_at"))
+        if table == "codes":
+            row += (entry.get("expires_at"),)
+        else:
+            # viewers live in the views table so a new viewer is a one-row insert
+            entry["access"]["viewed_by"] = []
+        return row + (json.dumps(entry, separators=(",", ":")),)
+
+    def _write(self, table, keys, db=None):
+        if db is None:
+            db = TABLE_DBS[table]
+        rows, gone, written = [], [], []
+        for k in keys:
+            # a RowCache row that is not in memory was not changed since it was written
+            entry = db.peek(k) if isinstance(db, RowCache) else db.get(k)
+            if entry is not None:
+                rows.append(self._row(table, k, entry))
+                written.append((k, entry))
+            elif k not in db:
+                gone.append((k,))
+        if rows:
+            marks = ",".join("?" * len(rows[0]))
+            self.conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({marks})", rows)
+        if gone:
+            self.conn.executemany(f"DELETE FROM {table} WHERE code = ?", gone)
+        if table != "codes":
+            self.conn.executemany("DELETE FROM views WHERE tbl = ? AND code = ?",
+                                  [(table, k) for k, _ in written] + [(table, k) for (k,) in gone])
+            viewers = [(table, k, uid) for k, entry in written for uid in (entry.viewed_by or ())]
+            self.conn.executemany("INSERT OR IGNORE INTO views VALUES (?, ?, ?)", viewers)
+
+    @staticmethod
+    def _decode(table, row):
+        if table == "codes":
+            return upgrade_code_entry(CodeEntry(json.loads(row)))
+        return TABLE_RECORDS[table].from_json(json.loads(row))
+
+    @staticmethod
+    def _add_viewers(data, cur):
+        for code, uid in cur:
+            entry = data.get(code)
+            if entry is not None:
+                if entry.viewed_by is None:
+                    entry.viewed_by = []
+                entry.viewed_by.append(uid)
+
+    def load_table(self, table):
+        with self.lock:
+            cur = self.conn.execute(f"SELECT code, data FROM {table}")
+            data = {code: self._decode(table, row) for code, row in cur}
+            if table != "codes":
+                self._add_viewers(data, self.conn.execute(
+                    "SELECT code, user_id FROM views WHERE tbl = ? ORDER BY rowid", (table,)))
+            return data
+
+    def load_keys(self, table):
+        with self.lock:
+            return {code for (code,) in self.conn.execute(f"SELECT code FROM {table}")}
+
+    def load_row(self, table, key):
+        with self.lock:
+            found = self.conn.execute(f"SELECT data FROM {table} WHERE code = ?", (key,)).fetchone()
+            if found is None:
+                return None
+            entry = self._decode(table, found[0])
+            if table != "codes":
+                self._add_viewers({key: entry}, self.conn.execute(
+                    "SELECT code, user_id FROM views WHERE tbl = ? AND code = ? ORDER BY rowid", (table, key)))
+            return entry
+
+    def load_rows(self, table, after, limit):
+        """Up to `limit` (code, entry) pairs with code > after, in code order."""
+        with self.lock:
+            cur = self.conn.execute(f"SELECT code, data FROM {table} WHERE code > ? ORDER BY code LIMIT ?",
+                                    (after, limit))
+            rows = [(code, self._decode(table, row)) for code, row in cur]
+            if rows and table != "codes":
+                data = dict(rows)
+                self._add_viewers(data, self.conn.execute(
+                    "SELECT code, user_id FROM views WHERE tbl = ? AND code > ? AND code <= ? ORDER BY rowid",
+                    (table, after, rows[-1][0])))
+            return rows
+
+    def owner_rows(self, table):
+        with self.lock:
+            return self.conn.execute(f"SELECT owner, created_at, code FROM {table}").fetchall()
+
+    def code_uses(self):
+        with self.lock:
+            (total,) = self.conn.execute(
+                "SELECT coalesce(sum(json_extract(data, '$.used_count')), 0) FROM codes").fetchone()
+            return total
+
+    def after_load(self):
+        pass
+
+    def put(self, table, *keys):
+        with db_lock, self.lock:
+            with self.conn:
+                self._write(table, keys)
+            db = TABLE_DBS[table]
+            if isinstance(db, RowCache):
+                db.saved(keys)
+
+    def record_view(self, table, code, viewer_id):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO views VALUES (?, ?, ?)", (table, code, int(viewer_id)))
+
+    def record_redeem(self, code, used_count, user_id):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE codes SET data = json_set(data, '$.used_count', max(coalesce(json_extract(data, '$.used_count'), 0), ?)) "
+                "WHERE code = ?", (int(used_count), code))
+
+    def flush(self, table):
+        # every put() is already its own committed transaction
+        pass
+
+    def maintenance(self):
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def load_set(self, name):
+        with self.lock:
+            return {uid for (uid,) in self.conn.execute(f"SELECT user_id FROM {name}")}
+
+    def add_member(self, name, value):
+        with self.lock, self.conn:
+            self.conn.execute(f"INSERT OR IGNORE INTO {name} (user_id) VALUES (?)", (int(value),))
+
+    def remove_member(self, name, value):
+        with self.lock, self.conn:
+            self.conn.execute(f"DELETE FROM {name} WHERE user_id = ?", (int(value),))
+
+    def import_all(self, tables):
+        """Replace every table with `tables` ({table: {key: entry}}) and the user sets in one transaction."""
+        with db_lock, self.lock, self.conn:
+            for table, db in tables.items():
+                self.conn.execute(f"DELETE FROM {table}")
+                if table != "codes":
+                    self.conn.execute("DELETE FROM views WHERE tbl = ?", (table,))
+                self._write(table, list(db), db)
+            for name, data in SET_DATA.items():
+                if name == "admins":
+                    data = data - set(MAIN_ADMINS)
+                self.conn.execute(f"DELETE FROM {name}")
+                self.conn.executemany(f"INSERT INTO {name} (user_id) VALUES (?)", [(int(v),) for v in data])
+
+def open_store():
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStore(SQLITE_DB_FILE)
+    return JsonStore()
+
+store = None  # opened by load_data()
+
+# ==============================
+#      DEAD CODE ARCHIVE
+# ==============================
+def dead_reason(info, now):
+    """"expired" / "used" for a code that can no longer be redeemed at `now`, else None."""
+    exp = info.get("expires_at")
+    if exp and now > exp:
+        return "expired"
+    if int(info.get("used_count", 0)) >= int(info.get("max_uses", 1)):
+        return "used"
+    return None
+
+class CodeExpiryIndex:
+    """Min-heap of (due, code): when each code may be archived.
+
+    Codes with expires_at are due CODES_ARCHIVE_GRACE after expiry; the redeem that uses up a
+    code pushes it as due CODES_ARCHIVE_GRACE from then. Popped codes are re-checked with
+    dead_reason(), so stale or duplicate entries are harmless.
+    """
+    def __init__(self):
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def push(self, code, due):
+        with self.lock:
+            heapq.heappush(self.heap, (due, code))
+
+    def rebuild(self):
+        now = time.time()
+        heap = []
+        with db_lock:
+            for code, info in codes_db.items():
+                if dead_reason(info, float("-inf")) == "used":
+                    heap.append((now + CODES_ARCHIVE_GRACE, code))
+                elif info.get("expires_at"):
+                    heap.append((info["expires_at"] + CODES_ARCHIVE_GRACE, code))
+        heapq.heapify(heap)
+        with self.lock:
+            self.heap = heap
+
+    def pop_due(self, now):
+        out = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                out.append(heapq.heappop(self.heap)[1])
+        return out
+
+code_expiry = CodeExpiryIndex()
+
+class BloomFilter:
+    """ARCHIVE_BLOOM_HASHES positions per key, double-hashed from one blake2b digest."""
+    def __init__(self, capacity=0, bits=None):
+        if bits is None:
+            bits = bytearray(self.nbytes(capacity))
+        self.bits = bits
+        self.size = len(bits) * 8
+
+    @staticmethod
+    def nbytes(capacity):
+        return (max(64, capacity * ARCHIVE_BLOOM_BITS_PER_CODE) + 7) // 8
+
+    @staticmethod
+    def hashes(key):
+        d = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        return int.from_bytes(d[:8], "little"), int.from_bytes(d[8:], "little") | 1
+
+    def positions(self, h):
+        h1, h2 = h
+        return [(h1 + i * h2) % self.size for i in range(ARCHIVE_BLOOM_HASHES)]
+
+    def add(self, h):
+        ps = self.positions(h)
+        for p in ps:
+            self.bits[p >> 3] |= 1 << (p & 7)
+        return ps
+
+    def __contains__(self, h):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self.positions(h))
+
+def gzip_members(f, pos=0):
+    """Yield (offset, length, data) for each complete gzip member of f from byte `pos` on.
+    Reads 1 MiB at a time; stops at the end of the file or at a member that doesn't finish."""
+    f.seek(pos)
+    buf = b""
+    while True:
+        if not buf:
+            buf = f.read(1 << 20)
+            if not buf:
+                return
+        d = zlib.decompressobj(wbits=31)
+        parts, length = [], 0
+        while True:
+            try:
+                parts.append(d.decompress(buf))
+            except zlib.error:
+                return
+            if d.eof:
+                length += len(buf) - len(d.unused_data)
+                buf = d.unused_data
+                break
+            length += len(buf)
+            buf = f.read(1 << 20)
+            if not buf:
+                return
+        yield pos, length, b"".join(parts)
+        pos += length
+
+class CodeArchive:
+    """Expired and used-up codes, moved out of codes_db into an append-only gzip file.
+
+    Every archival pass appends gzip members of JSON lines {"k": code, "reason": "expired"|"used",
+    "v": entry}. In memory there is one Bloom filter over all archived codes plus, per member,
+    its offset, length, code count and its own Bloom filter, so a lookup decompresses only the
+    member(s) that may hold the code. Once ARCHIVE_MERGE_MEMBERS members hold fewer than
+    CODES_ARCHIVE_BATCH codes, the archive is rewritten into full members.
+
+    The index is a small JSON header plus a binary file of the filters: the global one, then one
+    per member. save_index() writes only the changed pages of the global filter and the filters
+    of new members. On load, members appended after the saved index are scanned in; a missing or
+    outgrown index is rebuilt by scanning the archive once. Only the archive thread writes.
+    """
+    def __init__(self, path, index_path, bloom_path):
+        self.path = path
+        self.index_path = index_path
+        self.bloom_path = bloom_path
+        self.members = []  # [offset, length, codes, BloomFilter]; only appended to or replaced
+        self.capacity = ARCHIVE_BLOOM_MIN_CAPACITY
+        self.bloom = BloomFilter(self.capacity)
+        self.count = 0     # archived codes
+        self.uses = 0      # their used_count total (for /stats)
+        self.size = 0      # archive bytes covered by members
+        self.dirty = set() # 4 KiB pages of self.bloom changed since the last save_index()
+        self.saved = 0     # members whose filters are in bloom_path
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                idx = json.load(f)
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if idx["size"] <= size and idx["count"] <= idx["capacity"]:
+                with open(self.bloom_path, "rb") as f:
+                    raw = f.read()
+                pos = BloomFilter.nbytes(idx["capacity"])
+                bloom, members = BloomFilter(bits=bytearray(raw[:pos])), []
+                for o, n, c in idx["members"]:
+                    end = pos + BloomFilter.nbytes(c)
+                    members.append([o, n, c, BloomFilter(bits=bytearray(raw[pos:end]))])
+                    pos = end
+                if pos <= len(raw):
+                    with self.lock:
+                        self.members, self.bloom, self.dirty, self.saved = members, bloom, set(), len(members)
+                        self.capacity, self.count, self.uses, self.size = idx["capacity"], idx["count"], idx["uses"], idx["size"]
+                    if self.size < size:
+                        self.catch_up()
+                    return
+        except (FileNotFoundError, KeyError, TypeError, ValueError):
+            pass
+        self.rebuild()
+
+    def catch_up(self):
+        """Scan in the members appended after the saved index (a pass stopped before saving it)."""
+        with open(self.path, "rb") as f:
+            for offset, length, text in gzip_members(f, self.size):
+                recs = [json.loads(line) for line in text.splitlines() if line]
+                self.add_member(offset, length, [r["k"] for r in recs],
+                                sum(int(r["v"].get("used_count", 0)) for r in recs))
+        self.drop_torn_tail()
+        if self.count > self.capacity:
+            self.rebuild()
+        else:
+            self.save_index()
+
+    def drop_torn_tail(self):
+        size = os.path.getsize(self.path)
+        if self.size < size:
+            # torn tail from a crash mid-append; the codes in it are still in codes_db
+            print(f"{self.path}: dropping {size - self.size} byte(s) of an unfinished append")
+            with open(self.path, "r+b") as f:
+                f.truncate(self.size)
+
+    def rebuild(self, merge=False):
+        """Re-scan the archive and rebuild the index. With merge, the archive is also rewritten
+        into members of at least CODES_ARCHIVE_BATCH codes; lookups use the old file until then."""
+        open(self.path, "ab").close()
+        with open(self.path, "rb") as f:
+            total = self.count if merge else sum(text.count(b"\n") for _, _, text in gzip_members(f))
+            capacity = max(ARCHIVE_BLOOM_MIN_CAPACITY, 2 * total)
+            bloom = BloomFilter(capacity)
+            members, count, uses, end = [], 0, 0, 0
+            out = open(self.path + ".tmp", "wb") if merge else None
+            lines, codes = [], []
+
+            def add(offset, length, member_codes):
+                mb = BloomFilter(len(member_codes))
+                for code in member_codes:
+                    h = BloomFilter.hashes(code)
+                    mb.add(h)
+                    bloom.add(h)
+                members.append([offset, length, len(member_codes), mb])
+
+            def write_member():
+                blob = gzip.compress(b"".join(lines))
+                add(out.tell(), len(blob), codes)
+                out.write(blob)
+                lines.clear()
+                codes.clear()
+
+            for offset, length, text in gzip_members(f):
+                member_lines = [line for line in text.splitlines(keepends=True) if line.strip()]
+                recs = [json.loads(line) for line in member_lines]
+                count += len(recs)
+                uses += sum(int(r["v"].get("used_count", 0)) for r in recs)
+                end = offset + length
+                if out is None:
+                    add(offset, length, [r["k"] for r in recs])
+                    continue
+                lines.extend(member_lines)
+                codes.extend(r["k"] for r in recs)
+                if len(codes) >= CODES_ARCHIVE_BATCH:
+                    write_member()
+        if out is not None:
+            if codes:
+                write_member()
+            out.flush()
+            os.fsync(out.fileno())
+            out.close()
+        with self.lock:
+            self.members, self.capacity, self.bloom = members, capacity, bloom
+            self.count, self.uses, self.size = count, uses, end
+            if out is not None:
+                try:
+                    os.remove(self.index_path)  # its offsets are for the old file
+                except FileNotFoundError:
+                    pass
+                if end < os.path.getsize(self.path):
+                    print(f"{self.path}: dropping {os.path.getsize(self.path) - end} byte(s) of an unfinished append")
+                os.replace(self.path + ".tmp", self.path)
+                self.size = sum(n for _, n, _, _ in members)
+        if out is None:
+            self.drop_torn_tail()
+        self.save_index(full=True)
+
+    def save_index(self, full=False):
+        """Write the index: with full, every filter anew; otherwise only the changed pages of the
+        global filter and the filters of members added since the last save."""
+        with self.lock:
+            header = {"size": self.size, "count": self.count, "uses": self.uses, "capacity": self.capacity,
+                      "members": [[o, n, c] for o, n, c, _ in self.members]}
+            start = 0 if full else self.saved
+            pos = BloomFilter.nbytes(self.capacity) + sum(BloomFilter.nbytes(c) for _, _, c, _ in self.members[:start])
+            new = b"".join(mb.bits for _, _, _, mb in self.members[start:])  # member filters never change
+            pages = {p: bytes(self.bloom.bits[p << 12:(p + 1) << 12]) for p in self.dirty}
+            everything = bytes(self.bloom.bits) + b"".join(mb.bits for _, _, _, mb in self.members)
+            self.dirty, self.saved = set(), len(self.members)
+        if not full:
+            try:
+                with open(self.bloom_path, "r+b") as f:
+                    for p in sorted(pages):
+                        f.seek(p << 12)
+                        f.write(pages[p])
+                    f.seek(pos)
+                    f.write(new)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as e:
+                print(f"{self.bloom_path}: {e}; rewriting it")
+                full = True
+        if full:
+            try:
+                os.remove(self.index_path)  # never pair an old header with new filters
+            except FileNotFoundError:
+                pass
+            write_atomic(self.bloom_path, everything)
+        write_atomic(self.index_path, json.dumps(header, separators=(",", ":")))
+
+    def add_member(self, offset, length, codes, uses):
+        mb = BloomFilter(len(codes))
+        with self.lock:
+            for code in codes:
+                h = BloomFilter.hashes(code)
+                mb.add(h)
+                self.dirty.update(p >> 15 for p in self.bloom.add(h))
+            self.members.append([offset, length, len(codes), mb])
+            self.size = offset + length
+            self.count += len(codes)
+            self.uses += uses
+
+    def append(self, records):
+        """Archive [(code, entry, reason), ...] as one gzip member (fsynced before returning).
+        The index is saved by the caller once per pass; a crash before that is caught up on load."""
+        blob = gzip.compress("".join(
+            json.dumps({"k": code, "reason": reason, "v": entry}, separators=(",", ":")) + "\n"
+            for code, entry, reason in records
+        ).encode("utf-8"))
+        with self.lock:
+            offset = self.size
+            with open(self.path, "ab") as f:
+                try:
+                    f.write(blob)
+                    f.flush()
+                    os.fsync(f.fileno())
+                except OSError:
+                    f.truncate(offset)
+                    raise
+        self.add_member(offset, len(blob), [code for code, _, _ in records],
+                        sum(int(entry.get("used_count", 0)) for _, entry, _ in records))
+        short = sum(1 for _, _, c, _ in self.members if c < CODES_ARCHIVE_BATCH)
+        if self.count > self.capacity or short >= ARCHIVE_MERGE_MEMBERS:
+            self.rebuild(merge=True)  # resizes the global filter, merges the short members
+
+    def __contains__(self, code):
+        """Bloom check only: False is certain, True is right ~99% of the time (lookup() is exact)."""
+        return BloomFilter.hashes(code) in self.bloom
+
+    def lookup(self, code):
+        """(entry, reason) of an archived code, or None."""
+        h = BloomFilter.hashes(code)
+        with self.lock:
+            if h not in self.bloom:
+                return None
+            # opened with the member list it belongs to; a merge swaps both under the lock
+            members, n = self.members, len(self.members)
+            f = open(self.path, "rb")
+        prefix = ('{"k":' + json.dumps(code) + ",").encode("utf-8")
+        with f:
+            for i in range(n - 1, -1, -1):
+                offset, length, _, mb = members[i]
+                if h not in mb:
+                    continue
+                f.seek(offset)
+                for line in gzip.decompress(f.read(length)).splitlines():
+                    if line.startswith(prefix):
+                        rec = json.loads(line)
+                        return rec["v"], rec["reason"]
+        return None
+
+code_archive = CodeArchive(CODES_ARCHIVE_FILE, CODES_ARCHIVE_INDEX_FILE, CODES_ARCHIVE_BLOOM_FILE)
 
 # ==============================
 #   LOAD / SAVE HELPERS
 # ==============================
 def load_data():
-    global users, banned_users, admins, codes_db, categories, files_db, bundles_db
+    global store
+    store = open_store()
+
     try:
-        with open(USERS_FILE, "r") as f:
-            users = {int(line.strip()) for line in f if line.strip()}
+        users.update(store.load_set("users"))
     except FileNotFoundError:
         print(f"'{USERS_FILE}' not found. Starting with empty user list.")
 
     try:
-        with open(BANNED_USERS_FILE, "r") as f:
-            banned_users = {int(line.strip()) for line in f if line.strip()}
+        banned_users.update(store.load_set("banned_users"))
     except FileNotFoundError:
         print(f"'{BANNED_USERS_FILE}' not found. Starting with no banned users.")
 
     try:
-        with open(ADMINS_FILE, "r") as f:
-            for line in f:
-                v = line.strip()
-                if v:
-                    admins.add(int(v))
+        admins.update(store.load_set("admins"))
     except FileNotFoundError:
         print(f"'{ADMINS_FILE}' not found. Starting with only MAIN_ADMINS.")
 
     try:
-        with open(CODES_FILE, "r") as f:
-            loaded = json.load(f)
-            if isinstance(loaded, dict):
-                # migrate old schema (used->max_uses==1 etc.)
-                for k, v in loaded.items():
-                    if isinstance(v, dict):
-                        v.setdefault("max_uses", 1 if v.get("used") is not None else 1)
-                        v.setdefault("used_count", 1 if v.get("used") else 0)
-                        v.pop("used", None)
-                        v.setdefault("expires_at", None)
-                        v.setdefault("created_by", 0)
-                codes_db.update(loaded)
+        if isinstance(codes_db, RowCache):
+            # rows are read (and upgraded) on demand
+            codes_db.load_keys()
+        else:
+            loaded = store.load_table("codes")
+            for v in loaded.values():
+                upgrade_code_entry(v)
+            codes_db.update(loaded)
     except (FileNotFoundError, json.JSONDecodeError):
         print(f"'{CODES_FILE}' not found or invalid. Starting with empty codes DB.")
 
@@ -136,74 +1976,269 @@ def load_data():
             loaded_categories = [line.strip() for line in f if line.strip()]
             if loaded_categories:
                 categories[:] = loaded_categories
+                render_cache.invalidate("categories")
     except FileNotFoundError:
         print(f"'{CATEGORIES_FILE}' not found. Using default categories.")
 
     try:
-        with open(FILES_DB_FILE, "r") as f:
-            tmp = json.load(f)
-            if isinstance(tmp, dict):
-                # migrate access block
-                for code, entry in tmp.items():
-                    entry.setdefault("access", {"mode": "public", "limit": None, "viewed_by": []})
-                    entry["access"].setdefault("viewed_by", [])
-                files_db.update(tmp)
+        # from_json fills in a missing access block
+        if isinstance(files_db, RowCache):
+            files_db.load_keys()
+        else:
+            files_db.update(store.load_table("files"))
     except (FileNotFoundError, json.JSONDecodeError):
         print(f"'{FILES_DB_FILE}' not found/invalid. Starting empty.")
 
     try:
-        with open(BUNDLES_DB_FILE, "r") as f:
-            tmp = json.load(f)
-            if isinstance(tmp, dict):
-                for code, entry in tmp.items():
-                    entry.setdefault("access", {"mode": "public", "limit": None, "viewed_by": []})
-                    entry["access"].setdefault("viewed_by", [])
-                bundles_db.update(tmp)
+        bundles_db.update(store.load_table("bundles"))
     except (FileNotFoundError, json.JSONDecodeError):
         print(f"'{BUNDLES_DB_FILE}' not found/invalid. Starting empty.")
 
-def save_to_file(file_path, data_set):
-    with open(file_path, "w") as f:
-        for item in sorted(data_set):
-            f.write(str(item) + "\n")
+    store.after_load()
+    rebuild_owner_index()
+    code_archive.load()
+    code_expiry.rebuild()
+    code_allocator.rebuild()
+    if RESTORE_BUNDLE_SESSIONS:
+        load_bundle_sessions()
 
-def save_codes_db():
-    with open(CODES_FILE, "w") as f:
-        json.dump(codes_db, f, indent=4)
+    try:
+        dead_users.update(dead_users_registry.load())
+    except FileNotFoundError:
+        pass
+
+def save_codes_db(*codes):
+    if codes:
+        store.put("codes", *codes)
+    else:
+        store.flush("codes")
 
 def save_categories():
-    with open(CATEGORIES_FILE, "w") as f:
-        for cat in categories:
-            f.write(cat + "\n")
+    render_cache.invalidate("categories")
+    saver.mark_dirty("categories")
+
+saver.register("categories", lambda: list(categories),
+               lambda cats: write_atomic(CATEGORIES_FILE, "".join(cat + "\n" for cat in cats)))
+
+def save_files_db(*codes):
+    if codes:
+        store.put("files", *codes)
+    else:
+        store.flush("files")
+
+def save_bundles_db(*codes):
+    if codes:
+        store.put("bundles", *codes)
+    else:
+        store.flush("bundles")
+
+def index_owner_item(owner, created_at, kind, code):
+    bisect.insort(owner_index.setdefault(owner, []), (int(created_at or 0), kind, code))
 
-def save_files_db():
-    with open(FILES_DB_FILE, "w") as f:
-        json.dump(files_db, f, indent=2)
+def rebuild_owner_index():
+    owner_index.clear()
+    for kind, table in (("f", "files"), ("b", "bundles")):
+        for owner, created_at, code in store.owner_rows(table):
+            owner_index.setdefault(owner, []).append((int(created_at or 0), kind, code))
+    for items in owner_index.values():
+        items.sort()
 
-def save_bundles_db():
-    with open(BUNDLES_DB_FILE, "w") as f:
-        json.dump(bundles_db, f, indent=2)
+def compaction_loop():
+    while True:
+        time.sleep(JOURNAL_COMPACT_INTERVAL)
+        try:
+            store.maintenance()
+        except Exception as e:
+            print("Storage maintenance failed:", e)
+        if RESTORE_BUNDLE_SESSIONS:
+            save_bundle_sessions()
+
+def archive_dead_codes(now=None):
+    """Move codes that expired or were used up CODES_ARCHIVE_GRACE ago from codes_db to code_archive.
+    The archive is written (and fsynced) before the codes are deleted from the store."""
+    now = now or time.time()
+    due = code_expiry.pop_due(now)
+    archived = 0
+    for i in range(0, len(due), CODES_ARCHIVE_BATCH):
+        records = []
+        for code in due[i:i + CODES_ARCHIVE_BATCH]:
+            with redeem_lock(code):
+                info = codes_db.get(code)
+                reason = dead_reason(info, now - CODES_ARCHIVE_GRACE) if info else None
+                if reason:
+                    records.append((code, copy_entry(info), reason))
+        if not records:
+            continue
+        code_archive.append(records)
+        codes = [code for code, _, _ in records]
+        with db_lock:
+            for code in codes:
+                codes_db.pop(code, None)
+        save_codes_db(*codes)
+        code_allocator.release(codes)
+        archived += len(codes)
+    if archived:
+        code_archive.save_index()
+        print(f"🗄 Archived {archived} dead code(s); {len(codes_db)} live, {code_archive.count} archived")
+    return archived
+
+def archive_loop():
+    while True:
+        time.sleep(CODES_ARCHIVE_INTERVAL)
+        try:
+            archive_dead_codes()
+        except Exception as e:
+            print("Code archival failed:", e)
+
+def save_bundle_sessions():
+    now_wall, now_mono = time.time(), time.monotonic()
+    with bundle_sessions.lock:
+        data = {str(uid): {"items": list(items),
+                           "expires_at": now_wall + bundle_sessions.deadlines.get(uid, now_mono) - now_mono}
+                for uid, items in bundle_sessions.items()}
+    try:
+        write_atomic(BUNDLE_SESSIONS_FILE, json.dumps(data))
+    except OSError as e:
+        print("Saving bundle sessions failed:", e)
+
+def load_bundle_sessions():
+    try:
+        with open(BUNDLE_SESSIONS_FILE, "r") as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return
+    now = time.time()
+    for uid, sess in data.items():
+        remaining = sess.get("expires_at", 0) - now
+        if remaining > 0:
+            bundle_sessions[int(uid)] = [c for c in sess.get("items", []) if c in files_db]
+            bundle_sessions.touch(int(uid), remaining)
+
+def migrate_json_to_sqlite():
+    """One-shot copy of the JSON/TXT files in DATA_DIR into SQLITE_DB_FILE."""
+    global store
+    store = JsonStore()
+    for name in ("users", "banned_users", "admins"):
+        try:
+            SET_DATA[name].update(store.load_set(name))
+        except FileNotFoundError:
+            pass
+    tables = {}
+    for table in ("codes", "files", "bundles"):
+        try:
+            tables[table] = store.load_table(table)
+        except (FileNotFoundError, json.JSONDecodeError):
+            tables[table] = {}
+    for v in tables["codes"].values():
+        upgrade_code_entry(v)
+    target = SqliteStore(SQLITE_DB_FILE)
+    target.import_all(tables)
+    print(f"✅ Migrated {len(users)} users, {len(tables['codes'])} codes, {len(tables['files'])} files and "
+          f"{len(tables['bundles'])} bundles into '{SQLITE_DB_FILE}'.")
 
 # ==============================
 #      UTILS & HELPERS
 # ==============================
-def generate_code(length=10):
-    chars = string.ascii_letters + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
+CODE_ALPHABET = string.ascii_letters + string.digits
+CODE_LENGTH = 10
+# bytes.translate() maps each random byte to a code character; bytes >= 248 are dropped so
+# every one of the 62 characters stays equally likely (248 = 4 * 62)
+_CODE_TABLE = bytes(ord(CODE_ALPHABET[b % len(CODE_ALPHABET)]) for b in range(256))
+_CODE_REJECT = bytes(range(4 * len(CODE_ALPHABET), 256))
+
+class CodeAllocator:
+    """Hands out codes that are unique across codes_db, files_db and bundles_db.
+
+    `taken` is the one namespace index for all three tables (rebuilt by load_data); every new
+    code, random or custom, is claimed here first. Random codes come from `secrets`.
+    Archived codes leave `taken`; custom codes are checked against code_archive instead. Random
+    codes are not: with 62**10 possible codes a repeat of an archived one is a ~1e-12 event per
+    million archived codes, not worth a hash per candidate.
+    """
+    def __init__(self):
+        self.taken = set()
+        self.lock = threading.Lock()
+
+    def rebuild(self):
+        with self.lock:
+            self.taken = set(codes_db)
+            self.taken.update(files_db)
+            self.taken.update(bundles_db)
+
+    def allocate(self, n=1):
+        """Return n new unique random codes."""
+        out = []
+        with self.lock:
+            while len(out) < n:
+                need = n - len(out)
+                raw = secrets.token_bytes(need * CODE_LENGTH * 33 // 32 + CODE_LENGTH)
+                chars = raw.translate(_CODE_TABLE, _CODE_REJECT).decode("ascii")
+                for i in range(0, len(chars) - CODE_LENGTH + 1, CODE_LENGTH):
+                    code = chars[i:i + CODE_LENGTH]
+                    if code not in self.taken:
+                        self.taken.add(code)
+                        out.append(code)
+                        if len(out) == n:
+                            break
+        return out
+
+    def reserve(self, code):
+        """Claim a chosen (custom) code; False if it is already in use."""
+        with self.lock:
+            if code in self.taken or code_archive.lookup(code) is not None:
+                return False
+            self.taken.add(code)
+            return True
+
+    def release(self, codes):
+        with self.lock:
+            self.taken.difference_update(codes)
+
+code_allocator = CodeAllocator()
 
 def generate_unique_code():
-    while True:
-        code = generate_code(10)
-        if (code not in codes_db) and (code not in files_db) and (code not in bundles_db):
-            return code
+    return code_allocator.allocate(1)[0]
+
+# membership_cache: { user_id: (joined: bool, checked_at: monotonic) }, least recently used first
+membership_cache = OrderedDict()
+membership_lock = threading.Lock()
+
+def cached_membership(user_id):
+    """The cached join status while it is fresh, else None."""
+    with membership_lock:
+        cached = membership_cache.get(user_id)
+        if cached:
+            joined, checked_at = cached
+            ttl = MEMBERSHIP_TTL_JOINED if joined else MEMBERSHIP_TTL_NOT_JOINED
+            if time.monotonic() - checked_at < ttl:
+                membership_cache.move_to_end(user_id)
+                return joined
+    return None
 
 def has_joined_channel(user_id):
+    joined = cached_membership(user_id)
+    if joined is not None:
+        return joined
+    now = time.monotonic()
+    with membership_lock:
+        cached = membership_cache.get(user_id)
     try:
-        member_status = bot.get_chat_member(chat_id=FORCE_JOIN_CHANNEL_ID, user_id=user_id).status
-        return member_status in ['member', 'administrator', 'creator']
+        member_status = api.get_chat_member(chat_id=FORCE_JOIN_CHANNEL_ID, user_id=user_id).status
+        joined = member_status in ['member', 'administrator', 'creator']
     except Exception as e:
         print(f"Error checking user {user_id}: {e}")
+        # serve the last known answer for a while instead of locking everyone out
+        if cached:
+            ttl = MEMBERSHIP_TTL_JOINED if cached[0] else MEMBERSHIP_TTL_NOT_JOINED
+            if now - cached[1] < ttl + MEMBERSHIP_STALE_GRACE:
+                return cached[0]
         return False
+    with membership_lock:
+        membership_cache[user_id] = (joined, now)
+        membership_cache.move_to_end(user_id)
+        while len(membership_cache) > MEMBERSHIP_CACHE_SIZE:
+            membership_cache.popitem(last=False)
+    return joined
 
 def display_name(u):
     first = (u.first_name or "").strip()
@@ -228,11 +2263,112 @@ def build_share_link(code: str) -> str:
     username = BOT_USERNAME or "YourBot"
     return f"https://t.me/{username}?start={code}"
 
+class EventSink:
+    """Queues DATA_CHANNEL log events and posts them in merged batches off the request path.
+
+    A background thread flushes every EVENT_FLUSH_INTERVAL seconds or EVENT_FLUSH_BATCH
+    events, packing as many events as fit into one message. Events that overflow the queue
+    or can't be delivered (api already retries 429s and 5xx errors) are appended to
+    EVENT_SPILL_FILE and re-queued on the next start.
+    """
+    SEPARATOR = "\n\n"
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.spill_lock = threading.Lock()
+        self.thread = None
+        gauges["event_queue_depth"] = self.queue.qsize
+
+    def emit(self, text):
+        try:
+            self.queue.put_nowait(text)
+        except queue.Full:
+            self.spill([text])
+
+    def spill(self, texts):
+        with self.spill_lock:
+            with open(EVENT_SPILL_FILE, "a") as f:
+                for t in texts:
+                    f.write(json.dumps(t) + "\n")
+
+    def restore_spill(self):
+        with self.spill_lock:
+            try:
+                with open(EVENT_SPILL_FILE, "r") as f:
+                    texts = [json.loads(line) for line in f if line.strip()]
+                os.remove(EVENT_SPILL_FILE)
+            except (FileNotFoundError, json.JSONDecodeError):
+                return
+        for t in texts:
+            self.emit(t)
+
+    @staticmethod
+    def pack(texts):
+        """Merge events into messages of at most TELEGRAM_MESSAGE_LIMIT chars: [(message, [events])]."""
+        batches = []
+        for t in texts:
+            # an oversized event is cut into limit-sized pieces
+            for piece in [t[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(t), TELEGRAM_MESSAGE_LIMIT)]:
+                if batches and len(batches[-1][0]) + len(EventSink.SEPARATOR) + len(piece) <= TELEGRAM_MESSAGE_LIMIT:
+                    msg, events = batches[-1]
+                    batches[-1] = (msg + EventSink.SEPARATOR + piece, events + [piece])
+                else:
+                    batches.append((piece, [piece]))
+        return batches
+
+    def flush(self, texts):
+        batches = self.pack(texts)
+        for i, (msg, events) in enumerate(batches):
+            try:
+                api.send_message(self.chat_id, msg, parse_mode=None, disable_web_page_preview=True,
+                                 priority=PRIORITY_LOG)
+            except Exception as e:
+                # the rest would most likely fail the same way; keep them all for the next start
+                print("DATA_CHANNEL send failed:", e)
+                self.spill([t for _, batch in batches[i:] for t in batch])
+                return
+
+    def drain(self, wait=0):
+        """Collect events until EVENT_FLUSH_BATCH are in hand or `wait` seconds have passed."""
+        texts = []
+        deadline = time.monotonic() + wait
+        while len(texts) < EVENT_FLUSH_BATCH:
+            remaining = deadline - time.monotonic()
+            try:
+                texts.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return texts
+
+    def run(self):
+        while True:
+            texts = self.drain(wait=EVENT_FLUSH_INTERVAL)
+            if texts:
+                try:
+                    self.flush(texts)
+                except Exception as e:
+                    print("DATA_CHANNEL flush failed:", e)
+                    self.spill(texts)
+
+    def start(self):
+        self.restore_spill()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def close(self):
+        """Flush whatever is still queued (shutdown); undeliverable events are spilled."""
+        while True:
+            texts = self.drain()
+            if not texts:
+                return
+            self.flush(texts)
+
+event_sink = EventSink(DATA_CHANNEL)
+
 def send_to_data_channel(text: str):
-    try:
-        bot.send_message(DATA_CHANNEL, text, parse_mode=None, disable_web_page_preview=True)
-    except Exception as e:
-        print("DATA_CHANNEL send failed:", e)
+    event_sink.emit(text)
 
 def build_store_caption_html(user, code: str, created_at: int, original_caption: str, ctype: str) -> str:
     user_line = safe_html(display_name(user))
@@ -250,45 +2386,70 @@ def build_store_caption_html(user, code: str, created_at: int, original_caption:
     parts.append(f"🔗 <b>Share:</b> <code>{link}</code>")
     return "\n".join(parts)
 
+DEEPLINK_RE = re.compile(r"(?:https?://)?t\.me/[^?\s]+?\?start=([A-Za-z0-9_-]+)")
+
 def is_deeplink(text: str) -> str:
-    if not text:
+    if not text or "t.me/" not in text:
         return ""
-    m = re.search(r"(?:https?://)?t\.me/[^?\s]+?\?start=([A-Za-z0-9_-]+)", text)
+    m = DEEPLINK_RE.search(text)
     return m.group(1) if m else ""
 
-def access_ok_for_file(entry, requester_id: int) -> (bool, str):
-    acc = entry.get("access", {"mode": "public", "limit": None, "viewed_by": []})
-    mode = acc.get("mode", "public")
-    if requester_id == entry.get("owner"):
-        return True, ""
-    if mode == "public":
-        return True, ""
-    if mode == "private":
-        return False, "🔒 This file is Private. Only the owner can access."
-    if mode == "unlisted":
-        limit = acc.get("limit")
-        viewed_by = set(acc.get("viewed_by") or [])
-        if requester_id in viewed_by:
-            return True, ""
-        # if limit not set => treat like public-unlisted (no cap)
-        if limit is None:
-            return True, ""
-        # still capacity?
-        if len(viewed_by) < int(limit):
-            return True, ""
-        return False, "🚫 This Unlisted link has reached its viewer limit."
-    return True, ""
-
-def record_view(entry, requester_id: int, saver):
-    acc = entry.setdefault("access", {"mode": "public", "limit": None, "viewed_by": []})
-    mode = acc.get("mode", "public")
-    if mode != "unlisted":
-        return
-    viewed_by = set(acc.get("viewed_by") or [])
-    if requester_id not in viewed_by:
-        viewed_by.add(requester_id)
-        acc["viewed_by"] = list(viewed_by)
-        saver()
+def classify_text(text: str) -> (str, str):
+    """Shape of a plain text message: ("link"|"file"|"bundle"|"text", code-or-stripped-text)."""
+    code = is_deeplink(text)
+    if code:
+        return "link", code
+    stripped = text.strip()
+    if stripped in files_db:
+        return "file", stripped
+    if stripped in bundles_db:
+        return "bundle", stripped
+    return "text", stripped
+
+def _viewer_set(entry):
+    if entry.viewed_by is None:
+        entry.viewed_by = []
+    # viewed_by is only appended to through here once the set exists; a length mismatch means
+    # it was filled in some other way (journal replay, viewer rows), so rebuild
+    if entry.viewer_set is None or len(entry.viewer_set) != len(entry.viewed_by):
+        entry.viewer_set = set(entry.viewed_by)
+    return entry.viewer_set
+
+def claim_view(table, code, entry, requester_id: int) -> (bool, str, bool):
+    """Atomically check access and, for Unlisted links, take a viewer slot.
+
+    Returns (ok, reason, claimed); claimed is True when a new viewer was recorded, so the
+    caller can release_view() it if delivery then fails.
+    """
+    with db_lock:
+        mode = entry.mode
+        if requester_id == entry.owner:
+            return True, "", False
+        if mode == AccessMode.PUBLIC:
+            return True, "", False
+        if mode == AccessMode.PRIVATE:
+            return False, "🔒 This file is Private. Only the owner can access.", False
+        if mode == AccessMode.UNLISTED:
+            viewers = _viewer_set(entry)
+            if requester_id in viewers:
+                return True, "", False
+            limit = entry.limit
+            # if limit not set => treat like public-unlisted (no cap)
+            if limit is not None and len(viewers) >= int(limit):
+                return False, "🚫 This Unlisted link has reached its viewer limit.", False
+            viewers.add(requester_id)
+            entry.viewed_by.append(requester_id)
+            store.record_view(table, code, requester_id)
+            return True, "", True
+        return True, "", False
+
+def release_view(table, code, entry, requester_id: int):
+    with db_lock:
+        viewers = _viewer_set(entry)
+        if requester_id in viewers:
+            viewers.discard(requester_id)
+            entry.viewed_by.remove(requester_id)
+            store.put(table, code)
 
 # ===== Proof helpers =====
 def proof_caption_html(u, uid, code, category):
@@ -305,8 +2466,9 @@ def proof_caption_html(u, uid, code, category):
         f"🕒 <b>Time:</b> <code>{readable_time(int(time.time()))}</code>"
     )
 
-def set_pending_proof(user_id, code, category, ttl_seconds=600):
+def set_pending_proof(user_id, code, category, ttl_seconds=SESSION_TTL_PROOF):
     pending_proof[user_id] = {"code": code, "category": category, "expires": time.time() + ttl_seconds}
+    pending_proof.touch(user_id, ttl_seconds)
 
 def has_pending_proof(user_id) -> bool:
     ctx = pending_proof.get(user_id)
@@ -326,7 +2488,7 @@ def clear_pending_proof(user_id):
 
 def try_send_proof_via_copy(message, caption_html):
     try:
-        bot.copy_message(
+        api.copy_message(
             chat_id=PROOF_CHANNEL_ID,
             from_chat_id=message.chat.id,
             message_id=message.message_id,
@@ -339,40 +2501,55 @@ def try_send_proof_via_copy(message, caption_html):
 
 def try_send_proof_via_file_id_photo(photo_file_id, caption_html):
     try:
-        bot.send_photo(PROOF_CHANNEL_ID, photo_file_id, caption=caption_html, parse_mode="HTML")
+        api.send_photo(PROOF_CHANNEL_ID, photo_file_id, caption=caption_html, parse_mode="HTML")
         return True, None
     except Exception as e:
         return False, e
 
 def try_send_proof_via_file_id_doc(file_id, caption_html):
     try:
-        bot.send_document(PROOF_CHANNEL_ID, file_id, caption=caption_html, parse_mode="HTML")
+        api.send_document(PROOF_CHANNEL_ID, file_id, caption=caption_html, parse_mode="HTML")
         return True, None
     except Exception as e:
         return False, e
 
+def download_to_buffer(file_path, max_bytes=PROOF_MAX_BYTES, timeout=PROOF_DOWNLOAD_TIMEOUT):
+    """Stream a Telegram file into memory, enforcing a size cap and an overall deadline."""
+    url = (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(BOT_TOKEN, file_path)
+    deadline = time.monotonic() + timeout
+    buf = io.BytesIO()
+    with requests.get(url, stream=True, timeout=timeout, proxies=telebot.apihelper.proxy) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(64 * 1024):
+            buf.write(chunk)
+            if buf.tell() > max_bytes:
+                raise ValueError(f"file is larger than {max_bytes // (1024 * 1024)} MB")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"download took longer than {timeout}s")
+    buf.seek(0)
+    return buf
+
 def try_download_and_reupload(file_id, caption_html, filename_prefix="proof"):
     try:
-        file_info = bot.get_file(file_id)
-        downloaded = bot.download_file(file_info.file_path)
+        file_info = api.get_file(file_id)
+        if file_info.file_size and file_info.file_size > PROOF_MAX_BYTES:
+            raise ValueError(f"file is larger than {PROOF_MAX_BYTES // (1024 * 1024)} MB")
+        buf = download_to_buffer(file_info.file_path)
         ext = os.path.splitext(file_info.file_path)[1] or ".jpg"
-        local_path = f"{filename_prefix}_{int(time.time())}{ext}"
-        with open(local_path, "wb") as f:
-            f.write(downloaded)
+        buf.name = f"{filename_prefix}{ext}"  # upload filename; never touches the disk
         if ext.lower() in [".jpg", ".jpeg", ".png", ".webp", ".bmp"]:
-            with open(local_path, "rb") as f:
-                bot.send_photo(PROOF_CHANNEL_ID, f, caption=caption_html, parse_mode="HTML")
+            api.send_photo(PROOF_CHANNEL_ID, buf, caption=caption_html, parse_mode="HTML")
         else:
-            with open(local_path, "rb") as f:
-                bot.send_document(PROOF_CHANNEL_ID, f, caption=caption_html, parse_mode="HTML")
-        try:
-            os.remove(local_path)
-        except:
-            pass
+            api.send_document(PROOF_CHANNEL_ID, buf, caption=caption_html, parse_mode="HTML")
         return True, None
     except Exception as e:
         return False, e
 
+# Bounds how many proofs run the copy -> file_id -> download/re-upload chain at once,
+# so a burst of proofs can't pile up downloads in memory. Handlers never wait for a slot:
+# they run on shared dispatch workers, so a proof that finds none is told to resend.
+proof_slots = threading.BoundedSemaphore(PROOF_CONCURRENCY)
+
 def explain_send_error(e):
     msg = str(e)
     return (
@@ -384,10 +2561,73 @@ def explain_send_error(e):
         f"_Technical detail:_ `{msg}`"
     )
 
+# ==============================
+#         RENDER CACHE
+# ==============================
+class RenderCache:
+    """Reply markups and texts that are the same for every user, built once.
+
+    Markups are stored as their JSON string: telebot sends a str reply_markup as-is, so a
+    cached keyboard costs no button objects or json.dumps per reply. Keys are tuples whose
+    first element names the source (e.g. ("categories",)); invalidate(name) drops every entry
+    built from it."""
+    def __init__(self):
+        self.items = {}
+        self.generations = {}  # name -> invalidate() count
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        value = self.items.get(key)
+        if value is None:
+            with self.lock:
+                generation = self.generations.get(key[0], 0)
+            value = build()
+            with self.lock:
+                # built from data that was invalidated meanwhile: use it once, don't keep it
+                if self.generations.get(key[0], 0) == generation:
+                    self.items[key] = value
+        return value
+
+    def invalidate(self, name):
+        with self.lock:
+            self.generations[name] = self.generations.get(name, 0) + 1
+            for key in [k for k in self.items if k[0] == name]:
+                del self.items[key]
+
+render_cache = RenderCache()
+
+def markup_template(build, *fields):
+    """JSON of build(*fields) with a {field} placeholder per argument, for per-item keyboards.
+
+    Fill it with template.format(field=json_fragment(value), ...)."""
+    template = build(*("\x00" + f for f in fields)).to_json().replace("{", "{{").replace("}", "}}")
+    for f in fields:
+        template = template.replace("\\u0000" + f, "{" + f + "}")
+    return template
+
+def json_fragment(value):
+    return json.dumps(value)[1:-1]
+
+def categories_markup():
+    def build():
+        markup = telebot.types.InlineKeyboardMarkup()
+        for cat in categories:
+            markup.add(telebot.types.InlineKeyboardButton(cat, callback_data=f"cat_{cat}"))
+        return markup.to_json()
+    return render_cache.get(("categories",), build)
+
 # ==============================
 #      COMMANDS: START/HELP
 # ==============================
+WELCOME_TEXT = (
+    "👋 Welcome!\n\n"
+    "• Upload any file to get a share link (with privacy controls).\n"
+    "• Use /bundle to create a multi-file bundle.\n\n"
+    "🧩 **Create Redeem**\nChoose a category to add account(s), then pick a code type:"
+)
+
 @bot.message_handler(commands=["start"])
+@timed
 def start_cmd(message):
     user_id = message.from_user.id
     payload_code = ""
@@ -396,7 +2636,8 @@ def start_cmd(message):
         payload_code = parts[1].strip()
 
     if user_id in banned_users:
-        return bot.send_message(user_id, "🚫 You are banned from using this bot.")
+        return api.send_message(user_id, "🚫 You are banned from using this bot.")
+    revive_user(user_id)
 
     # Public retrieval via deep link (no force-join)
     if payload_code and (payload_code in files_db or payload_code in bundles_db):
@@ -406,26 +2647,14 @@ def start_cmd(message):
     # If redeem/category UI flow: show categories list immediately
     if user_id not in users:
         users.add(user_id)
-        save_to_file(USERS_FILE, users)
+        store.add_member("users", user_id)
         text = f"🆕 New User Notification\nUser: {message.from_user.first_name} (@{message.from_user.username})\nUser ID: {user_id}"
         send_to_data_channel(text)
 
     # Show Category chooser (no force-join needed to create codes, but required to REDEEM later)
-    markup = telebot.types.InlineKeyboardMarkup()
-    for cat in categories:
-        markup.add(telebot.types.InlineKeyboardButton(cat, callback_data=f"cat_{cat}"))
-    bot.send_message(
-        user_id,
-        "👋 Welcome!\n\n"
-        "• Upload any file to get a share link (with privacy controls).\n"
-        "• Use /bundle to create a multi-file bundle.\n\n"
-        "🧩 **Create Redeem**\nChoose a category to add account(s), then pick a code type:",
-        reply_markup=markup
-    )
+    api.send_message(user_id, WELCOME_TEXT, reply_markup=categories_markup())
 
-@bot.message_handler(commands=["help"])
-def help_cmd(message):
-    uid = message.from_user.id
+def help_text(role):
     main_admin_block = (
         "👑 **Main Admin Commands**\n"
         "/addadmin `<user_id>` - Add new admin\n"
@@ -433,7 +2662,9 @@ def help_cmd(message):
         "/addcat `<Category Name>` - Add a new category\n"
         "/delcat `<Category Name>` - Delete a category\n"
         "/broadcast `<message>` - (Admins only) Send message to all users\n"
+        "/resumebroadcast - (Admins only) Resume an interrupted broadcast\n"
         "/stats - (Admins only) Show bot stats\n"
+        "/perf - (Admins only) Handler, API and save latencies\n"
         "/ban `<user_id>` - Ban user\n"
         "/unban `<user_id>` - Unban user\n"
     )
@@ -451,17 +2682,143 @@ def help_cmd(message):
         f"• Retrieve via `https://t.me/{BOT_USERNAME or 'YourBot'}?start=CODE` or by sending the CODE."
     )
 
-    if uid in MAIN_ADMINS:
-        text = f"{main_admin_block}\n{users_adminish_block}\n{user_file_block}"
-    elif uid in admins:
-        text = f"{users_adminish_block}\n{user_file_block}"
-    else:
-        text = (
-            "👋 **Welcome!**\n\n"
-            "**Start & Help**\n"
-            "/start to begin, /help for full command list.\n\n" + user_file_block
-        )
-    bot.send_message(message.chat.id, text)
+    if role == "main":
+        return f"{main_admin_block}\n{users_adminish_block}\n{user_file_block}"
+    if role == "admin":
+        return f"{users_adminish_block}\n{user_file_block}"
+    return (
+        "👋 **Welcome!**\n\n"
+        "**Start & Help**\n"
+        "/start to begin, /help for full command list.\n\n" + user_file_block
+    )
+
+@bot.message_handler(commands=["help"])
+def help_cmd(message):
+    uid = message.from_user.id
+    role = "main" if uid in MAIN_ADMINS else "admin" if uid in admins else "user"
+    text = render_cache.get(("help", role, BOT_USERNAME), lambda: help_text(role))
+    api.send_message(message.chat.id, text)
+
+# ==============================
+#       BROADCAST ENGINE
+# ==============================
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+broadcast_running = threading.Lock()
+
+def load_broadcast_state():
+    try:
+        with open(BROADCAST_STATE_FILE, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def save_broadcast_state(state):
+    tmp_path = BROADCAST_STATE_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, BROADCAST_STATE_FILE)
+
+def mark_dead_user(uid):
+    if uid in dead_users:
+        return
+    dead_users.add(uid)
+    dead_users_registry.add(uid)
+
+def revive_user(uid):
+    if uid in dead_users:
+        dead_users.discard(uid)
+        dead_users_registry.remove(uid)
+
+def broadcast_send_one(uid, text):
+    """Returns "sent", "failed", "dead" or "limited" (still a 429 after api's retries: send again).
+
+    A 429 pauses broadcast_bucket, so every broadcast sender backs off, not just this chat."""
+    try:
+        api.send_message(uid, f"📢 **Broadcast:**\n\n{text}", priority=PRIORITY_BULK, throttle=broadcast_bucket)
+        return "sent"
+    except Exception as e:
+        wait = retry_after_of(e)
+        if wait is not None:
+            broadcast_bucket.pause(wait)  # api gave up on its last attempt without pausing
+            return "limited"
+        if is_dead_chat_error(e):
+            mark_dead_user(uid)
+            return "dead"
+        print(f"Failed to send broadcast to {uid}: {e}")
+        return "failed"
+
+def broadcast_progress_text(state, total, done):
+    return (f"📢 Broadcast {'finished' if done else 'in progress'}…\n\n"
+            f"📬 Sent: {state['sent']}\n❌ Failed: {state['failed']}\n🚫 Blocked/deleted: {state['dead']}\n"
+            f"👥 Remaining: {0 if done else total}")
+
+def run_broadcast(state):
+    """Deliver state["text"] to every live user with an id above state["cursor"].
+
+    Users are walked in id order in chunks of BROADCAST_CHUNK; after each chunk the last id is
+    checkpointed to BROADCAST_STATE_FILE, so a restart resumes where the last full chunk ended.
+    Rate-limited users are sent to again before the cursor moves past them.
+    """
+    chat_id = state["admin_chat_id"]
+    cursor = state.get("cursor")
+    targets = sorted(u for u in list(users) if u not in dead_users and (cursor is None or u > cursor))
+    save_broadcast_state(state)
+    progress = None
+    try:
+        progress = api.send_message(chat_id, broadcast_progress_text(state, len(targets), False))
+    except Exception as e:
+        print("Broadcast progress message failed:", e)
+    last_edit = time.monotonic()
+    with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as pool:
+        for i in range(0, len(targets), BROADCAST_CHUNK):
+            chunk = targets[i:i + BROADCAST_CHUNK]
+            pending = chunk
+            while pending:
+                results = pool.map(lambda uid: broadcast_send_one(uid, state["text"]), pending)
+                limited = []
+                for uid, result in zip(pending, results):
+                    if result == "limited":
+                        limited.append(uid)  # broadcast_bucket is paused by now
+                    else:
+                        state[result] += 1
+                pending = limited
+            state["cursor"] = chunk[-1]
+            save_broadcast_state(state)
+            if progress and time.monotonic() - last_edit >= BROADCAST_PROGRESS_EVERY:
+                last_edit = time.monotonic()
+                try:
+                    api.edit_message_text(broadcast_progress_text(state, len(targets) - i - len(chunk), False),
+                                          chat_id, progress.message_id)
+                except Exception:
+                    pass
+    try:
+        os.remove(BROADCAST_STATE_FILE)
+    except FileNotFoundError:
+        pass
+    final = broadcast_progress_text(state, 0, True)
+    try:
+        if progress:
+            api.edit_message_text(final, chat_id, progress.message_id)
+        else:
+            api.send_message(chat_id, final)
+    except Exception as e:
+        print("Broadcast summary failed:", e)
+
+def start_broadcast(state):
+    """Run the broadcast on a background thread; False if one is already running."""
+    if not broadcast_running.acquire(blocking=False):
+        return False
+
+    def worker():
+        try:
+            run_broadcast(state)
+        except Exception as e:
+            print("Broadcast crashed (resume with /resumebroadcast):", e)
+        finally:
+            broadcast_running.release()
+
+    threading.Thread(target=worker, daemon=True).start()
+    return True
 
 # ==============================
 #           ADMIN COMMANDS
@@ -474,16 +2831,25 @@ def stats_cmd(message):
     total_codes = len(codes_db)
     total_files = len(files_db)
     total_bundles = len(bundles_db)
-    total_uses = sum(v.get("used_count", 0) for v in codes_db.values())
+    total_uses = store.code_uses() + code_archive.uses
     text = (
         "📊 **Bot Statistics**\n\n"
         f"👥 Total Users: {total_users}\n"
-        f"🔑 Total Codes: {total_codes}\n"
+        f"🔑 Total Codes: {total_codes} live, {code_archive.count} archived\n"
         f"📈 Total Redeems: {total_uses}\n\n"
         f"🗂 Stored Files: {total_files}\n"
         f"🧺 Bundles: {total_bundles}"
     )
-    bot.send_message(message.chat.id, text)
+    api.send_message(message.chat.id, text)
+
+@bot.message_handler(commands=["perf"])
+def perf_cmd(message):
+    if message.from_user.id not in admins:
+        return
+    text = "\n".join(perf_report()) or "No samples yet."
+    if len(text) > 3900:
+        text = text[:3900] + "\n…"
+    api.send_message(message.chat.id, "📈 **Performance**\n```\n" + text + "\n```")
 
 @bot.message_handler(commands=["addadmin"])
 def add_admin(message):
@@ -492,10 +2858,12 @@ def add_admin(message):
     try:
         uid = int(message.text.split()[1])
         admins.add(uid)
-        save_to_file(ADMINS_FILE, admins - set(MAIN_ADMINS))
-        bot.send_message(message.chat.id, f"✅ Added `{uid}` as admin.")
+        if uid not in MAIN_ADMINS:
+            # MAIN_ADMINS come from the code, so dropping one there revokes them
+            store.add_member("admins", uid)
+        api.send_message(message.chat.id, f"✅ Added `{uid}` as admin.")
     except:
-        bot.send_message(message.chat.id, "⚠️ Usage: `/addadmin user_id`")
+        api.send_message(message.chat.id, "⚠️ Usage: `/addadmin user_id`")
 
 @bot.message_handler(commands=["adminlist"])
 def admin_list(message):
@@ -511,7 +2879,33 @@ def admin_list(message):
             text += f"- `{admin_id}`\n"
     else:
         text += "- None"
-    bot.send_message(message.chat.id, text)
+    api.send_message(message.chat.id, text)
+
+@bot.message_handler(commands=["addcat", "delcat"])
+def add_del_category(message):
+    if message.from_user.id not in MAIN_ADMINS:
+        return
+    command, _, name = message.text.partition(" ")
+    name = name.strip()
+    if not name:
+        return api.send_message(message.chat.id, "⚠️ Usage: `/addcat Category Name` OR `/delcat Category Name`")
+    if command.split("@")[0] == "/addcat":
+        if "\n" in name or "\r" in name:
+            return api.send_message(message.chat.id, "⚠️ A category name must be a single line.")
+        if len(f"cat_{name}".encode()) > CALLBACK_DATA_LIMIT:
+            # it becomes the button's callback data
+            return api.send_message(message.chat.id, f"⚠️ Category name is too long (max {CALLBACK_DATA_LIMIT - 4} bytes).")
+        if name in categories:
+            return api.send_message(message.chat.id, f"ℹ️ Category *{name}* already exists.")
+        categories.append(name)
+        save_categories()
+        api.send_message(message.chat.id, f"✅ Added category *{name}*.")
+    else:
+        if name not in categories:
+            return api.send_message(message.chat.id, f"⚠️ No category named *{name}*.")
+        categories.remove(name)
+        save_categories()
+        api.send_message(message.chat.id, f"🗑 Deleted category *{name}*.")
 
 @bot.message_handler(commands=["ban", "unban"])
 def ban_unban_user(message):
@@ -522,14 +2916,14 @@ def ban_unban_user(message):
         uid = int(uid_str)
         if command == "/ban":
             banned_users.add(uid)
-            save_to_file(BANNED_USERS_FILE, banned_users)
-            bot.send_message(message.chat.id, f"🚫 Banned user `{uid}`")
+            store.add_member("banned_users", uid)
+            api.send_message(message.chat.id, f"🚫 Banned user `{uid}`")
         elif command == "/unban":
             banned_users.discard(uid)
-            save_to_file(BANNED_USERS_FILE, banned_users)
-            bot.send_message(message.chat.id, f"✅ Unbanned user `{uid}`")
+            store.remove_member("banned_users", uid)
+            api.send_message(message.chat.id, f"✅ Unbanned user `{uid}`")
     except:
-        bot.send_message(message.chat.id, "⚠️ Usage: `/ban user_id` OR `/unban user_id`")
+        api.send_message(message.chat.id, "⚠️ Usage: `/ban user_id` OR `/unban user_id`")
 
 @bot.message_handler(commands=["broadcast"])
 def broadcast(message):
@@ -537,23 +2931,30 @@ def broadcast(message):
         return
     text = message.text.replace("/broadcast", "").strip()
     if not text:
-        return bot.send_message(message.chat.id, "⚠️ Please provide a message: `/broadcast YourMessage`")
-    sent_count, failed_count = 0, 0
-    for uid in list(users):
-        try:
-            bot.send_message(uid, f"📢 **Broadcast:**\n\n{text}")
-            sent_count += 1
-            time.sleep(0.1)
-        except Exception as e:
-            failed_count += 1
-            print(f"Failed to send broadcast to {uid}: {e}")
-    bot.send_message(message.chat.id, f"✅ Broadcast finished.\n\n📬 Sent to: {sent_count} users\n❌ Failed for: {failed_count} users")
+        return api.send_message(message.chat.id, "⚠️ Please provide a message: `/broadcast YourMessage`")
+    if load_broadcast_state():
+        return api.send_message(message.chat.id, "⚠️ A broadcast is already pending. Use /resumebroadcast to finish it first.")
+    state = {"text": text, "admin_chat_id": message.chat.id, "cursor": None,
+             "sent": 0, "failed": 0, "dead": 0, "started_at": int(time.time())}
+    if not start_broadcast(state):
+        api.send_message(message.chat.id, "⚠️ A broadcast is already running.")
+
+@bot.message_handler(commands=["resumebroadcast"])
+def resume_broadcast(message):
+    if message.from_user.id not in admins:
+        return
+    state = load_broadcast_state()
+    if not state:
+        return api.send_message(message.chat.id, "ℹ️ No interrupted broadcast to resume.")
+    state["admin_chat_id"] = message.chat.id
+    if not start_broadcast(state):
+        api.send_message(message.chat.id, "⚠️ A broadcast is already running.")
 
 # ==============================
 #         REDEEM CREATION
 #   (/start flow + /add for users)
 # ==============================
-def show_code_type_buttons(chat_id):
+def code_type_markup():
     kb = telebot.types.InlineKeyboardMarkup()
     kb.add(
         telebot.types.InlineKeyboardButton("✨ Custom Redeem Code", callback_data="code_type_custom"),
@@ -562,7 +2963,11 @@ def show_code_type_buttons(chat_id):
         telebot.types.InlineKeyboardButton("⏳ Time Code", callback_data="code_type_time"),
         telebot.types.InlineKeyboardButton("👥 User Limit Code", callback_data="code_type_limit"),
     )
-    bot.send_message(chat_id,
+    return kb.to_json()
+
+def show_code_type_buttons(chat_id):
+    kb = render_cache.get(("code_type",), code_type_markup)
+    api.send_message(chat_id,
                      "Choose code type:\n\n"
                      "• **Custom**: you pick the code text (e.g., `FESTIVE2025`).\n"
                      "• **Time**: code auto-expires after hours you set.\n"
@@ -575,10 +2980,7 @@ def add_cmd(message):
     if message.from_user.id in banned_users:
         return
     # Start like /start category chooser
-    markup = telebot.types.InlineKeyboardMarkup()
-    for cat in categories:
-        markup.add(telebot.types.InlineKeyboardButton(cat, callback_data=f"cat_{cat}"))
-    bot.send_message(message.chat.id, "Choose a *category* to add account(s):", reply_markup=markup)
+    api.send_message(message.chat.id, "Choose a *category* to add account(s):", reply_markup=categories_markup())
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("cat_"))
 def handle_choose_category(call):
@@ -586,87 +2988,158 @@ def handle_choose_category(call):
         return
     cat = call.data.split("_", 1)[1]
     pending_redeem[call.from_user.id] = {"stage": "have_cat", "category": cat, "accounts": []}
-    bot.edit_message_text(f"📂 **Category:** {cat}\n\nNow send the *account detail(s)* (one per line).",
+    api.edit_message_text(f"📂 **Category:** {cat}\n\nNow send the *account detail(s)* (one per line).",
                           call.message.chat.id, call.message.message_id)
 
-@bot.message_handler(func=lambda m: pending_redeem.get(m.from_user.id, {}).get("stage") == "have_cat", content_types=['text'])
 def receive_accounts_for_redeem(message):
     ctx = pending_redeem.get(message.from_user.id)
     if not ctx: return
     lines = [ln.strip() for ln in message.text.splitlines() if ln.strip()]
     if not lines:
-        return bot.send_message(message.chat.id, "⚠️ Send at least one non-empty line.")
+        return api.send_message(message.chat.id, "⚠️ Send at least one non-empty line.")
     ctx["accounts"] = lines
+    pending_redeem.touch(message.from_user.id)
+    show_code_type_buttons(message.chat.id)
+
+def parse_accounts_file(buf, filename):
+    """Read accounts from an uploaded file: .txt = one per line, .csv = the "account" column
+    (or the first column when there is no such header). Lines are streamed, not split in one go."""
+    text = io.TextIOWrapper(buf, encoding="utf-8-sig", errors="replace", newline="")
+    if filename.lower().endswith(".csv"):
+        reader = csv.reader(text)
+        first = next(reader, None) or []
+        header = [c.strip().lower() for c in first]
+        if "account" in header:
+            col = header.index("account")
+        else:
+            col = 0
+            reader = itertools.chain([first], reader)
+        lines = (row[col] if len(row) > col else "" for row in reader)
+    else:
+        lines = text
+    accounts = []
+    for line in lines:
+        line = line.strip()
+        if line:
+            accounts.append(line)
+            if len(accounts) > IMPORT_MAX_LINES:
+                raise ValueError(f"more than {IMPORT_MAX_LINES} accounts in one file")
+    return accounts
+
+def is_accounts_file(message):
+    # other documents (proof screenshots, uploads) fall through to their own handlers
+    return ((message.document.file_name or "").lower().endswith((".txt", ".csv"))
+            and (pending_redeem.get(message.from_user.id) or {}).get("stage") == "have_cat")
+
+@bot.message_handler(func=is_accounts_file, content_types=['document'])
+def receive_accounts_file(message):
+    uid = message.from_user.id
+    ctx = pending_redeem.get(uid)
+    if not ctx: return
+    doc = message.document
+    name = doc.file_name or ""
+    try:
+        if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+            raise ValueError(f"file is larger than {IMPORT_MAX_BYTES // (1024 * 1024)} MB")
+        file_info = api.get_file(doc.file_id)
+        accounts = parse_accounts_file(download_to_buffer(file_info.file_path, max_bytes=IMPORT_MAX_BYTES), name)
+    except Exception as e:
+        return api.send_message(message.chat.id, f"❌ Could not read the file:\n`{e}`")
+    if not accounts:
+        return api.send_message(message.chat.id, "⚠️ The file has no non-empty lines.")
+    ctx["accounts"] = accounts
+    pending_redeem.touch(uid)
+    api.send_message(message.chat.id, f"📄 Read **{len(accounts)}** account(s) from the file.")
     show_code_type_buttons(message.chat.id)
 
+def codes_csv(rows):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["code", "account"])
+    writer.writerows(rows)
+    return io.BytesIO(out.getvalue().encode("utf-8"))
+
 @bot.callback_query_handler(func=lambda call: call.data.startswith("code_type_"))
 def handle_code_type(call):
     uid = call.from_user.id
     ctx = pending_redeem.get(uid)
     if not ctx:
-        try: bot.answer_callback_query(call.id, "Session expired. Use /add again.")
+        try: api.answer_callback_query(call.id, "Session expired. Use /add again.")
         except: pass
         return
     kind = call.data.split("_", 2)[2]
+    pending_redeem.touch(uid)
     if kind == "custom":
         ctx["stage"] = "await_code"
-        bot.edit_message_text("✍️ Send your **custom code text** (letters/digits/`-`/`_`, 4–24 chars).",
+        api.edit_message_text("✍️ Send your **custom code text** (letters/digits/`-`/`_`, 4–24 chars).",
                               call.message.chat.id, call.message.message_id)
     elif kind == "time":
         ctx["stage"] = "await_time"
-        bot.edit_message_text("⏳ Send expiry in **hours** (e.g., `2` for 2 hours).",
+        api.edit_message_text("⏳ Send expiry in **hours** (e.g., `2` for 2 hours).",
                               call.message.chat.id, call.message.message_id)
     elif kind == "limit":
         ctx["stage"] = "await_limit"
-        bot.edit_message_text("👥 Send **user limit** as a number (e.g., `100`).",
+        api.edit_message_text("👥 Send **user limit** as a number (e.g., `100`).",
                               call.message.chat.id, call.message.message_id)
 
 def make_codes_and_reply(chat_id, creator_id, category, accounts, max_uses=1, expires_at=None, custom_code=None):
-    made = []
+    if not accounts:
+        # save_codes_db() with no keys would rewrite the whole table
+        api.send_message(chat_id, "⚠️ No account details were sent. Use /add again.")
+        return
+    made = []  # [(code, account), ...]
     if custom_code:
         code = custom_code
-        if code in codes_db or code in files_db or code in bundles_db:
-            bot.send_message(chat_id, "❌ This code already exists. Choose another.")
+        if not code_allocator.reserve(code):
+            api.send_message(chat_id, "❌ This code already exists. Choose another.")
             return
-        if len(accounts) > 1:
-            bot.send_message(chat_id, "⚠️ Custom code will be created for the *first* account only (one code).")
-        acc = accounts[0]
-        codes_db[code] = {
-            "category": category, "account": acc,
-            "max_uses": max_uses, "used_count": 0,
-            "expires_at": expires_at, "created_by": creator_id
-        }
-        made.append(code)
-    else:
-        for acc in accounts:
-            code = generate_unique_code()
+        with db_lock:
             codes_db[code] = {
-                "category": category, "account": acc,
+                "category": category, "account": accounts[0],
                 "max_uses": max_uses, "used_count": 0,
                 "expires_at": expires_at, "created_by": creator_id
             }
-            made.append(code)
-    save_codes_db()
-    lines = [f"🔑 `{c}`" for c in made]
+        if len(accounts) > 1:
+            api.send_message(chat_id, "⚠️ Custom code will be created for the *first* account only (one code).")
+        made.append((code, accounts[0]))
+    else:
+        new_codes = code_allocator.allocate(len(accounts))
+        with db_lock:
+            for acc, code in zip(accounts, new_codes):
+                codes_db[code] = {
+                    "category": category, "account": acc,
+                    "max_uses": max_uses, "used_count": 0,
+                    "expires_at": expires_at, "created_by": creator_id
+                }
+                made.append((code, acc))
+    # one journal write / one SQLite transaction for the whole batch
+    save_codes_db(*(c for c, _ in made))
+    if expires_at:
+        for c, _ in made:
+            code_expiry.push(c, expires_at + CODES_ARCHIVE_GRACE)
     meta = []
     if expires_at: meta.append(f"⏳ Expires: {readable_time(expires_at)}")
     if max_uses != 1: meta.append(f"👥 Limit: {max_uses} uses")
     meta_txt = (" (" + ", ".join(meta) + ")") if meta else ""
-    bot.send_message(chat_id, f"✅ Created **{len(made)}** code(s){meta_txt} for **{category}**:\n" + "\n".join(lines))
+    summary = f"✅ Created **{len(made)}** code(s){meta_txt} for **{category}**"
+    if len(made) > CODES_INLINE_MAX:
+        api.send_document(chat_id, codes_csv(made), caption=summary + ".",
+                          visible_file_name=f"codes_{category.replace(' ', '_')}_{int(time.time())}.csv")
+        return
+    lines = [f"🔑 `{c}`" for c, _ in made]
+    api.send_message(chat_id, summary + ":\n" + "\n".join(lines))
 
-@bot.message_handler(func=lambda m: pending_redeem.get(m.from_user.id, {}).get("stage") == "await_code", content_types=['text'])
 def finalize_custom_code(message):
     uid = message.from_user.id
     ctx = pending_redeem.pop(uid, None)
     if not ctx: return
     code = message.text.strip()
     if not re.fullmatch(r"[A-Za-z0-9_-]{4,24}", code):
-        bot.send_message(message.chat.id, "❌ Invalid format. Use letters/digits/`-`/`_` (4–24 chars).")
+        api.send_message(message.chat.id, "❌ Invalid format. Use letters/digits/`-`/`_` (4–24 chars).")
         pending_redeem[uid] = ctx; ctx["stage"] = "await_code"
         return
     make_codes_and_reply(message.chat.id, uid, ctx["category"], ctx["accounts"], max_uses=1, expires_at=None, custom_code=code)
 
-@bot.message_handler(func=lambda m: pending_redeem.get(m.from_user.id, {}).get("stage") == "await_time", content_types=['text'])
 def finalize_time_code(message):
     uid = message.from_user.id
     ctx = pending_redeem.pop(uid, None)
@@ -675,13 +3148,12 @@ def finalize_time_code(message):
         hours = int(message.text.strip())
         if hours <= 0: raise ValueError()
     except:
-        bot.send_message(message.chat.id, "❌ Please send a positive integer (hours).")
+        api.send_message(message.chat.id, "❌ Please send a positive integer (hours).")
         pending_redeem[uid] = ctx; ctx["stage"] = "await_time"
         return
     expires_at = int(time.time()) + hours * 3600
     make_codes_and_reply(message.chat.id, uid, ctx["category"], ctx["accounts"], max_uses=999999999, expires_at=expires_at)
 
-@bot.message_handler(func=lambda m: pending_redeem.get(m.from_user.id, {}).get("stage") == "await_limit", content_types=['text'])
 def finalize_limit_code(message):
     uid = message.from_user.id
     ctx = pending_redeem.pop(uid, None)
@@ -690,7 +3162,7 @@ def finalize_limit_code(message):
         lim = int(message.text.strip())
         if lim <= 0: raise ValueError()
     except:
-        bot.send_message(message.chat.id, "❌ Please send a positive integer (user limit).")
+        api.send_message(message.chat.id, "❌ Please send a positive integer (user limit).")
         pending_redeem[uid] = ctx; ctx["stage"] = "await_limit"
         return
     make_codes_and_reply(message.chat.id, uid, ctx["category"], ctx["accounts"], max_uses=lim, expires_at=None)
@@ -699,33 +3171,39 @@ def finalize_limit_code(message):
 #     PROOF SCREENSHOT HANDLERS
 # ==============================
 @bot.callback_query_handler(func=lambda call: call.data.startswith("proof_"))
+@timed
 def handle_proof_click(call):
     user_id = call.from_user.id
     if user_id in banned_users:
         return
 
     code = call.data.split("_", 1)[1]
-    if code not in codes_db:
-        try: bot.answer_callback_query(call.id, "⚠️ This code is not valid.")
+    info = codes_db.get(code)
+    if info is None:
+        found = code_archive.lookup(code)
+        info = found[0] if found else None
+    if info is None:
+        try: api.answer_callback_query(call.id, "⚠️ This code is not valid.")
         except: pass
         return
 
-    category = codes_db[code]["category"]
+    category = info["category"]
     set_pending_proof(user_id, code, category)
 
     try:
-        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        api.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
     except:
         pass
 
     try:
-        bot.answer_callback_query(call.id, "Now send your screenshot as a *photo*.")
+        api.answer_callback_query(call.id, "Now send your screenshot as a *photo*.")
     except:
         pass
 
-    bot.send_message(user_id, "✅ Please send your **proof screenshot** now (send as *photo*, not file).")
+    api.send_message(user_id, "✅ Please send your **proof screenshot** now (send as *photo*, not file).")
 
 @bot.message_handler(func=lambda m: m.content_type == 'photo' and has_pending_proof(m.from_user.id), content_types=['photo'])
+@timed
 def receive_proof_photo(message):
     user_id = message.from_user.id
     ctx = get_and_prune_pending_proof(user_id)
@@ -735,36 +3213,43 @@ def receive_proof_photo(message):
     category = ctx["category"]
     caption_html = proof_caption_html(message.from_user, user_id, code, category)
 
+    if not proof_slots.acquire(blocking=False):
+        # the pending proof stays set, so the user can simply resend
+        return api.send_message(user_id, "⏳ Too many screenshots are being processed. Please send it again in a minute.")
+    try:
+        ok, err = send_proof_photo(message, caption_html)
+    finally:
+        proof_slots.release()
+    clear_pending_proof(user_id)
+    if ok:
+        return api.send_message(user_id, "✅ Your screenshot has been sent to the channel. Thank you!")
+    api.send_message(user_id, explain_send_error(err))
+
+@timed
+def send_proof_photo(message, caption_html):
     ok, err = try_send_proof_via_copy(message, caption_html)
     if ok:
-        clear_pending_proof(user_id)
-        return bot.send_message(user_id, "✅ Your screenshot has been sent to the channel. Thank you!")
+        return True, None
 
     photo_file_id = None
     try:
         photo_file_id = message.photo[-1].file_id
     except Exception:
         pass
-    if photo_file_id:
-        ok2, err2 = try_send_proof_via_file_id_photo(photo_file_id, caption_html)
-        if ok2:
-            clear_pending_proof(user_id)
-            return bot.send_message(user_id, "✅ Your screenshot has been sent to the channel. Thank you!")
-    else:
-        err2 = "No photo file_id available."
+    if not photo_file_id:
+        return False, "No photo file_id available."
 
-    if photo_file_id:
-        ok3, err3 = try_download_and_reupload(photo_file_id, caption_html)
-        if ok3:
-            clear_pending_proof(user_id)
-            return bot.send_message(user_id, "✅ Your screenshot has been sent to the channel. Thank you!")
-    else:
-        err3 = "No file_id to download."
+    ok2, err2 = try_send_proof_via_file_id_photo(photo_file_id, caption_html)
+    if ok2:
+        return True, None
 
-    clear_pending_proof(user_id)
-    bot.send_message(user_id, explain_send_error(err3 or err2 or err))
+    ok3, err3 = try_download_and_reupload(photo_file_id, caption_html)
+    if ok3:
+        return True, None
+    return False, err3 or err2 or err
 
 @bot.message_handler(func=lambda m: m.content_type == 'document' and has_pending_proof(m.from_user.id), content_types=['document'])
+@timed
 def receive_proof_document(message):
     user_id = message.from_user.id
     ctx = get_and_prune_pending_proof(user_id)
@@ -775,35 +3260,44 @@ def receive_proof_document(message):
     name = (message.document.file_name or "").lower()
     is_image = mime.startswith("image/") or name.endswith((".jpg", ".jpeg", ".png", ".webp", ".bmp"))
     if not is_image:
-        return bot.send_message(user_id, "⚠️ Please send an *image* as a photo or image file.")
+        return api.send_message(user_id, "⚠️ Please send an *image* as a photo or image file.")
 
     code = ctx["code"]
     category = ctx["category"]
     caption_html = proof_caption_html(message.from_user, user_id, code, category)
 
+    if not proof_slots.acquire(blocking=False):
+        # the pending proof stays set, so the user can simply resend
+        return api.send_message(user_id, "⏳ Too many screenshots are being processed. Please send it again in a minute.")
+    try:
+        ok, err = send_proof_document(message, caption_html)
+    finally:
+        proof_slots.release()
+    clear_pending_proof(user_id)
+    if ok:
+        return api.send_message(user_id, "✅ Your screenshot has been sent to the channel. Thank you!")
+    api.send_message(user_id, explain_send_error(err))
+
+@timed
+def send_proof_document(message, caption_html):
     ok, err = try_send_proof_via_copy(message, caption_html)
     if ok:
-        clear_pending_proof(user_id)
-        return bot.send_message(user_id, "✅ Your screenshot has been sent to the channel. Thank you!")
+        return True, None
 
     file_id = message.document.file_id
     ok2, err2 = try_send_proof_via_file_id_doc(file_id, caption_html)
     if ok2:
-        clear_pending_proof(user_id)
-        return bot.send_message(user_id, "✅ Your screenshot has been sent to the channel. Thank you!")
+        return True, None
 
     ok3, err3 = try_download_and_reupload(file_id, caption_html, filename_prefix="proof_doc")
     if ok3:
-        clear_pending_proof(user_id)
-        return bot.send_message(user_id, "✅ Your screenshot has been sent to the channel. Thank you!")
-
-    clear_pending_proof(user_id)
-    bot.send_message(user_id, explain_send_error(err3 or err2 or err))
+        return True, None
+    return False, err3 or err2 or err
 
 # ==============================
 #       PUBLIC FILE FEATURES
 # ==============================
-def privacy_keyboard(kind: str, code: str):
+def build_privacy_keyboard(kind: str, code: str):
     kb = telebot.types.InlineKeyboardMarkup()
     kb.add(
         telebot.types.InlineKeyboardButton("🌍 Public", callback_data=f"privacy:{kind}:{code}:public"),
@@ -812,21 +3306,25 @@ def privacy_keyboard(kind: str, code: str):
     )
     return kb
 
+def privacy_keyboard(kind: str, code: str):
+    template = render_cache.get(("privacy",), lambda: markup_template(build_privacy_keyboard, "kind", "code"))
+    return template.format(kind=json_fragment(kind), code=json_fragment(code))
+
 @bot.message_handler(commands=["bundle"])
 def bundle_start(message):
     if message.from_user.id in banned_users:
         return
     bundle_sessions[message.from_user.id] = []
-    bot.send_message(message.chat.id, "🧺 Bundle mode ON.\nSend files now. When done, use /finish to create one link.\nUse /cancel to exit without saving.")
+    api.send_message(message.chat.id, "🧺 Bundle mode ON.\nSend files now. When done, use /finish to create one link.\nUse /cancel to exit without saving.")
 
 @bot.message_handler(commands=["cancel"])
 def bundle_cancel(message):
     if message.from_user.id in banned_users:
         return
     if bundle_sessions.pop(message.from_user.id, None) is not None:
-        bot.send_message(message.chat.id, "✅ Bundle cancelled.")
+        api.send_message(message.chat.id, "✅ Bundle cancelled.")
     else:
-        bot.send_message(message.chat.id, "ℹ️ You were not bundling anything.")
+        api.send_message(message.chat.id, "ℹ️ You were not bundling anything.")
 
 @bot.message_handler(commands=["finish"])
 def bundle_finish(message):
@@ -834,124 +3332,183 @@ def bundle_finish(message):
         return
     items = bundle_sessions.get(message.from_user.id)
     if not items:
-        return bot.send_message(message.chat.id, "⚠️ No files in your bundle. Use /bundle then upload files.")
+        return api.send_message(message.chat.id, "⚠️ No files in your bundle. Use /bundle then upload files.")
     code = generate_unique_code()
-    bundles_db[code] = {
-        "owner": message.from_user.id,
-        "items": items[:],
-        "created_at": int(time.time()),
-        "access": {"mode": "public", "limit": None, "viewed_by": []}
-    }
-    save_bundles_db()
+    created_at = int(time.time())
+    bundles_db[code] = BundleRecord(message.from_user.id, items, created_at)
+    save_bundles_db(code)
+    with db_lock:
+        index_owner_item(message.from_user.id, created_at, "b", code)
     bundle_sessions.pop(message.from_user.id, None)
     link = build_share_link(code)
-    bot.send_message(
+    api.send_message(
         message.chat.id,
         f"✅ Bundle created with **{len(items)}** file(s).\n🔗 Share link:\n`{link}`\n\n"
         "Set bundle privacy:",
         reply_markup=privacy_keyboard("bundle", code)
     )
 
+def send_myfiles_item(chat_id, kind, code):
+    if kind == "f":
+        entry = files_db.get(code)
+        if not entry:
+            return
+        header = f"🗂 **File** `{code}` ({entry.type})"
+        kb_kind = "file"
+    else:
+        entry = bundles_db.get(code)
+        if not entry:
+            return
+        header = f"📦 **Bundle** `{code}` ({len(entry.items)} items)"
+        kb_kind = "bundle"
+    lim = entry.limit
+    api.send_message(
+        chat_id,
+        f"{header} — {readable_time(entry.created_at)}\n"
+        f"🔗 {build_share_link(code)}\n"
+        f"🔒 Privacy: *{entry.mode.label}*" + (f" (limit {lim})" if entry.mode == AccessMode.UNLISTED and lim else ""),
+        reply_markup=privacy_keyboard(kb_kind, code)
+    )
+
+def send_myfiles_page(chat_id, uid, cursor=None, direction="older"):
+    """Send one page of the owner's uploads, newest first.
+
+    cursor is the (created_at, kind, code) key of the page edge: "older" lists items strictly
+    before it, "newer" lists items strictly after it.
+    """
+    items = owner_index.get(uid, [])
+    if direction == "newer":
+        lo = bisect.bisect_right(items, cursor)
+        hi = min(len(items), lo + MYFILES_PAGE_SIZE)
+    else:
+        hi = len(items) if cursor is None else bisect.bisect_left(items, cursor)
+        lo = max(0, hi - MYFILES_PAGE_SIZE)
+    page = items[lo:hi]
+    if not page:
+        return api.send_message(chat_id, "📭 Nothing to show yet.")
+    for _, kind, code in reversed(page):
+        send_myfiles_item(chat_id, kind, code)
+
+    nav = []
+    if hi < len(items):
+        nav.append(telebot.types.InlineKeyboardButton("⬅️ Newer", callback_data="myfiles:newer:%d:%s:%s" % page[-1]))
+    if lo > 0:
+        nav.append(telebot.types.InlineKeyboardButton("Older ➡️", callback_data="myfiles:older:%d:%s:%s" % page[0]))
+    if nav:
+        kb = telebot.types.InlineKeyboardMarkup()
+        kb.add(*nav)
+        api.send_message(chat_id, f"📄 Showing {len(items) - hi + 1}–{len(items) - lo} of {len(items)}", reply_markup=kb)
+
 @bot.message_handler(commands=["myfiles"])
 def myfiles_cmd(message):
     uid = message.from_user.id
     if uid in banned_users:
         return
-    user_files = [(c, e) for c, e in files_db.items() if e.get("owner") == uid]
-    user_bundles = [(c, e) for c, e in bundles_db.items() if e.get("owner") == uid]
-
-    if not user_files and not user_bundles:
-        return bot.send_message(message.chat.id, "📭 You have no uploads yet. Send any file to get a link.")
-
-    # Show up to 20 with per-item privacy buttons
-    count = 0
-    for code, entry in sorted(user_files, key=lambda x: x[1].get("created_at", 0), reverse=True)[:20]:
-        acc = entry.get("access", {})
-        mode = acc.get("mode", "public")
-        lim = acc.get("limit")
-        bot.send_message(
-            message.chat.id,
-            f"🗂 **File** `{code}` ({entry.get('type')}) — {readable_time(entry.get('created_at', 0))}\n"
-            f"🔗 {build_share_link(code)}\n"
-            f"🔒 Privacy: *{mode}*" + (f" (limit {lim})" if mode == "unlisted" and lim else ""),
-            reply_markup=privacy_keyboard("file", code)
-        )
-        count += 1
-    for code, entry in sorted(user_bundles, key=lambda x: x[1].get("created_at", 0), reverse=True)[:20]:
-        acc = entry.get("access", {})
-        mode = acc.get("mode", "public")
-        lim = acc.get("limit")
-        bot.send_message(
-            message.chat.id,
-            f"📦 **Bundle** `{code}` ({len(entry.get('items', []))} items) — {readable_time(entry.get('created_at', 0))}\n"
-            f"🔗 {build_share_link(code)}\n"
-            f"🔒 Privacy: *{mode}*" + (f" (limit {lim})" if mode == "unlisted" and lim else ""),
-            reply_markup=privacy_keyboard("bundle", code)
-        )
-        count += 1
-    if count == 0:
-        bot.send_message(message.chat.id, "📭 Nothing to show yet.")
+    if not owner_index.get(uid):
+        return api.send_message(message.chat.id, "📭 You have no uploads yet. Send any file to get a link.")
+    send_myfiles_page(message.chat.id, uid)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith("myfiles:"))
+def handle_myfiles_page(call):
+    uid = call.from_user.id
+    if uid in banned_users:
+        return
+    _, direction, ts, kind, code = call.data.split(":", 4)
+    try: api.answer_callback_query(call.id)
+    except: pass
+    try: api.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+    except: pass
+    send_myfiles_page(call.message.chat.id, uid, (int(ts), kind, code), direction)
+
+def copy_runs(msg_ids):
+    """Split [(store_msg_id, code), ...] into copyMessages batches.
+
+    copyMessages takes up to COPY_BATCH_LIMIT ids in strictly increasing order, so a new
+    batch starts whenever the order breaks; bundle order is preserved.
+    """
+    runs = []
+    for mid, code in msg_ids:
+        if runs and len(runs[-1]) < COPY_BATCH_LIMIT and runs[-1][-1][0] < mid:
+            runs[-1].append((mid, code))
+        else:
+            runs.append([(mid, code)])
+    return runs
+
+def deliver_bundle_items(chat_id, items):
+    """Copy bundle items from the store channel in batches; returns how many were delivered."""
+    msg_ids = [(files_db[c].store_msg_id, c) for c in items if c in files_db]
+    sent_count = 0
+    for run in copy_runs(msg_ids):
+        try:
+            copied = api.copy_messages(chat_id, STORE_CHANNEL_ID, [mid for mid, _ in run])
+            sent_count += len(copied)
+            if len(copied) < len(run):
+                print(f"copyMessages to {chat_id} skipped {len(run) - len(copied)} of {len(run)} message(s)")
+            continue
+        except Exception as e:
+            print(f"copyMessages to {chat_id} failed, copying {len(run)} item(s) one by one:", e)
+        # per-item fallback only for the batch that failed
+        for mid, c in run:
+            try:
+                api.copy_message(chat_id=chat_id, from_chat_id=STORE_CHANNEL_ID, message_id=mid)
+                sent_count += 1
+            except Exception as e:
+                api.send_message(chat_id, f"⚠️ Failed on item `{c}`: `{e}`")
+    return sent_count
 
+@timed
 def serve_file_by_code(chat_id: int, code: str):
     # Single file
     if code in files_db:
         entry = files_db[code]
-        ok, reason = access_ok_for_file(entry, chat_id)
+        ok, reason, claimed = claim_view("files", code, entry, chat_id)
         if not ok:
-            bot.send_message(chat_id, reason)
+            api.send_message(chat_id, reason)
             return
         try:
-            bot.copy_message(chat_id=chat_id, from_chat_id=STORE_CHANNEL_ID, message_id=entry["store_msg_id"])
-            record_view(entry, chat_id, save_files_db)
+            api.copy_message(chat_id=chat_id, from_chat_id=STORE_CHANNEL_ID, message_id=entry.store_msg_id)
         except Exception as e:
-            bot.send_message(chat_id, f"⚠️ Failed to fetch file for `{code}`.\n`{e}`")
+            if claimed:
+                release_view("files", code, entry, chat_id)
+            api.send_message(chat_id, f"⚠️ Failed to fetch file for `{code}`.\n`{e}`")
             return
-        bot.send_message(chat_id, f"🔗 Share link:\n`{build_share_link(code)}`")
-        save_files_db()
+        api.send_message(chat_id, f"🔗 Share link:\n`{build_share_link(code)}`")
         return
 
     # Bundle
     if code in bundles_db:
         bundle = bundles_db[code]
-        ok, reason = access_ok_for_file(bundle, chat_id)  # reuse checker
-        if not ok:
-            bot.send_message(chat_id, reason)
-            return
-        items = bundle.get("items", [])
+        items = bundle.items
         if not items:
-            bot.send_message(chat_id, "⚠️ This bundle is empty.")
+            api.send_message(chat_id, "⚠️ This bundle is empty.")
             return
-        bot.send_message(chat_id, f"📦 Sending *{len(items)}* item(s) from bundle `{code}` …")
-        sent_any = False
-        for c in items:
-            if c in files_db:
-                entry = files_db[c]
-                try:
-                    bot.copy_message(chat_id=chat_id, from_chat_id=STORE_CHANNEL_ID, message_id=entry["store_msg_id"])
-                    sent_any = True
-                except Exception as e:
-                    bot.send_message(chat_id, f"⚠️ Failed on item `{c}`: `{e}`")
-                    continue
-        if sent_any:
-            record_view(bundle, chat_id, save_bundles_db)
-            bot.send_message(chat_id, f"🔗 Bundle link:\n`{build_share_link(code)}`")
-            save_bundles_db()
+        ok, reason, claimed = claim_view("bundles", code, bundle, chat_id)
+        if not ok:
+            api.send_message(chat_id, reason)
+            return
+        api.send_message(chat_id, f"📦 Sending *{len(items)}* item(s) from bundle `{code}` …")
+        started = time.monotonic()
+        sent_count = deliver_bundle_items(chat_id, items)
+        elapsed = time.monotonic() - started
+        histogram("bundle_delivery_seconds").observe(elapsed)
+        print(f"📦 Bundle {code}: {sent_count}/{len(items)} item(s) delivered to {chat_id} in {elapsed:.2f}s")
+        if sent_count:
+            api.send_message(chat_id, f"🔗 Bundle link:\n`{build_share_link(code)}`")
+        elif claimed:
+            release_view("bundles", code, bundle, chat_id)
         return
 
-    bot.send_message(chat_id, "❌ Invalid link/code.\nSend /help for usage.")
+    api.send_message(chat_id, "❌ Invalid link/code.\nSend /help for usage.")
 
-@bot.message_handler(func=lambda m: (m.content_type == 'text') and (
-    is_deeplink(m.text) or (m.text.strip() in files_db) or (m.text.strip() in bundles_db)
-))
-def retrieve_by_link_or_code(message):
+def retrieve_by_link_or_code(message, code=None):
     if message.from_user.id in banned_users:
         return
-    code = is_deeplink(message.text) or message.text.strip()
+    code = code or is_deeplink(message.text) or message.text.strip()
     serve_file_by_code(message.chat.id, code)
 
 def prompt_privacy_set(chat_id, kind, code):
     kb = privacy_keyboard(kind, code)
-    bot.send_message(chat_id, "Set privacy for this item:", reply_markup=kb)
+    api.send_message(chat_id, "Set privacy for this item:", reply_markup=kb)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("privacy:"))
 def handle_privacy_click(call):
@@ -961,48 +3518,43 @@ def handle_privacy_click(call):
         entry = files_db.get(code)
         if not entry:
             return
-        if entry.get("owner") != uid and uid not in admins:
-            bot.answer_callback_query(call.id, "You can't change privacy for this item.")
+        if entry.owner != uid and uid not in admins:
+            api.answer_callback_query(call.id, "You can't change privacy for this item.")
             return
         if mode == "unlisted":
             pending_privacy[uid] = {"kind": "file", "code": code}
-            bot.answer_callback_query(call.id, "Send viewer limit number for Unlisted (e.g., 50).")
-            bot.send_message(call.message.chat.id, "🔗 Send **viewer limit** for *Unlisted* (or `0` for unlimited).")
+            api.answer_callback_query(call.id, "Send viewer limit number for Unlisted (e.g., 50).")
+            api.send_message(call.message.chat.id, "🔗 Send **viewer limit** for *Unlisted* (or `0` for unlimited).")
             return
-        entry["access"]["mode"] = mode
-        if mode != "unlisted":
-            entry["access"]["limit"] = None
-            entry["access"]["viewed_by"] = []
-        save_files_db()
-        try: bot.answer_callback_query(call.id, f"Privacy set to {mode}.")
+        with db_lock:
+            entry.set_access(AccessMode.parse(mode))
+            save_files_db(code)
+        try: api.answer_callback_query(call.id, f"Privacy set to {mode}.")
         except: pass
-        try: bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        try: api.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
         except: pass
-        bot.send_message(call.message.chat.id, f"✅ File `{code}` privacy: *{mode}*")
+        api.send_message(call.message.chat.id, f"✅ File `{code}` privacy: *{mode}*")
     else:
         entry = bundles_db.get(code)
         if not entry:
             return
-        if entry.get("owner") != uid and uid not in admins:
-            bot.answer_callback_query(call.id, "You can't change privacy for this bundle.")
+        if entry.owner != uid and uid not in admins:
+            api.answer_callback_query(call.id, "You can't change privacy for this bundle.")
             return
         if mode == "unlisted":
             pending_privacy[uid] = {"kind": "bundle", "code": code}
-            bot.answer_callback_query(call.id, "Send viewer limit number for Unlisted (e.g., 100).")
-            bot.send_message(call.message.chat.id, "🔗 Send **viewer limit** for *Unlisted* (or `0` for unlimited).")
+            api.answer_callback_query(call.id, "Send viewer limit number for Unlisted (e.g., 100).")
+            api.send_message(call.message.chat.id, "🔗 Send **viewer limit** for *Unlisted* (or `0` for unlimited).")
             return
-        entry["access"]["mode"] = mode
-        if mode != "unlisted":
-            entry["access"]["limit"] = None
-            entry["access"]["viewed_by"] = []
-        save_bundles_db()
-        try: bot.answer_callback_query(call.id, f"Privacy set to {mode}.")
+        with db_lock:
+            entry.set_access(AccessMode.parse(mode))
+            save_bundles_db(code)
+        try: api.answer_callback_query(call.id, f"Privacy set to {mode}.")
         except: pass
-        try: bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
+        try: api.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
         except: pass
-        bot.send_message(call.message.chat.id, f"✅ Bundle `{code}` privacy: *{mode}*")
+        api.send_message(call.message.chat.id, f"✅ Bundle `{code}` privacy: *{mode}*")
 
-@bot.message_handler(func=lambda m: pending_privacy.get(m.from_user.id) is not None, content_types=['text'])
 def receive_unlisted_limit(message):
     uid = message.from_user.id
     ctx = pending_privacy.pop(uid, None)
@@ -1011,29 +3563,27 @@ def receive_unlisted_limit(message):
         n = int(message.text.strip())
         if n < 0: raise ValueError()
     except:
-        bot.send_message(message.chat.id, "❌ Send a non-negative integer. Try again by tapping Unlisted.")
+        api.send_message(message.chat.id, "❌ Send a non-negative integer. Try again by tapping Unlisted.")
         return
     if ctx["kind"] == "file":
         entry = files_db.get(ctx["code"])
         if not entry: return
-        entry["access"]["mode"] = "unlisted"
-        entry["access"]["limit"] = None if n == 0 else n
-        entry["access"]["viewed_by"] = []
-        save_files_db()
-        bot.send_message(message.chat.id, f"✅ File `{ctx['code']}` set to *Unlisted* (limit: {'unlimited' if n==0 else n}).")
+        with db_lock:
+            entry.set_access(AccessMode.UNLISTED, None if n == 0 else n)
+            save_files_db(ctx["code"])
+        api.send_message(message.chat.id, f"✅ File `{ctx['code']}` set to *Unlisted* (limit: {'unlimited' if n==0 else n}).")
     else:
         entry = bundles_db.get(ctx["code"])
         if not entry: return
-        entry["access"]["mode"] = "unlisted"
-        entry["access"]["limit"] = None if n == 0 else n
-        entry["access"]["viewed_by"] = []
-        save_bundles_db()
-        bot.send_message(message.chat.id, f"✅ Bundle `{ctx['code']}` set to *Unlisted* (limit: {'unlimited' if n==0 else n}).")
+        with db_lock:
+            entry.set_access(AccessMode.UNLISTED, None if n == 0 else n)
+            save_bundles_db(ctx["code"])
+        api.send_message(message.chat.id, f"✅ Bundle `{ctx['code']}` set to *Unlisted* (limit: {'unlimited' if n==0 else n}).")
 
 # ---- Generic uploads ----
 def after_upload_privacy_prompt(chat_id, code, kind):
     kb = privacy_keyboard(kind, code)
-    bot.send_message(
+    api.send_message(
         chat_id,
         "Select privacy for this upload:\n"
         "• 🌍 **Public**: anyone with link/code can access.\n"
@@ -1043,6 +3593,7 @@ def after_upload_privacy_prompt(chat_id, code, kind):
     )
 
 @bot.message_handler(content_types=['document', 'photo', 'video', 'audio', 'sticker', 'voice', 'animation'])
+@timed
 def handle_public_upload(message):
     uid = message.from_user.id
     if uid in banned_users:
@@ -1059,7 +3610,7 @@ def handle_public_upload(message):
 
     try:
         if content_supports_caption(ctype):
-            copied = bot.copy_message(
+            copied = api.copy_message(
                 chat_id=STORE_CHANNEL_ID,
                 from_chat_id=message.chat.id,
                 message_id=message.message_id,
@@ -1068,37 +3619,33 @@ def handle_public_upload(message):
             )
             store_msg_id = copied.message_id
         else:
-            copied = bot.copy_message(
+            copied = api.copy_message(
                 chat_id=STORE_CHANNEL_ID,
                 from_chat_id=message.chat.id,
                 message_id=message.message_id
             )
             store_msg_id = copied.message_id
-            bot.send_message(
+            api.send_message(
                 STORE_CHANNEL_ID,
                 caption_html,
                 parse_mode="HTML",
                 reply_to_message_id=store_msg_id
             )
     except Exception as e:
-        bot.send_message(message.chat.id, f"❌ Failed to store file. Ensure bot is admin in storage channel.\n`{e}`")
+        api.send_message(message.chat.id, f"❌ Failed to store file. Ensure bot is admin in storage channel.\n`{e}`")
         return
 
-    files_db[code] = {
-        "owner": uid,
-        "store_msg_id": int(store_msg_id),
-        "type": ctype,
-        "caption": original_caption or "",
-        "created_at": created_at,
-        "access": {"mode": "public", "limit": None, "viewed_by": []}
-    }
-    save_files_db()
+    files_db[code] = FileRecord(uid, int(store_msg_id), ctype, original_caption, created_at)
+    save_files_db(code)
+    with db_lock:
+        index_owner_item(uid, created_at, "f", code)
 
     if uid in bundle_sessions:
         bundle_sessions[uid].append(code)
-        bot.send_message(message.chat.id, f"➕ Added to bundle.\n`{build_share_link(code)}`")
+        bundle_sessions.touch(uid)
+        api.send_message(message.chat.id, f"➕ Added to bundle.\n`{build_share_link(code)}`")
     else:
-        bot.send_message(
+        api.send_message(
             message.chat.id,
             f"✅ File stored.\n🔗 Share link:\n`{build_share_link(code)}`\n"
             f"Or share the code: `{code}`"
@@ -1109,71 +3656,538 @@ def handle_public_upload(message):
 # ==============================
 #           REDEEM FLOW
 # ==============================
-@bot.message_handler(func=lambda msg: msg.content_type == 'text' and not msg.text.startswith('/'), content_types=['text'])
+# The steps below are shared by redeem_code and the asyncio engine's native redeem.
+REDEEM_INVALID_TEXT = "❌ **Invalid Code**\nThe code you entered does not exist."
+REDEEM_DEAD_TEXT = {"expired": "⏳ This code has expired.", "used": "❌ Code usage limit reached."}
+REDEEM_JOIN_TEXT = (
+    f"⚠️ **ACTION REQUIRED**\n\nYou must join our channel to redeem codes:\n➡️ {FORCE_JOIN_CHANNEL_LINK}\n\n"
+    "Public file hosting is open — you can still upload & share files."
+)
+
+redeem_locks = [threading.Lock() for _ in range(REDEEM_LOCK_STRIPES)]
+
+def redeem_lock(code):
+    return redeem_locks[hash(code) % REDEEM_LOCK_STRIPES]
+
+def take_redeem_use(code, info, user_id):
+    """Check expiry and take one use of a code; returns None on success, else the reply text.
+
+    The use is reserved in memory and committed with a redeem record (store.record_redeem)
+    under the code's lock, so concurrent redeems never oversell and a failed write gives the
+    use back.
+    """
+    exp = info.get("expires_at")
+    if exp and time.time() > exp:
+        return REDEEM_DEAD_TEXT["expired"]
+    with redeem_lock(code):
+        max_uses = int(info.get("max_uses", 1))
+        used_count = int(info.get("used_count", 0))
+        if used_count >= max_uses:
+            return REDEEM_DEAD_TEXT["used"]
+        info["used_count"] = used_count + 1
+        try:
+            store.record_redeem(code, used_count + 1, user_id)
+        except Exception as e:
+            info["used_count"] = used_count
+            print(f"Redeem of {code} could not be saved:", e)
+            return "⚠️ Could not redeem right now, please try again."
+    if used_count + 1 >= max_uses:
+        code_expiry.push(code, time.time() + CODES_ARCHIVE_GRACE)
+    return None
+
+def unknown_code_text(code):
+    """Reply for a code that is not in codes_db: expired/used if it was archived, else invalid."""
+    found = code_archive.lookup(code) if code in code_archive else None
+    return REDEEM_DEAD_TEXT[found[1]] if found else REDEEM_INVALID_TEXT
+
+def build_proof_keyboard(code):
+    markup = telebot.types.InlineKeyboardMarkup()
+    markup.add(telebot.types.InlineKeyboardButton("📸 Send Proof Screenshot", callback_data=f"proof_{code}"))
+    return markup
+
+def redeem_reply(code, info):
+    template = render_cache.get(("proof",), lambda: markup_template(build_proof_keyboard, "code"))
+    markup = template.format(code=json_fragment(code))
+    text = (f"🎉 **Success! Your {info['category']} Account**:\n\n`{info['account']}`\n\n"
+            "Enjoy! Please save your details securely.\n\nYou can also send a proof screenshot below.")
+    return text, markup
+
+def redeem_log_text(user, code, info):
+    return (
+        f"🎉 New Code Redeem!\n"
+        f"User: {user.first_name} (@{user.username})\n"
+        f"Code: {code}\n"
+        f"User ID: {user.id}\n"
+        f"Type: {info['category']}"
+    )
+
+@timed
 def redeem_code(message):
     user_id = message.from_user.id
     if user_id in banned_users:
         return
-    if not has_joined_channel(user_id):
-        bot.send_message(
-            user_id,
-            f"⚠️ **ACTION REQUIRED**\n\nYou must join our channel to redeem codes:\n➡️ {FORCE_JOIN_CHANNEL_LINK}\n\n"
-            "Public file hosting is open — you can still upload & share files."
-        )
-        return
 
+    # unknown codes are rejected before the (cached) membership API call
     code = message.text.strip()
     info = codes_db.get(code)
     if not info:
-        return bot.send_message(user_id, "❌ **Invalid Code**\nThe code you entered does not exist.")
+        return api.send_message(user_id, unknown_code_text(code))
 
-    # Expiry check
-    exp = info.get("expires_at")
-    if exp and time.time() > exp:
-        return bot.send_message(user_id, "⏳ This code has expired.")
+    if not has_joined_channel(user_id):
+        api.send_message(user_id, REDEEM_JOIN_TEXT)
+        return
 
-    # Usage check
-    max_uses = int(info.get("max_uses", 1))
-    used_count = int(info.get("used_count", 0))
-    if used_count >= max_uses:
-        return bot.send_message(user_id, "❌ Code usage limit reached.")
+    error = take_redeem_use(code, info, user_id)
+    if error:
+        return api.send_message(user_id, error)
 
-    # Mark usage
-    info["used_count"] = used_count + 1
-    save_codes_db()
+    text, markup = redeem_reply(code, info)
+    api.send_message(user_id, text, reply_markup=markup)
+    send_to_data_channel(redeem_log_text(message.from_user, code, info))
 
-    acc = info["account"]
-    category = info["category"]
+# ==============================
+#         TEXT ROUTER
+# ==============================
+# Every non-command text message goes through one handler: per-user wizard state first,
+# then the shape of the text (deep link / file or bundle code / anything else).
+REDEEM_STAGE_ROUTES = {
+    "have_cat": receive_accounts_for_redeem,
+    "await_code": finalize_custom_code,
+    "await_time": finalize_time_code,
+    "await_limit": finalize_limit_code,
+}
 
-    markup = telebot.types.InlineKeyboardMarkup()
-    markup.add(telebot.types.InlineKeyboardButton("📸 Send Proof Screenshot", callback_data=f"proof_{code}"))
+def text_route(message):
+    """Pick the handler for a text message; returns (handler, code) or (None, None)."""
+    uid = message.from_user.id
+    ctx = pending_redeem.get(uid)
+    if ctx is not None:
+        handler = REDEEM_STAGE_ROUTES.get(ctx.get("stage"))
+        if handler is not None:
+            return handler, None
+    kind, code = classify_text(message.text)
+    if kind != "text":
+        return retrieve_by_link_or_code, code
+    if uid in pending_privacy:
+        return receive_unlisted_limit, None
+    if message.text.startswith('/'):
+        return None, None
+    return redeem_code, None
 
-    bot.send_message(
-        user_id,
-        f"🎉 **Success! Your {category} Account**:\n\n`{acc}`\n\nEnjoy! Please save your details securely.\n\nYou can also send a proof screenshot below.",
-        reply_markup=markup
-    )
+@bot.message_handler(content_types=['text'])
+def route_text(message):
+    handler, code = text_route(message)
+    if handler is retrieve_by_link_or_code:
+        handler(message, code)
+    elif handler is not None:
+        handler(message)
 
-    text = (
-        f"🎉 New Code Redeem!\n"
-        f"User: {message.from_user.first_name} (@{message.from_user.username})\n"
-        f"Code: {code}\n"
-        f"User ID: {user_id}\n"
-        f"Type: {category}"
-    )
-    send_to_data_channel(text)
+# ==============================
+#        WEBHOOK SERVER
+# ==============================
+webhook_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+gauges["webhook_queue_depth"] = webhook_queue.qsize
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, Telegram reuses connections
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            return self._reply(404)
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return self._reply(403)
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            update = telebot.types.Update.de_json(self.rfile.read(length).decode("utf-8"))
+        except Exception as e:
+            print("Webhook: bad update payload:", e)
+            return self._reply(400)
+        if async_engine is not None:
+            accepted = async_engine.submit_threadsafe(update)
+        else:
+            try:
+                webhook_queue.put_nowait(update)
+                accepted = True
+            except queue.Full:
+                accepted = False
+        if not accepted:
+            # Telegram re-delivers on non-2xx, so shedding load here loses nothing
+            return self._reply(503)
+        self._reply(200)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def webhook_worker():
+    while True:
+        update = webhook_queue.get()
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            print(f"Handler failed for update {update.update_id}:", e)
+        finally:
+            webhook_queue.task_done()
+
+def flush_all():
+    """Drain in-flight updates and write every store out (used on shutdown)."""
+    webhook_queue.join()
+    if hasattr(bot, "drain"):
+        bot.drain()
+    if RESTORE_BUNDLE_SESSIONS:
+        save_bundle_sessions()
+    event_sink.close()
+    saver.flush()
+    for table in ("codes", "files", "bundles"):
+        try:
+            store.flush(table)
+        except Exception as e:
+            print(f"Final save of '{table}' failed:", e)
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def run_webhook():
+    global WEBHOOK_SECRET
+    if not WEBHOOK_SECRET:
+        # Without a secret anyone who can reach the port could post updates "from" an admin
+        if not WEBHOOK_URL:
+            sys.exit("❌ Webhook mode needs WEBHOOK_SECRET (or WEBHOOK_URL, to register one generated now).")
+        WEBHOOK_SECRET = secrets.token_urlsafe(32)
+    server = WebhookServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    if async_engine is not None:
+        async_engine.start_loop_thread()
+    else:
+        for _ in range(WEBHOOK_WORKERS):
+            threading.Thread(target=webhook_worker, daemon=True).start()
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                        max_connections=100)
+
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever returns, so it can't run on the serving thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"🌐 Webhook listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        print("🛑 Shutting down, flushing pending saves...")
+        if async_engine is not None:
+            async_engine.stop_loop_thread()
+        flush_all()
+
+def run_polling():
+    signal.signal(signal.SIGTERM, lambda signum, frame: bot.stop_polling())
+    try:
+        bot.infinity_polling()
+    finally:
+        print("🛑 Shutting down, flushing pending saves...")
+        flush_all()
+
+# ==============================
+#        ASYNCIO ENGINE
+# ==============================
+class AsyncEngine:
+    """BOT_ENGINE=asyncio: updates are handled by coroutines on AsyncTeleBot.
+
+    The hot paths (deep-link /start, file/bundle retrieval by link or code, redeem with a cached
+    join status) run natively on the event loop and await the Bot API over one shared aiohttp
+    session, so a slow Telegram call holds a coroutine instead of a thread. Every other update
+    is handed to the regular sync handlers on a thread pool. A per-user asyncio.Lock keeps one
+    user's updates in arrival order, like OrderedDispatchBot does for the thread engine.
+    db_lock sections run inline when the lock is free and on a thread otherwise; writes to disk
+    go through persist() (ASYNC_PERSIST_CONCURRENCY) and copies out of the store channel through
+    store_slots (ASYNC_STORE_CONCURRENCY). Proofs are delegated and keep using proof_slots.
+    """
+    def __init__(self):
+        from telebot import asyncio_helper
+        from telebot.async_telebot import AsyncTeleBot
+        asyncio_helper.REQUEST_LIMIT = ASYNC_HTTP_CONNECTIONS
+        if TELEGRAM_API_URL:
+            asyncio_helper.API_URL = telebot.apihelper.API_URL
+            asyncio_helper.FILE_URL = telebot.apihelper.FILE_URL
+        self.session_manager = asyncio_helper.session_manager
+        self.abot = AsyncTeleBot(BOT_TOKEN, parse_mode="Markdown")
+        self.api = AsyncTelegramApi(self.abot, api)
+        bot.threaded = False  # delegated handlers run inline on our executor threads
+        self.executor = ThreadPoolExecutor(ASYNC_SYNC_WORKERS, thread_name_prefix="sync-handler")
+        self.store_slots = asyncio.Semaphore(ASYNC_STORE_CONCURRENCY)
+        self.persist_slots = asyncio.Semaphore(ASYNC_PERSIST_CONCURRENCY)
+        self.inflight = threading.BoundedSemaphore(ASYNC_MAX_INFLIGHT)
+        self.user_locks = {}  # uid -> [asyncio.Lock, updates holding or waiting for it]
+        self.tasks = set()
+        self.loop = None
+        self.abot.register_message_handler(self.handle_message,
+                                           content_types=telebot.util.content_type_media + telebot.util.content_type_service)
+        self.abot.register_callback_query_handler(self.handle_callback, func=lambda call: True)
+        gauges["async_updates_inflight"] = lambda: len(self.tasks)
+
+    # --- plumbing ---
+    async def in_order(self, uid, fn, *args):
+        slot = self.user_locks.get(uid)
+        if slot is None:
+            slot = self.user_locks[uid] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                return await fn(*args)
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self.user_locks[uid]
+
+    async def run_sync(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def locked(self, fn, *args):
+        """Run a short db_lock section: inline when the lock is free, else on a thread."""
+        if db_lock.acquire(blocking=False):
+            try:
+                return fn(*args)
+            finally:
+                db_lock.release()
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    async def persist(self, fn, *args):
+        """Run something that writes to disk (journal, registry, sqlite) off the event loop."""
+        async with self.persist_slots:
+            return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    # --- handlers ---
+    async def handle_message(self, message):
+        try:
+            await self.in_order(message.from_user.id, self.route_message, message)
+        except Exception as e:
+            print(f"Handler failed for message from {message.from_user.id}:", e)
+
+    async def handle_callback(self, call):
+        try:
+            await self.in_order(call.from_user.id, self.run_sync, bot.process_new_callback_query, [call])
+        except Exception as e:
+            print(f"Handler failed for callback from {call.from_user.id}:", e)
+
+    async def route_message(self, message):
+        uid = message.from_user.id
+        if message.content_type == "text" and uid not in banned_users:
+            parts = message.text.split(maxsplit=1)
+            if parts and parts[0] in ("/start", f"/start@{BOT_USERNAME}"):
+                code = parts[1].strip() if len(parts) == 2 else ""
+                if code in files_db or code in bundles_db:
+                    if uid in dead_users:
+                        await self.persist(revive_user, uid)
+                    return await self.serve_file_by_code(uid, code)
+            elif not message.text.startswith("/"):
+                handler, code = text_route(message)
+                if handler is retrieve_by_link_or_code:
+                    return await self.serve_file_by_code(message.chat.id, code)
+                if handler is redeem_code and await self.redeem_code(message):
+                    return
+        await self.run_sync(bot.process_new_messages, [message])
+
+    @timed
+    async def serve_file_by_code(self, chat_id, code):
+        """serve_file_by_code() on the event loop."""
+        aapi = self.api
+        table, entry = ("files", files_db.get(code)) if code in files_db else ("bundles", bundles_db.get(code))
+        if entry is None:
+            return await aapi.send_message(chat_id, "❌ Invalid link/code.\nSend /help for usage.")
+        if table == "bundles" and not entry.items:
+            return await aapi.send_message(chat_id, "⚠️ This bundle is empty.")
+        # only Unlisted claims write a view record; Public/Private checks are in-memory
+        claim = self.persist if entry.mode == AccessMode.UNLISTED else self.locked
+        ok, reason, claimed = await claim(claim_view, table, code, entry, chat_id)
+        if not ok:
+            return await aapi.send_message(chat_id, reason)
+
+        if table == "files":
+            try:
+                async with self.store_slots:
+                    await aapi.copy_message(chat_id=chat_id, from_chat_id=STORE_CHANNEL_ID, message_id=entry.store_msg_id)
+            except Exception as e:
+                if claimed:
+                    await self.persist(release_view, table, code, entry, chat_id)
+                return await aapi.send_message(chat_id, f"⚠️ Failed to fetch file for `{code}`.\n`{e}`")
+            return await aapi.send_message(chat_id, f"🔗 Share link:\n`{build_share_link(code)}`")
+
+        items = entry.items
+        await aapi.send_message(chat_id, f"📦 Sending *{len(items)}* item(s) from bundle `{code}` …")
+        started = time.monotonic()
+        sent_count = await self.deliver_bundle_items(chat_id, items)
+        elapsed = time.monotonic() - started
+        histogram("bundle_delivery_seconds").observe(elapsed)
+        print(f"📦 Bundle {code}: {sent_count}/{len(items)} item(s) delivered to {chat_id} in {elapsed:.2f}s")
+        if sent_count:
+            await aapi.send_message(chat_id, f"🔗 Bundle link:\n`{build_share_link(code)}`")
+        elif claimed:
+            await self.persist(release_view, table, code, entry, chat_id)
+
+    async def deliver_bundle_items(self, chat_id, items):
+        msg_ids = [(files_db[c].store_msg_id, c) for c in items if c in files_db]
+        sent_count = 0
+        for run in copy_runs(msg_ids):
+            try:
+                async with self.store_slots:
+                    copied = await self.api.copy_messages(chat_id, STORE_CHANNEL_ID, [mid for mid, _ in run])
+                sent_count += len(copied)
+                if len(copied) < len(run):
+                    print(f"copyMessages to {chat_id} skipped {len(run) - len(copied)} of {len(run)} message(s)")
+                continue
+            except Exception as e:
+                print(f"copyMessages to {chat_id} failed, copying {len(run)} item(s) one by one:", e)
+            for mid, c in run:
+                try:
+                    async with self.store_slots:
+                        await self.api.copy_message(chat_id=chat_id, from_chat_id=STORE_CHANNEL_ID, message_id=mid)
+                    sent_count += 1
+                except Exception as e:
+                    await self.api.send_message(chat_id, f"⚠️ Failed on item `{c}`: `{e}`")
+        return sent_count
+
+    @timed
+    async def redeem_code(self, message):
+        """redeem_code() on the event loop; returns False (nothing sent) when the join status
+        is not cached, so the sync handler does the membership check."""
+        uid = message.from_user.id
+        code = message.text.strip()
+        info = codes_db.get(code)
+        if not info:
+            # the Bloom check is in memory; only a possible hit reads the archive, on a thread
+            text = await self.run_sync(unknown_code_text, code) if code in code_archive else REDEEM_INVALID_TEXT
+            await self.api.send_message(uid, text)
+            return True
+        joined = cached_membership(uid)
+        if joined is None:
+            return False
+        if not joined:
+            await self.api.send_message(uid, REDEEM_JOIN_TEXT)
+            return True
+        error = await self.persist(take_redeem_use, code, info, uid)
+        if error:
+            await self.api.send_message(uid, error)
+            return True
+        text, markup = redeem_reply(code, info)
+        await self.api.send_message(uid, text, reply_markup=markup)
+        send_to_data_channel(redeem_log_text(message.from_user, code, info))
+        return True
+
+    # --- running ---
+    async def process(self, update):
+        try:
+            await self.abot.process_new_updates([update])
+        finally:
+            self.inflight.release()
+
+    def spawn(self, update):
+        task = asyncio.ensure_future(self.process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def submit_threadsafe(self, update):
+        """Queue an update from another thread (webhook); False when ASYNC_MAX_INFLIGHT are in flight."""
+        if not self.inflight.acquire(blocking=False):
+            return False
+        self.loop.call_soon_threadsafe(self.spawn, update)
+        return True
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+    async def shutdown(self):
+        await self.drain()
+        if self.session_manager.session is not None:
+            await self.abot.close_session()
+
+    async def poll(self):
+        offset = None
+        while True:
+            try:
+                updates = await self.abot.get_updates(offset=offset, timeout=20)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("getUpdates failed:", e)
+                await asyncio.sleep(3)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                while not self.inflight.acquire(blocking=False):
+                    await asyncio.sleep(0.05)
+                self.spawn(update)
+
+    def run_polling(self):
+        async def main():
+            self.loop = asyncio.get_running_loop()
+            poller = asyncio.ensure_future(self.poll())
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                self.loop.add_signal_handler(sig, poller.cancel)
+            try:
+                await poller
+            except asyncio.CancelledError:
+                pass
+            await self.shutdown()
+
+        try:
+            asyncio.run(main())
+        finally:
+            print("🛑 Shutting down, flushing pending saves...")
+            flush_all()
+
+    def start_loop_thread(self):
+        """Run the event loop on a background thread (webhook mode: the HTTP server submits into it)."""
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def stop_loop_thread(self):
+        try:
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        except Exception as e:
+            print("Async engine shutdown failed:", e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+async_engine = None  # set in __main__ when BOT_ENGINE=asyncio
 
 # ==============================
 #      RUN BOT
 # ==============================
 if __name__ == '__main__':
+    if sys.argv[1:2] == ["migrate-sqlite"]:
+        migrate_json_to_sqlite()
+        sys.exit(0)
     print("🔄 Loading data from files...")
     load_data()
+    threading.Thread(target=compaction_loop, daemon=True).start()
+    threading.Thread(target=archive_loop, daemon=True).start()
+    session_sweeper.start()
+    saver.start()
+    event_sink.start()
+    if PERF_PORT:
+        start_metrics_server()
     try:
         me = bot.get_me()
         BOT_USERNAME = (me.username or "").strip()
         print(f"🤖 Bot username: @{BOT_USERNAME}")
     except Exception as e:
         print("⚠️ Could not fetch bot username:", e)
-    print("🤖 Bot is now running...")
-    bot.infinity_polling()
\ No newline at end of file
+    if load_broadcast_state():
+        print("📢 An interrupted broadcast was found. Send /resumebroadcast to finish it.")
+    if BOT_ENGINE == "asyncio":
+        async_engine = AsyncEngine()
+    print(f"🤖 Bot is now running ({BOT_ENGINE} engine)...")
+    if BOT_MODE == "webhook":
+        run_webhook()
+    elif async_engine is not None:
+        async_engine.run_polling()
+    else:
+        run_polling()
\ No newline at end of file
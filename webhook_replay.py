@@ -0,0 +1,128 @@
+"""Replay recorded Telegram updates against the bot's webhook endpoint.
+
+Usage:
+    python webhook_replay.py updates.jsonl [--url http://127.0.0.1:8443/webhook]
+                             [--secret S] [--concurrency 16] [--repeat 1]
+    python webhook_replay.py --synthetic 10000 ...
+
+The input is either a JSON array of updates or one update per line (JSONL), e.g. the raw
+bodies Telegram posted to the webhook. --synthetic generates /start and text updates for
+N fake users instead. Update ids are rewritten so repeats are not dropped as duplicates.
+Prints accepted/rejected counts, updates per second and ack latency percentiles.
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def load_updates(path):
+    with open(path, "r") as f:
+        raw = f.read().strip()
+    if raw.startswith("["):
+        return json.loads(raw)
+    return [json.loads(line) for line in raw.splitlines() if line.strip()]
+
+
+def synthetic_updates(n):
+    updates = []
+    for i in range(n):
+        uid = 10_000_000 + i
+        text = "/start" if i % 2 == 0 else "hello"
+        msg = {
+            "message_id": i + 1,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": uid, "is_bot": False, "first_name": f"User{i}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        updates.append({"update_id": i + 1, "message": msg})
+    return updates
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100.0 * len(sorted_values)))]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("file", nargs="?", help="recorded updates (JSON array or JSONL)")
+    ap.add_argument("--synthetic", type=int, default=0, help="generate N updates instead of reading a file")
+    ap.add_argument("--url", default="http://127.0.0.1:8443/webhook")
+    ap.add_argument("--secret", default="")
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--repeat", type=int, default=1)
+    args = ap.parse_args()
+
+    if args.synthetic:
+        base = synthetic_updates(args.synthetic)
+    elif args.file:
+        base = load_updates(args.file)
+    else:
+        ap.error("give a recorded updates file or --synthetic N")
+
+    bodies = []
+    next_id = 1
+    for _ in range(args.repeat):
+        for upd in base:
+            upd = dict(upd, update_id=next_id)
+            next_id += 1
+            bodies.append(json.dumps(upd).encode("utf-8"))
+
+    url = urlsplit(args.url)
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+
+    lock = threading.Lock()
+    cursor = [0]
+    latencies = []
+    statuses = {}
+
+    def worker():
+        conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+        while True:
+            with lock:
+                i = cursor[0]
+                cursor[0] += 1
+            if i >= len(bodies):
+                break
+            started = time.perf_counter()
+            try:
+                conn.request("POST", url.path or "/", body=bodies[i], headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+                status = resp.status
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+                status = "error"
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+        conn.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"Posted {len(bodies)} updates in {wall:.2f}s -> {len(bodies) / wall:.0f} updates/s")
+    print("Status codes:", ", ".join(f"{k}: {v}" for k, v in sorted(statuses.items(), key=str)))
+    print("Ack latency ms: p50 {:.1f}  p95 {:.1f}  p99 {:.1f}  max {:.1f}".format(
+        *(percentile(latencies, p) * 1000 for p in (50, 95, 99)), latencies[-1] * 1000 if latencies else 0.0))
+
+
+if __name__ == "__main__":
+    main()